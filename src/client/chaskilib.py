@@ -10,7 +10,16 @@ DEFAULT_PORT = 4567
 RESPONSE_TIMEOUT = 5000
 RECEIVE_BUFLEN = 1024
 ENCODING = 'UTF-8'
-NAMESPACE = '{http://www.some.com/chaski}'
+# namespace of Mail and Fetch (see chaski.xsd)
+NAMESPACE = '{urn:chaski:org}'
+# namespace of Result sent by the server
+RESULT_NAMESPACE = '{http://www.some.com/chaski}'
+# elements of fetch conditions in the order of chaski.xsd
+FETCH_CONDITIONS = ['OnlyHeader', 'MinReceiveDate', 'MaxReceiveDate'\
+                    , 'RemoveAfterFetch', 'MaxMessages', 'MaxBytes', 'Cursor']
+FETCH_DEFAULTS = {'OnlyHeader': 'false', 'RemoveAfterFetch': 'false'}
+RESULT_START = '<chaski:Result'
+RESULT_END = '</chaski:Result>'
 
 class ChaskiError(Exception) :
     pass
@@ -64,8 +73,8 @@ def send_messages(server_address, credentials, messages\
                   , progress_listener=dummy_listener) :
 
     def transform_response(response) :
-        return response.findtext(NAMESPACE + 'Status') == STATUS_OK\
-               , response.findtext(NAMESPACE + 'Description')
+        return response.findtext(RESULT_NAMESPACE + 'Status') == STATUS_OK\
+               , response.findtext(RESULT_NAMESPACE + 'Description')
 
     mail = create_mail(credentials, messages)
     progress_listener.on_progress(2)
@@ -78,20 +87,96 @@ def send_messages(server_address, credentials, messages\
 
 
 def fetch_messages(server_address, credentials, rcpnts, filters={}\
-                   , progress_listener=dummy_listener) :
-
-        
-    mail = create_fetch_mail(credentials, rcpnts, filters)
-    progress_listener.on_progress(2)
+                   , progress_listener=dummy_listener\
+                   , page_messages=None, page_bytes=None) :
+    """
+    fetches messages of rcpnts accounts from chaski server.
+    filters -> dict of fetch conditions by element name
+               (e.g. {'OnlyHeader': 'true', 'MinReceiveDate': '2010-01-31'})
+    page_messages, page_bytes (optional) -> limits of one server response,
+               all the pages are fetched one by one
+    returns (True, list of tupelized messages) on success,
+            (False, error message) otherwise
+    """
+    messages = []
     try:
-        response = exchange_messages(server_address, mail, progress_listener)
+        for page in fetch_pages(server_address, credentials, rcpnts, filters\
+                                , progress_listener\
+                                , page_messages, page_bytes) :
+            messages.extend(page)
     except ChaskiError, errmes :
         return False, errmes
+    return True, messages
+
+
+def fetch_pages(server_address, credentials, rcpnts, filters={}\
+                , progress_listener=dummy_listener\
+                , page_messages=None, page_bytes=None) :
+    """
+    generator of pages of fetched messages, each page is a list of
+    tupelized messages of one server response. Next page is requested
+    with NextCursor of the previous one. Raises ChaskiError on failure.
+    """
+    filters = dict(filters)
+    if page_messages is not None :
+        filters['MaxMessages'] = str(page_messages)
+    if page_bytes is not None :
+        filters['MaxBytes'] = str(page_bytes)
+    while True :
+        mail = create_fetch_mail(credentials, rcpnts, filters)
+        progress_listener.on_progress(2)
+        response = exchange_fetch(server_address, mail, progress_listener)
+        yield tupelize_mail(response)
+        cursor = response.findtext(NAMESPACE + 'NextCursor')
+        if not cursor :
+            break
+        filters['Cursor'] = cursor
+
+
+def exchange_fetch(server_address, message, progress_listener) :
+    """sends fetch and returns the fetched mail read till the end
+    of server response (the mail is followed by chaski:Result)"""
+    s = send_request(server_address, message, progress_listener)
+    data = read_response(s)
+    start = data.rfind(RESULT_START)
+    if start < 0 :
+        raise ChaskiError('Incomplete server response')
+    result = xml_fromstr(data[start:])
+    if result.findtext(RESULT_NAMESPACE + 'Status') != STATUS_OK \
+           or not data[:start].strip() :
+        raise ChaskiError(result.findtext(RESULT_NAMESPACE + 'Description'))
+    return xml_fromstr(data[:start])
 
-    return True, tupelize_mail(response)
-    
 
 def exchange_messages(server_address, message, progress_listener) :
+    s = send_request(server_address, message, progress_listener)
+    # TODO: must be changed to something capable to handle huge data with progress
+    #       notification.
+    response = read_response(s)
+    print response
+    return xml_fromstr(response)
+
+def read_response(s) :
+    """reads server response till the end of chaski:Result and closes
+    the socket, server may keep the connection open after Result"""
+    chunks = []
+    tail = ''
+    try:
+        while True :
+            chunk = s.recv(RECEIVE_BUFLEN)
+            if not chunk :
+                break
+            chunks.append(chunk)
+            tail = (tail + chunk)[-RECEIVE_BUFLEN:]
+            if tail.rstrip().endswith(RESULT_END) :
+                break
+    finally:
+        s.close()
+    return ''.join(chunks)
+
+def send_request(server_address, message, progress_listener) :
+    """sends message and returns socket with server response
+    ready to read"""
     s = socket.socket()
     if isinstance(server_address, str) :
         server_address = (server_address, DEFAULT_PORT)
@@ -123,12 +208,7 @@ def exchange_messages(server_address, message, progress_listener) :
         raise ChaskiError('Error while waiting for server response: %s' \
                           % (errortext))
     progress_listener.on_progress(7)
-    # TODO: must be changed to something capable to handle huge data with progress
-    #       notification.
-    response = s.recv(RECEIVE_BUFLEN)
-    s.close()
-    print response
-    return xml_fromstr(response)
+    return s
 
 def create_elem(tag, text, attribs={}) :
     elem = Element(tag, attribs)
@@ -177,12 +257,31 @@ def create_mail(credentials, messages) :
 
     return root
 
+def create_fetch_mail(credentials, rcpnts, filters) :
+    root = Element(NAMESPACE + 'Fetch')
+    creds = Element(NAMESPACE + 'Credentials')
+    creds.append(create_elem(NAMESPACE + 'Username', credentials[0]))
+    creds.append(create_elem(NAMESPACE + 'Password', credentials[1]))
+    root.append(creds)
+    if isinstance(rcpnts, basestring) :
+        rcpnts = [rcpnts]
+    map(lambda rcpnt: root.append(create_elem(NAMESPACE + 'To', rcpnt))\
+        , rcpnts)
+    conds = SubElement(root, NAMESPACE + 'Conditions')
+    for name in FETCH_CONDITIONS :
+        value = filters.get(name, FETCH_DEFAULTS.get(name))
+        if value is not None :
+            conds.append(create_elem(NAMESPACE + name, value))
+    return root
+
 def tupelize_chapter(chapter) :
     name = chapter.findtext(NAMESPACE + 'ChapterName')
     mime = chapter.findtext(NAMESPACE + 'MIMEType')
     cont = chapter.find(NAMESPACE + 'ChapterContent')
-    enc = cont.get('encoding')
-    return (name, mime, cont.text, enc)
+    if cont is None :
+        # header-only fetch
+        return (name, mime, None, None)
+    return (name, mime, cont.text, cont.get('encoding'))
     
 def tupelize_message(message) :
     sender = message.findtext(NAMESPACE + 'From')
@@ -194,4 +293,4 @@ def tupelize_message(message) :
     
 
 def tupelize_mail(mail) :
-    return map(tupelize_message, mail)
+    return map(tupelize_message, mail.findall(NAMESPACE + 'Message'))
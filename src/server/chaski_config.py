@@ -1,14 +1,24 @@
 
+import os
+import md5
 import urllib
+import urlparse
 import socket
+import copy
+import threading
 import logging
 import logging.config
 
 from lxml import etree
 
-from chaski_const import NAMESPACE, CHASKI_PORT, DEFAULT_LOG_LEVEL
+from chaski_reader import MessageReader, DEFAULT_READ_SIZE, make_validator
+from chaski_spill import make_spiller
+from chaski_pool import WorkerPool
+from chaski_const import NAMESPACE, CHASKI_PORT, DEFAULT_LOG_LEVEL\
+     , SERVE_MODES, SERVE_THREAD, XSD_BOOL_TRUE, MATCH_ALWAYS\
+     , VALIDATION_MODES, VALIDATE_FULL
 
-__all__ = ['ChaskiConfig']
+__all__ = ['ChaskiConfig', 'DispatchTable', 'Listener', 'MessageSizeLimits']
 
 SIZE_TO_SUFFIX = {'b': 1, 'k': 2**10, 'm': 2**20, \
                   'g': 2**30, 't': 2**40} #should be sufficient :)
@@ -63,11 +73,207 @@ def parse_size(size) :
     else :
         factor = 1
     return int(size) * factor
+
+def parse_sizes(data) :
+    """'name = size, ...' to dictionary of sizes"""
+    sizes = str_to_map(data, ',', '=')
+    for key, size in sizes.items() :
+        sizes[key] = parse_size(size)
+    return sizes
     
 
+def load_schema(uri, cache_dir=None) :
+    """Load etree.XMLSchema from uri.
+    Non-local schemas are fetched once and then read from a copy
+    in cache_dir (if given) named by uri digest.
+
+    """
+    uri = uri.strip()
+    if cache_dir is None or urlparse.urlparse(uri)[0] in ('', 'file') :
+        return etree.XMLSchema(etree.parse(urllib.urlopen(uri)))
+
+    cached = os.path.join(cache_dir.strip()\
+                          , md5.new(uri).hexdigest() + '.xsd')
+    if not os.access(cached, os.F_OK) :
+        data = urllib.urlopen(uri).read()
+        tmpname = '%s.%d.tmp' % (cached, os.getpid())
+        out = file(tmpname, 'wb')
+        out.write(data)
+        out.close()
+        os.rename(tmpname, cached)
+    return etree.XMLSchema(etree.parse(cached))
+
+def check_validation(validation) :
+    if validation not in VALIDATION_MODES :
+        raise ValueError('Unknown validation "%s", expected one of %s'\
+                         % (validation, VALIDATION_MODES))
+    return validation
+
+def parse_listener(listener) :
+    port = int(listener.findtext(NAMESPACE + 'port'))
+    validation = listener.findtext(NAMESPACE + 'validation')
+    if validation is not None :
+        validation = validation.strip()
+    message_size = listener.findtext(NAMESPACE + 'message_size')
+    if message_size is not None :
+        message_size = parse_size(message_size)
+    return Listener(port, validation, message_size)
+
+
+class Listener(object) :
+    """One listening port of the server.
+
+    validation -- one of VALIDATION_MODES or None for configuration default
+    max_message_size -- size limit of messages or None for
+                        configuration default
+    validator -- validator for MessageReader, set by ChaskiConfig
+
+    """
+    __slots__ = ['port', 'validation', 'max_message_size', 'validator']
+
+    def __init__(self, port, validation=None, max_message_size=None) :
+        if validation is not None :
+            check_validation(validation)
+        self.port = port
+        self.validation = validation
+        self.max_message_size = max_message_size
+        self.validator = None
+
+    def __str__(self) :
+        return '%d(%s)' % (self.port, self.validation)
+
+
+class MessageSizeLimits(object) :
+    """Size limits of received messages by sender class.
+
+    A user (by chaski:Credentials of the message) with a limit
+    in users gets it, otherwise the peer (by address) with a limit
+    in peers, otherwise limit of the listener or default. A user limit
+    above the others applies only if verify(username, password)
+    accepts the credentials, checked by the worker once the message
+    is received (see MessageReader.verify_user).
+
+    """
+    __slots__ = ['default', 'peers', 'users', 'verify']
+
+    def __init__(self, default, peers=None, users=None, verify=None) :
+        self.default = default
+        self.peers = peers or {}
+        self.users = users or {}
+        self.verify = verify
+
+    def connection_limit(self, listener, address) :
+        """Limit of messages received from address on listener"""
+        limit = self.peers.get(address)
+        if limit is None :
+            limit = listener.max_message_size
+        if limit is None :
+            limit = self.default
+        return limit
+
+    def user_limit(self, username) :
+        """Limit of the user or None"""
+        if username is None :
+            return None
+        return self.users.get(username.strip())
+
+    def reader(self, listener, address, spiller=None) :
+        """MessageReader for a connection from address on listener"""
+        user_limit = None
+        if self.users :
+            user_limit = self.user_limit
+        return MessageReader(self.connection_limit(listener, address)\
+            , listener.validator, spiller, user_limit, self.verify)
+
+
+MATCH_QUEUE_SIZE = 256
+
+class DispatchTable(object) :
+    """Plugin chains precomputed for every root element tag
+    plugins could match on.
+
+    Every chain keeps configuration order and consists of
+    (plugin, needs_match) pairs. needs_match is False for plugins
+    selected by their dispatch_key() alone.
+
+    If match_workers is positive pipeline() evaluates match()es
+    in a pool of that many threads.
+
+    """
+    __slots__ = ['chains', 'default', 'match_workers', 'pool', 'pool_lock']
+
+    def __init__(self, plugins, match_workers=0) :
+        keyed = [(plugin, plugin.dispatch_key()) for plugin in plugins]
+        tags = set([key for plugin, key in keyed \
+                    if key not in (MATCH_ALWAYS, None)])
+
+        def make_chain(tag) :
+            return [(plugin, key is None) for plugin, key in keyed \
+                    if key in (MATCH_ALWAYS, None, tag)]
+
+        self.chains = dict([(tag, make_chain(tag)) for tag in tags])
+        self.default = make_chain(None)
+        self.match_workers = match_workers
+        self.pool = None
+        self.pool_lock = threading.Lock()
+
+    def resolve(self, message) :
+        """Returns list of plugins to process the message with"""
+        chain = self.chains.get(message.tag, self.default)
+        return [plugin for plugin, needs_match in chain \
+                if not needs_match or plugin.match(message)]
+
+    def get_pool(self) :
+        """Match pool is started on first use so that no threads
+        are created before prefork"""
+        self.pool_lock.acquire()
+        try:
+            if self.pool is None :
+                self.pool = WorkerPool(self.match_workers, MATCH_QUEUE_SIZE\
+                    , MATCH_QUEUE_SIZE, logging.getLogger('DispatchTable'))
+            return self.pool
+        finally:
+            self.pool_lock.release()
+
+    def pipeline(self, message) :
+        """Generator yielding the same plugins as resolve() does.
+        All the match()es are started concurrently and every plugin
+        is yielded as soon as its own match() result is known,
+        so its process() may run while later match()es are evaluated.
+        match()es see a copy of the message as it was received.
+        Closing the generator cancels match()es not started yet.
+
+        """
+        chain = self.chains.get(message.tag, self.default)
+        snapshot = None
+        pending = []
+        for plugin, needs_match in chain :
+            if needs_match :
+                if snapshot is None :
+                    snapshot = copy.deepcopy(message)
+                result = self.get_pool().call(plugin.match, snapshot)
+            else :
+                result = None
+            pending.append((plugin, result))
+        try:
+            for plugin, result in pending :
+                if result is None or result.get() :
+                    yield plugin
+        finally:
+            for plugin, result in pending :
+                if result is not None :
+                    result.cancel()
+
+
 class ChaskiConfig (object):
     __slots__ = ['port', 'maildir', 'max_message_size'\
-                 , 'log_conf', 'plugins', 'schema', 'my_name']
+                 , 'log_conf', 'plugins', 'schema', 'my_name'\
+                 , 'serve_mode', 'workers', 'queue_size', 'max_in_flight'\
+                 , 'processes', 'reuse_port', 'read_size', 'dispatch'\
+                 , 'match_workers', 'listeners', 'validation'\
+                 , 'keep_alive', 'keep_alive_timeout', 'spill_threshold'\
+                 , 'spill_dir', 'spill_decode', 'spiller'\
+                 , 'peer_message_sizes', 'user_message_sizes', 'size_limits']
 
     def __init__(self, raw_config) :
 
@@ -82,6 +288,20 @@ class ChaskiConfig (object):
         if message_size is not None :
             params['max_message_size'] = parse_size(message_size)
 
+        peer_message_sizes = xml_config.findtext(\
+            NAMESPACE + 'peer_message_sizes')
+        if peer_message_sizes is not None :
+            params['peer_message_sizes'] = parse_sizes(peer_message_sizes)
+
+        user_message_sizes = xml_config.findtext(\
+            NAMESPACE + 'user_message_sizes')
+        if user_message_sizes is not None :
+            params['user_message_sizes'] = parse_sizes(user_message_sizes)
+
+        read_size = xml_config.findtext(NAMESPACE + 'read_size')
+        if read_size is not None :
+            params['read_size'] = parse_size(read_size)
+
         log_conf = xml_config.findtext(NAMESPACE + 'log_conf')
         if log_conf is not None :
             logging.config.fileConfig(log_conf)
@@ -94,8 +314,66 @@ class ChaskiConfig (object):
 
         schema_uri = xml_config.findtext(NAMESPACE + 'schema_uri')
         if schema_uri is not None :
-            params['schema'] = etree.XMLSchema(\
-                etree.parse(urllib.urlopen(schema_uri)))
+            params['schema'] = load_schema(schema_uri\
+                , xml_config.findtext(NAMESPACE + 'schema_cache'))
+
+        validation = xml_config.findtext(NAMESPACE + 'validation')
+        if validation is not None :
+            params['validation'] = validation.strip()
+
+        listener_xml_conf = xml_config.findall(\
+            NAMESPACE + 'listeners/' + NAMESPACE + 'listener')
+        if listener_xml_conf :
+            params['listeners'] = map(parse_listener, listener_xml_conf)
+
+        match_workers = xml_config.findtext(NAMESPACE + 'match_workers')
+        if match_workers is not None :
+            params['match_workers'] = int(match_workers)
+
+        serve_mode = xml_config.findtext(NAMESPACE + 'serve_mode')
+        if serve_mode is not None :
+            params['serve_mode'] = serve_mode.strip()
+
+        workers = xml_config.findtext(NAMESPACE + 'workers')
+        if workers is not None :
+            params['workers'] = int(workers)
+
+        queue_size = xml_config.findtext(NAMESPACE + 'queue_size')
+        if queue_size is not None :
+            params['queue_size'] = int(queue_size)
+
+        max_in_flight = xml_config.findtext(NAMESPACE + 'max_in_flight')
+        if max_in_flight is not None :
+            params['max_in_flight'] = int(max_in_flight)
+
+        processes = xml_config.findtext(NAMESPACE + 'processes')
+        if processes is not None :
+            params['processes'] = int(processes)
+
+        reuse_port = xml_config.findtext(NAMESPACE + 'reuse_port')
+        if reuse_port is not None :
+            params['reuse_port'] = reuse_port.strip() in XSD_BOOL_TRUE
+
+        keep_alive = xml_config.findtext(NAMESPACE + 'keep_alive')
+        if keep_alive is not None :
+            params['keep_alive'] = keep_alive.strip() in XSD_BOOL_TRUE
+
+        keep_alive_timeout = xml_config.findtext(\
+            NAMESPACE + 'keep_alive_timeout')
+        if keep_alive_timeout is not None :
+            params['keep_alive_timeout'] = float(keep_alive_timeout)
+
+        spill_threshold = xml_config.findtext(NAMESPACE + 'spill_threshold')
+        if spill_threshold is not None :
+            params['spill_threshold'] = parse_size(spill_threshold)
+
+        spill_dir = xml_config.findtext(NAMESPACE + 'spill_dir')
+        if spill_dir is not None :
+            params['spill_dir'] = spill_dir.strip()
+
+        spill_decode = xml_config.findtext(NAMESPACE + 'spill_decode')
+        if spill_decode is not None :
+            params['spill_decode'] = spill_decode.strip() in XSD_BOOL_TRUE
 
         plugin_xml_conf = xml_config.findall(\
             NAMESPACE + 'plugin_modules/' + NAMESPACE + 'plugin') 
@@ -104,19 +382,71 @@ class ChaskiConfig (object):
 
     def from_params(self, port = CHASKI_PORT
                     , max_message_size = 10*1024*1024 # 10Mb
+                    , peer_message_sizes = None
+                    , user_message_sizes = None
+                    , read_size = DEFAULT_READ_SIZE
                     , my_name = socket.gethostname()
                     , schema = None
-                    , plugins = []) :
+                    , plugins = []
+                    , serve_mode = SERVE_THREAD
+                    , workers = 4
+                    , queue_size = 64
+                    , max_in_flight = 128
+                    , processes = 1
+                    , reuse_port = False
+                    , match_workers = 0
+                    , listeners = None
+                    , validation = VALIDATE_FULL
+                    , keep_alive = False
+                    , keep_alive_timeout = 60
+                    , spill_threshold = 0
+                    , spill_dir = None
+                    , spill_decode = False) :
+        if serve_mode not in SERVE_MODES :
+            raise ValueError('Unknown serve mode "%s", expected one of %s'\
+                             % (serve_mode, SERVE_MODES))
         self.port = port
         self.max_message_size = max_message_size
+        self.peer_message_sizes = peer_message_sizes or {}
+        self.user_message_sizes = user_message_sizes or {}
+        self.size_limits = MessageSizeLimits(max_message_size\
+            , self.peer_message_sizes, self.user_message_sizes)
+        self.read_size = read_size
         self.schema = schema
         self.my_name = my_name
         self.plugins = plugins
+        self.serve_mode = serve_mode
+        self.workers = workers
+        self.queue_size = queue_size
+        self.max_in_flight = max_in_flight
+        self.processes = processes
+        self.reuse_port = reuse_port
+        self.match_workers = match_workers
+        self.validation = check_validation(validation)
+        self.keep_alive = keep_alive
+        self.keep_alive_timeout = keep_alive_timeout
+        self.spill_threshold = spill_threshold
+        self.spill_dir = spill_dir
+        self.spill_decode = spill_decode
+        self.spiller = make_spiller(spill_threshold, spill_dir, spill_decode)
+        if listeners is None :
+            listeners = [Listener(port)]
+        self.listeners = listeners
+
+        for listener in listeners :
+            listener.validator = make_validator(\
+                listener.validation or validation, schema)
 
         for plugin in plugins :
             plugin.conf = self
+            plugin.compile_matchers()
+            # the authentication plugin verifies credentials for
+            # user size limits too (its cache is shared)
+            if self.size_limits.verify is None :
+                self.size_limits.verify = getattr(plugin, 'credsok', None)
+        self.dispatch = DispatchTable(plugins, match_workers)
     
     def __str__(self) :
-        return 'ChaskiConfig:\nport:%d\nsize:%d\nplugins:%s' \
-               % (self.port, self.max_message_size\
-                  , [x.__class__ for x in self.plugins])
+        return 'ChaskiConfig:\nlisteners:%s\nsize:%d\nmode:%s\nplugins:%s' \
+               % (map(str, self.listeners), self.max_message_size\
+                  , self.serve_mode, [x.__class__ for x in self.plugins])
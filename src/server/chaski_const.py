@@ -11,6 +11,7 @@ class ProcessResult (object):
         return self.name
 PROCESS_OK = ProcessResult('PROCESS_OK')
 PROCESS_FAIL = ProcessResult('PROCESS_FAIL')
+MATCH_ALWAYS = 'MATCH_ALWAYS' # dispatch key of plugins matching any message
 DEFAULT_CFG = '/etc/chaski.conf'
 RESULT_MESSAGE = '''
 <chaski:Result xmlns:chaski="http://www.some.com/chaski"
@@ -19,9 +20,22 @@ RESULT_MESSAGE = '''
 <chaski:Description>%s</chaski:Description>
 </chaski:Result>
 '''
+# Status of Result for mails refused before any plugin storing or
+# relaying them ran, nothing of such a mail has been kept
+STATUS_REJECTED = 'Rejected'
+EMPTY_MAIL_PATTERN = '''<chaski:Mail xmlns:chaski="urn:chaski:org">
+%s</chaski:Mail>'''
+MAIL_HEAD, MAIL_TAIL = EMPTY_MAIL_PATTERN.split('%s')
 NAMESPACE='{urn:chaski:org}'
 XPATH_NAMESPACES = {'chaski': 'urn:chaski:org'}
 ADDRESS_DELIM = '@'
 CHASKI_PORT=25
 XSD_BOOL_TRUE = ['true', '1']
 XSD_DATE_FORMAT = '%Y-%m-%d'
+SERVE_THREAD = 'thread' # worker pool thread per connection
+SERVE_POLL = 'poll' # all connections in one poll() loop
+SERVE_MODES = [SERVE_THREAD, SERVE_POLL]
+VALIDATE_FULL = 'full' # XML Schema validation
+VALIDATE_STRUCTURAL = 'structural' # root and required children only
+VALIDATE_NONE = 'none'
+VALIDATION_MODES = [VALIDATE_FULL, VALIDATE_STRUCTURAL, VALIDATE_NONE]
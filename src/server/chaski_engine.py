@@ -0,0 +1,210 @@
+"""poll()-based serving engine for chaski server
+
+EventLoopServer multiplexes all client connections in one thread,
+feeds received data into a MessageReader and hands
+fully received messages to a WorkerPool which validates them
+and runs the (possibly CPU-heavy) plugin chain. Connections kept
+alive after the chain come back to the loop to wait for the next
+message.
+
+"""
+
+import os
+import time
+import select
+import socket
+import errno
+import Queue
+
+from chaski_reader import ConnectionClosed
+from chaski_raw import register as register_raw, release as release_raw
+
+POLL_ERROR_MASK = select.POLLHUP | select.POLLNVAL | select.POLLERR
+
+__all__ = ['EventLoopServer']
+
+
+class _Connection(object) :
+    """State of one client connection served by EventLoopServer.
+    deadline is the time an idle kept alive connection is closed at."""
+    __slots__ = ['sock', 'address_info', 'listener', 'reader', 'deadline']
+
+    def __init__(self, sock, address_info, listener, reader) :
+        self.sock = sock
+        self.address_info = address_info
+        self.listener = listener
+        self.reader = reader
+        self.deadline = None
+
+
+class EventLoopServer(object) :
+    """Serves all connections from one poll() loop.
+
+    on_message(message, sock, address_info) -- called in a worker thread
+                  for every fully received valid message. Socket is switched
+                  back to blocking mode and owned by the callback
+                  unless it returns True to keep the connection:
+                  the loop then waits for the next message
+                  for conf.keep_alive_timeout seconds. The client
+                  sends it after the Result, data following
+                  a message makes it fail to parse.
+    on_error(sock, address_info, exception) -- called in a worker thread
+                  if message could not be received, parsed
+                  or validated.
+    on_overload(sock, address_info) -- called from the loop itself
+                  if the pool refused to take the job.
+
+    """
+
+    def __init__(self, servers, conf, logger, pool\
+                 , on_message, on_error, on_overload) :
+        self.servers = dict([(sock.fileno(), (sock, listener)) \
+                             for sock, listener in servers])
+        self.conf = conf
+        self.logger = logger
+        self.pool = pool
+        self.on_message = on_message
+        self.on_error = on_error
+        self.on_overload = on_overload
+        self.poller = select.poll()
+        self.connections = {}
+        # kept alive connections handed back by workers
+        self.resumed = Queue.Queue()
+        self.wakeup_fd, self.wakeup_write_fd = os.pipe()
+
+    def submit(self, func, conn, *args) :
+        """Hand the job over to the pool or refuse the connection.
+        Returns False if refused."""
+        if not self.pool.submit(func, *args) :
+            self.on_overload(conn.sock, conn.address_info)
+            return False
+        return True
+
+    def finish(self, conn, message) :
+        """Worker part: validate the message, verify credentials
+        of a raised size limit, run on_message and resume kept
+        connection"""
+        try:
+            conn.reader.check(message)
+        except Exception, ex :
+            release_raw(message)
+            self.on_error(conn.sock, conn.address_info, ex)
+            return
+        self.logger.debug('Message of %d bytes validated in %.3f ms'\
+            , conn.reader.received, conn.reader.validation_time * 1000)
+        if self.on_message(message, conn.sock, conn.address_info) :
+            self.resumed.put(conn)
+            os.write(self.wakeup_write_fd, 'x')
+
+    def resume(self) :
+        """Serve connections kept alive by the workers again"""
+        os.read(self.wakeup_fd, 4096)
+        try:
+            while True :
+                conn = self.resumed.get_nowait()
+                conn.sock.setblocking(False)
+                conn.reader = self.reader(conn.listener, conn.address_info)
+                conn.deadline = time.time() + self.conf.keep_alive_timeout
+                self.connections[conn.sock.fileno()] = conn
+                self.poller.register(conn.sock, select.POLLIN)
+        except Queue.Empty :
+            pass
+
+    def close_idle(self) :
+        """Close kept alive connections idle for too long.
+        Returns milliseconds till the next deadline or None."""
+        now = time.time()
+        deadlines = []
+        for fd, conn in self.connections.items() :
+            if conn.deadline is None :
+                continue
+            if conn.deadline <= now :
+                self.logger.debug('Closing idle connection from %s:%d'\
+                                  , *conn.address_info)
+                self.release(fd).sock.close()
+            else :
+                deadlines.append(conn.deadline)
+        if not deadlines :
+            return None
+        return (min(deadlines) - now) * 1000
+
+    def accept(self, serv_sock, listener) :
+        try:
+            sock, address_info = serv_sock.accept()
+        except socket.error, (err, errtext) :
+            if err not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR) :
+                self.logger.error('Failed to accept connection: %s', errtext)
+            return
+        self.logger.debug('Accepted connection from %s:%d', *address_info)
+        sock.setblocking(False)
+        self.connections[sock.fileno()] = _Connection(sock, address_info\
+            , listener, self.reader(listener, address_info))
+        self.poller.register(sock, select.POLLIN)
+
+    def reader(self, listener, address_info) :
+        """MessageReader leaving validation to the worker"""
+        reader = self.conf.size_limits.reader(listener, address_info[0]\
+                                              , self.conf.spiller)
+        reader.defer_validation()
+        return reader
+
+    def release(self, fd) :
+        """Stop serving connection in the loop and return it"""
+        conn = self.connections.pop(fd)
+        self.poller.unregister(fd)
+        conn.sock.setblocking(True)
+        return conn
+
+    def readable(self, fd, mask) :
+        conn = self.connections[fd]
+        try:
+            if mask & POLL_ERROR_MASK and not mask & select.POLLIN :
+                raise ConnectionClosed('Connection error, mask: %x' % mask)
+            try:
+                data = conn.sock.recv(\
+                    conn.reader.recv_size(self.conf.read_size))
+            except socket.error, (err, errtext) :
+                if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR) :
+                    return
+                raise
+            if not data and conn.deadline is not None :
+                # client closed kept alive connection
+                self.release(fd).sock.close()
+                return
+            conn.deadline = None
+            message = conn.reader.feed(data)
+        except Exception, ex :
+            conn = self.release(fd)
+            conn.reader.discard()
+            self.submit(self.on_error, conn, conn.sock, conn.address_info, ex)
+        else :
+            if message is not None :
+                conn = self.release(fd)
+                register_raw(message, conn.reader.raw, conn.reader.spills)
+                if not self.submit(self.finish, conn, conn, message) :
+                    release_raw(message)
+
+    def serve_forever(self) :
+        """Run the loop until a listening socket fails"""
+        for serv_sock, listener in self.servers.values() :
+            serv_sock.setblocking(False)
+            self.poller.register(serv_sock, select.POLLIN)
+        self.poller.register(self.wakeup_fd, select.POLLIN)
+        while True :
+            try:
+                events = self.poller.poll(self.close_idle())
+            except select.error, (err, errtext) :
+                if err == errno.EINTR :
+                    continue
+                raise
+            for fd, mask in events :
+                if fd == self.wakeup_fd :
+                    self.resume()
+                elif self.servers.has_key(fd) :
+                    if mask & POLL_ERROR_MASK :
+                        self.logger.error('An error occured while waiting'\
+                            + ' for connection. Error mask: %x', mask)
+                        return
+                    self.accept(*self.servers[fd])
+                else :
+                    self.readable(fd, mask)
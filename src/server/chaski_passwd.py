@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+"""Password hashing for chaski userconf files
+
+Hashes are stored as
+  pbkdf2_sha256$<iterations>$<salt>$<hash>
+with base64 salt and hash. Plain md5 hex digests of old userconf
+files are still accepted.
+
+Usage: chaski_passwd.py <password>  -- prints hash for userconf
+"""
+
+import os
+import sys
+import md5
+import hmac
+import time
+import base64
+import hashlib
+import threading
+from collections import OrderedDict
+
+__all__ = ['make_hash', 'verify_password', 'CredentialCache']
+
+PBKDF2_PREFIX = 'pbkdf2_sha256'
+DEFAULT_ITERATIONS = 100000
+SALT_SIZE = 16
+HASH_SEP = '$'
+
+
+def to_bytes(text) :
+    if isinstance(text, unicode) :
+        return text.encode('utf-8')
+    return text
+
+def make_hash(passwd, iterations=DEFAULT_ITERATIONS, salt=None) :
+    """Returns PBKDF2 hash string of the password for userconf"""
+    if salt is None :
+        salt = os.urandom(SALT_SIZE)
+    digest = hashlib.pbkdf2_hmac('sha256', to_bytes(passwd), salt, iterations)
+    return HASH_SEP.join([PBKDF2_PREFIX, str(iterations)\
+                          , base64.b64encode(salt), base64.b64encode(digest)])
+
+def verify_password(stored, passwd) :
+    """Check password against stored hash of any supported format"""
+    passwd = to_bytes(passwd)
+    if stored.startswith(PBKDF2_PREFIX + HASH_SEP) :
+        try:
+            prefix, iterations, salt, digest = stored.split(HASH_SEP)
+            salt = base64.b64decode(salt)
+            digest = base64.b64decode(digest)
+            iterations = int(iterations)
+        except (ValueError, TypeError) :
+            return False
+        return hmac.compare_digest(digest\
+            , hashlib.pbkdf2_hmac('sha256', passwd, salt, iterations))
+    return hmac.compare_digest(stored, md5.new(passwd).hexdigest())
+
+
+class CredentialCache(object) :
+    """Short-lived cache of successfully verified credentials,
+    so that frequent logins don't pay for the KDF every time.
+
+    Entries are keyed by HMAC of the credentials and the stored hash
+    with a per-process random key, so neither passwords nor hashes
+    are kept and a password change invalidates the entry.
+
+    ttl -- seconds to trust a verification
+    max_entries -- cache size, oldest entries are dropped
+
+    Attributes defined:
+    hits, misses -- lookup counters
+
+    """
+
+    def __init__(self, ttl=60, max_entries=10000) :
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.secret = os.urandom(32)
+        self.lock = threading.Lock()
+        self.entries = OrderedDict() # key -> expiration time
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, username, passwd, stored) :
+        return hmac.new(self.secret, '\0'.join([to_bytes(username)\
+            , to_bytes(passwd), stored]), hashlib.sha256).digest()
+
+    def verified(self, key) :
+        """True if credentials with this key were verified recently"""
+        self.lock.acquire()
+        try:
+            expires = self.entries.get(key)
+            if expires is not None and expires >= time.time() :
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+        finally:
+            self.lock.release()
+
+    def add(self, key) :
+        self.lock.acquire()
+        try:
+            self.entries.pop(key, None)
+            self.entries[key] = time.time() + self.ttl
+            while len(self.entries) > self.max_entries :
+                self.entries.popitem(last=False)
+        finally:
+            self.lock.release()
+
+    def stats(self) :
+        """Returns dict with cache size, counters and hit rate"""
+        self.lock.acquire()
+        try:
+            lookups = self.hits + self.misses
+            return {'entries': len(self.entries)
+                    , 'hits': self.hits
+                    , 'misses': self.misses
+                    , 'hit_rate': lookups and float(self.hits) / lookups}
+        finally:
+            self.lock.release()
+
+    def __str__(self) :
+        return 'CredentialCache: %s' % self.stats()
+
+
+if __name__ == '__main__' :
+    if len(sys.argv) != 2 :
+        print __doc__
+        sys.exit(1)
+    print make_hash(sys.argv[1])
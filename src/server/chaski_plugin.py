@@ -6,35 +6,222 @@ import md5
 import stat
 import socket
 import copy
-import select
+import base64
 from datetime import date
 import time
 import logging
 from lxml import etree
 
+from chaski_resolver import CachingResolver, ResolveError
+from chaski_relay import get_relay_pool, Delivery, MAX_PER_HOST\
+     , IDLE_TIMEOUT, IO_TIMEOUT
+from chaski_spool import get_spool, RETRY_DELAY, MAX_RETRY_DELAY, MAX_AGE\
+     , SCAN_INTERVAL, BATCH_MAILS, BATCH_BYTES, BATCH_AGE
+from chaski_userstore import UserStore
+from chaski_passwd import verify_password, CredentialCache
+from chaski_raw import message_chunks, mail_chunks, mail_size\
+     , mark_mutated, spilled, ChainedChunks
 from chaski_const import PROCESS_OK, PROCESS_FAIL, ADDRESS_DELIM\
      , NAMESPACE, CHASKI_PORT, XSD_BOOL_TRUE, XSD_DATE_FORMAT\
-     , XPATH_NAMESPACES
+     , XPATH_NAMESPACES, MATCH_ALWAYS, EMPTY_MAIL_PATTERN, MAIL_HEAD\
+     , MAIL_TAIL
 
 
-EMPTY_MAIL_PATTERN = '''<chaski:Mail xmlns:chaski="urn:chaski:org">
-%s</chaski:Mail>'''
+# size of reads from message files and of socket writes
+CHUNK_SIZE = 64*1024
+# chunk making send_chunks() send all the data before asking for more
+FLUSH = ''
+
+CHAPTER_TAG = NAMESPACE + 'Chapter'
+CONTENT_TAG = NAMESPACE + 'ChapterContent'
+# directory of header files in mail folders
+HEADERS_DIR = '.headers'
+# continuation of a fetch limited by MaxMessages/MaxBytes
+NEXT_CURSOR_PATTERN = '<chaski:NextCursor>%s</chaski:NextCursor>\n'
+CURSOR_SEP = '\n'
+
+_XPATH_CACHE = {}
+
+def compile_xpath(expr, namespaces=XPATH_NAMESPACES) :
+    """Returns etree.XPath object for expression.
+    Expressions are compiled once and shared by expression
+    and namespace map.
+
+    """
+    key = (expr, tuple(sorted(namespaces.items())))
+    try:
+        return _XPATH_CACHE[key]
+    except KeyError :
+        return _XPATH_CACHE.setdefault(key\
+            , etree.XPath(expr, namespaces=namespaces))
+
+def first_node(path, elem) :
+    """First node selected by compiled path from elem or None
+    (same as elem.find())"""
+    nodes = path(elem)
+    if nodes :
+        return nodes[0]
+    return None
+
+def node_text(path, elem) :
+    """Text of first node selected by compiled path from elem
+    or None (same as elem.findtext())"""
+    node = first_node(path, elem)
+    if node is None :
+        return None
+    return node.text or ''
+
+ROOT_XPATH_RE = re.compile(r'^/(\w+):(\w+)$')
+
+# paths used by plugins on every message
+TO_PATH = compile_xpath('chaski:To')
+SECRET_TO_PATH = compile_xpath('chaski:SecretTo')
+SUBJECT_PATH = compile_xpath('chaski:Subject')
+CHAPTER_PATH = compile_xpath('chaski:Chapter')
+MESSAGE_TO_PATH = compile_xpath('chaski:Message/chaski:To')
+MESSAGE_FROM_PATH = compile_xpath('chaski:Message/chaski:From')
+USERNAME_PATH = compile_xpath('chaski:Credentials/chaski:Username')
+PASSWORD_PATH = compile_xpath('chaski:Credentials/chaski:Password')
+CONDITIONS_PATH = compile_xpath('chaski:Conditions')
+ONLY_HEADER_PATH = compile_xpath('chaski:OnlyHeader')
+MIN_DATE_PATH = compile_xpath('chaski:MinReceiveDate')
+MAX_DATE_PATH = compile_xpath('chaski:MaxReceiveDate')
+REMOVE_AFTER_PATH = compile_xpath('chaski:RemoveAfterFetch')
+MAX_MESSAGES_PATH = compile_xpath('chaski:MaxMessages')
+MAX_BYTES_PATH = compile_xpath('chaski:MaxBytes')
+CURSOR_PATH = compile_xpath('chaski:Cursor')
+
+
+def content_size(content) :
+    """Size of ChapterContent data after decoding"""
+    spill = spilled(content)
+    if spill is not None :
+        return spill.content_size()
+    text = content.text or ''
+    encoding = content.get('encoding', 'plain')
+    if encoding == 'base64' :
+        text = ''.join(text.split())
+        return len(text) * 3 / 4 - text[-2:].count('=')
+    if encoding == 'hex' :
+        return len(''.join(text.split())) / 2
+    if isinstance(text, unicode) :
+        return len(text.encode('utf-8'))
+    return len(text)
+
+def make_header(message) :
+    """Serialized header of message (chaski:Message): the message
+    with chapters reduced to name, MIME type and 'size' of content.
+    Chapter contents are not copied."""
+    header = etree.Element(message.tag, message.attrib, nsmap=message.nsmap)
+    header.text = message.text
+    for child in message :
+        if child.tag == CHAPTER_TAG :
+            summary = etree.SubElement(header, CHAPTER_TAG, child.attrib)
+            summary.text = child.text
+            for part in child :
+                if part.tag == CONTENT_TAG :
+                    summary.set('size', str(content_size(part)))
+                else :
+                    summary.append(copy.deepcopy(part))
+        else :
+            header.append(copy.deepcopy(child))
+        header[-1].tail = child.tail
+    header.tail = message.tail
+    return etree.tostring(header)
+
+
+def file_chunks(infile, size=None, chunk_size=CHUNK_SIZE) :
+    """Yields data of open file (at most size bytes) in chunks
+    and closes the file. IOError is raised if the file has less
+    than size bytes."""
+    try:
+        while size is None or size > 0 :
+            if size is None :
+                chunk = infile.read(chunk_size)
+            else :
+                chunk = infile.read(min(chunk_size, size))
+                size -= len(chunk)
+            if not chunk :
+                if size is not None :
+                    raise IOError('File %s is truncated' % infile.name)
+                break
+            yield chunk
+    finally:
+        infile.close()
+
+
+class FetchAborted(Exception) :
+    """Raised by fetch() when reading a message failed after a part
+    of it was yielded: the response can't be completed"""
+    pass
+
+
+def guard_message(chunks, errors) :
+    """Yields chunks of one message being fetched. errors raised
+    before the first chunk are passed on (the message may be skipped),
+    later ones are raised as FetchAborted."""
+    started = False
+    try:
+        for chunk in chunks :
+            started = True
+            yield chunk
+    except errors, err :
+        if started :
+            raise FetchAborted('Failed in the middle of a message: %s'\
+                               % err)
+        raise
+
+def send_chunks(sock, chunks, buffer_size=CHUNK_SIZE) :
+    """Send all the chunks with sendall() joining small ones
+    (up to buffer_size or FLUSH chunk). Returns number of bytes sent."""
+    sent = 0
+    pending = []
+    pending_size = 0
+    for chunk in chunks :
+        pending.append(chunk)
+        pending_size += len(chunk)
+        if pending_size >= buffer_size or chunk == FLUSH :
+            sock.sendall(''.join(pending))
+            sent += pending_size
+            pending = []
+            pending_size = 0
+    if pending :
+        sock.sendall(''.join(pending))
+        sent += pending_size
+    return sent
+
+def close_connection(sock) :
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except socket.error :
+        pass
+    sock.close()
 
 
 class ChaskiPlugin(object) :
     """Base class for all plugins.
 
     Methods defined:
-    xpath_exists(message) -- check if child_xpath attribute defines any nodes
+    compile_matchers() -- precompile match_xpath, called by configuration
+    xpath_exists(message) -- check if match_xpath attribute defines any nodes
     xpath_doesnt_exist(message) -- reverses the previous
     match_any(message) -- returns True
     match(message) -- used by server to decide whether to call process()
+    dispatch_key() -- lets server decide without calling match()
     process(mail, src_sock) -- does actual processing
 
     Attributes defined:
     conf -- reference to conf structure
+    mutates -- True for plugins changing the mail without reporting
+               changes with mark_mutated(): bytes of the mail cached
+               for the plugin chain are dropped after process()
+    stores -- True for plugins keeping the mail, passing it on or
+              removing fetched mails: failures after one of them
+              has run are not reported as rejection of the mail
 
     """
+    mutates = False
+    stores = False
 
     def __init__(self, params) :
         """Take params dict and store as attributes"""
@@ -42,10 +229,19 @@ class ChaskiPlugin(object) :
             self.__dict__[k] = v
         self.logger = logging.getLogger(self.__class__.__name__)
 
+    def compile_matchers(self) :
+        """Compile 'match_xpath' (if any) so match() doesn't have to"""
+        if hasattr(self, 'match_xpath') :
+            self.match_path = compile_xpath(self.match_xpath)
+
     def xpath_exists(self, message) :
-        """Checks if at least one child specified by 'child_xpath' exist."""
-        return bool(message.getroottree().xpath(\
-            self.match_xpath, namespaces=XPATH_NAMESPACES))
+        """Checks if at least one child specified by 'match_xpath' exist."""
+        try:
+            match_path = self.match_path
+        except AttributeError :
+            self.compile_matchers()
+            match_path = self.match_path
+        return bool(match_path(message.getroottree()))
 
     def xpath_doesnt_exist(self, message) :
         """Checks if no children specified by 'child_xpath' exist."""
@@ -65,6 +261,27 @@ class ChaskiPlugin(object) :
         """
         return False
 
+    def dispatch_key(self) :
+        """Tells the server how to select the plugin without match():
+        MATCH_ALWAYS -- plugin matches any message
+        '{namespace}tag' -- plugin matches messages with this root tag only
+        None -- match() should be called for every message
+
+        Recognizes match_any and xpath_exists on '/prefix:Root' paths.
+        Plugins with their own match() could override it.
+
+        """
+        match = getattr(self.match, 'im_func', None)
+        if match is ChaskiPlugin.match_any.im_func :
+            return MATCH_ALWAYS
+        if match is ChaskiPlugin.xpath_exists.im_func :
+            root = ROOT_XPATH_RE.match(self.match_xpath.strip())
+            if root is not None \
+                   and XPATH_NAMESPACES.has_key(root.group(1)) :
+                return '{%s}%s' % (XPATH_NAMESPACES[root.group(1)]\
+                                   , root.group(2))
+        return None
+
     def process(self, mail, src_sock) :
         """Interface method containing real processing of message by plugin.
         Should return tuple (status, result) where :
@@ -85,13 +302,15 @@ class _StoreMail(ChaskiPlugin) :
     """Stores mail to file specified by 'fname' parameter.
     Intended primarely for testing."""
     match = ChaskiPlugin.match_any
+    stores = True
 
     def __init__(self, params) :
         ChaskiPlugin.__init__(self, params)
         self.out_file = file(self.fname, 'wb+')
 
     def process(self, mail, src_sock) :
-        self.out_file.write(etree.tostring(mail))
+        for chunk in mail_chunks(mail) :
+            self.out_file.write(chunk)
         self.out_file.flush()
         return PROCESS_OK, mail
 
@@ -100,66 +319,91 @@ class SimpleUserAuth(ChaskiPlugin) :
     """Simple file based authentifiaction plugin
 
     Check chaski:Credentials (if available) and all recepients
+
+    Plugin parameters:
+      userconf -- file with lines "username, password hash, accounts..."
+                  reloaded when changed. Hash is made by chaski_passwd.py
+                  (md5 hex digests are accepted too)
+      user_snapshot -- SQLite file to compile userconf into (optional)
+      userconf_check -- seconds between userconf change checks (1)
+      dns_ttl -- seconds to cache peer host names (300)
+      dns_negative_ttl -- seconds to cache failed lookups (60)
+      dns_cache_size -- number of cached peers (10000)
+      dns_timeout -- seconds to wait for DNS answer (5)
+      cred_cache_ttl -- seconds to trust verified credentials (60)
+      cred_cache_size -- number of cached credentials (10000)
+
+    Attributes defined:
+    resolver -- CachingResolver used for peers, could be replaced
+                (e.g. by one with a HostTable lookup in tests)
+    credentials -- CredentialCache of verified logins
+
+    credsok(username, password) also lets user_message_sizes raise
+    the size limit of a mail being received (see MessageSizeLimits).
     
     """
     match = ChaskiPlugin.match_any
 
     def __init__(self, params) :
-        def parseusers(data):
-            userlines = data.split('\n')
-            result = {}
-            for line in userlines :
-                tokens = [x.strip() for x in line.split(',')]
-                if len(tokens) >= 2:
-                    result[tokens[0]] = (tokens[1], tokens[2:])
-            return result
-        def getaccountset(users) :
-            result = []
-            for v in users.values() :
-                result.extend(v[1])
-            return set(result)
-
         ChaskiPlugin.__init__(self, params)
-        self.users = parseusers(open(self.userconf).read())
-        self.accountset = getaccountset(self.users)
-        
+        self.users = UserStore(self.userconf, params.get('user_snapshot')\
+            , float(params.get('userconf_check', 1)))
+        self.credentials = CredentialCache(\
+            ttl=int(params.get('cred_cache_ttl', 60))\
+            , max_entries=int(params.get('cred_cache_size', 10000)))
+        self.resolver = CachingResolver(\
+            ttl=int(params.get('dns_ttl', 300))\
+            , negative_ttl=int(params.get('dns_negative_ttl', 60))\
+            , max_entries=int(params.get('dns_cache_size', 10000))\
+            , timeout=float(params.get('dns_timeout', 5)))
 
     def recepientsok(self, mail) :
         mail_host = ADDRESS_DELIM + self.conf.my_name
-        recepients = mail.findall(NAMESPACE + 'Message/' + NAMESPACE + 'To')
+        recepients = MESSAGE_TO_PATH(mail)
         recepient_names = [node.text for node in recepients]
         self.logger.debug('here are recepients: %s', recepient_names)
         local = filter(lambda x: x.endswith(mail_host), recepient_names)
         self.logger.debug('here are local recepients: %s', local)
         local_names = [name[:name.rfind(ADDRESS_DELIM)] for name in local]
-        names_set = set(local_names)
-        return self.accountset.issuperset(names_set)
+        users = self.users.table()
+        for name in set(local_names) :
+            if users.owner(name) is None :
+                return False
+        return True
 
     def credsok(self, uname, passwd) :
         self.logger.debug('User %s tries to login', uname)
-        if self.users.has_key(uname) : 
-            pwd_hash = md5.new(passwd).hexdigest()
-            self.logger.debug('providing hash %s', pwd_hash)
-            return self.users[uname][0] == pwd_hash
-        else :
+        user_hash = self.users.table().password_hash(uname)
+        if user_hash is None :
             return False
+        key = self.credentials.key(uname, passwd, user_hash)
+        if self.credentials.verified(key) :
+            return True
+        if verify_password(user_hash, passwd) :
+            self.credentials.add(key)
+            self.logger.debug('%s', self.credentials)
+            return True
+        return False
 
     def accountsok(self, mail) :
-        accnames = [node.text for node in mail.findall(NAMESPACE + 'To')]
-        registred_accnames = set(self.users[mail.findtext(\
-                NAMESPACE + 'Credentials/' + NAMESPACE + 'Username')][1])
-        self.logger.debug('registred accounts: %s', registred_accnames)
-        return set(accnames).issubset(registred_accnames)
+        accnames = [node.text for node in TO_PATH(mail)]
+        uname = node_text(USERNAME_PATH, mail)
+        users = self.users.table()
+        for accname in accnames :
+            if not users.owns(uname, accname) :
+                self.logger.debug('%s is not an account of %s'\
+                                  , accname, uname)
+                return False
+        return True
         
         
     def usermail_auth(self, mail, uname) :
-        passwd = mail.findtext(NAMESPACE + 'Credentials/' \
-                                   + NAMESPACE + 'Password')
+        passwd = node_text(PASSWORD_PATH, mail)
         if passwd is None :
             passwd = ''
         if not self.credsok(uname, passwd) :
-            return PROCESS_FAIL, 'No such user "%s" or wrong password "%s"'\
-                   % (uname, password)
+            return PROCESS_FAIL, 'No such user "%s" or wrong password'\
+                   % uname
         if mail.tag == NAMESPACE + 'Fetch' :
             if not self.accountsok(mail) :
                 return PROCESS_FAIL, '''Some requested accounts
@@ -168,27 +412,24 @@ class SimpleUserAuth(ChaskiPlugin) :
             if not self.recepientsok(mail) :
                 return PROCESS_FAIL, 'Some recepients do not exist'
 
-            senders = mail.findall(NAMESPACE + 'Message/' + NAMESPACE + 'From')
+            senders = MESSAGE_FROM_PATH(mail)
             mail_host = ADDRESS_DELIM + self.conf.my_name
             for sender in senders :
                 sender.text = sender.text + mail_host
+                mark_mutated(sender)
         return PROCESS_OK, mail
 
 
     def external_auth(self, mail, ip) :
-        def getdnsinfo(ip) :
-            hosts = socket.gethostbyaddr(ip)
-            result = hosts[1]
-            result.append(hosts[0])
-            return result
-
-        senders = [node.text for node \
-                   in mail.findall(NAMESPACE + 'Message/' \
-                                   + NAMESPACE + 'From')]
+        senders = [node.text for node in MESSAGE_FROM_PATH(mail)]
         sender_domains = [name[name.rfind(ADDRESS_DELIM)+1:] \
                           for name in senders]
         
-        peer_domains = getdnsinfo(ip)
+        try:
+            peer_domains = self.resolver.names(ip)
+        except ResolveError, err :
+            return PROCESS_FAIL, 'Failed to check peer: %s' % err
+        self.logger.debug('%s is %s. %s', ip, peer_domains, self.resolver)
         
         excessive = set(sender_domains).difference(set(peer_domains)) 
         if excessive :
@@ -207,7 +448,7 @@ class SimpleUserAuth(ChaskiPlugin) :
         In both cases all the local To's are checked for existense.
         
         """
-        username = mail.find(NAMESPACE + 'Credentials/' + NAMESPACE + 'Username')
+        username = first_node(USERNAME_PATH, mail)
         if username is not None :
             self.logger.debug('Mail from user')
             return self.usermail_auth(mail, username.text)
@@ -223,6 +464,8 @@ class ReceiveMessage(ChaskiPlugin) :
     store(usernames, message)->None -- store one message for all users
     
     """
+    stores = True
+
     def __init__(self, params) :
         ChaskiPlugin.__init__(self, params)
         self.match_xpath = '/chaski:Mail'
@@ -254,8 +497,8 @@ class ReceiveMessage(ChaskiPlugin) :
                     unames.append(user[:user.find(ADDRESS_DELIM)])
             return unames
             
-        receivers = message.findall(NAMESPACE + 'To')
-        secret = message.findall(NAMESPACE + 'SecretTo')
+        receivers = TO_PATH(message)
+        secret = SECRET_TO_PATH(message)
         map(lambda node: message.remove(node), secret)
         myusernames = getmyusernames(receivers, self.conf.my_name)
         mysecrets = getmyusernames(secret, self.conf.my_name)
@@ -263,7 +506,7 @@ class ReceiveMessage(ChaskiPlugin) :
         status, out_message = self.store(myusernames, message)
         if status != PROCESS_OK :
             return status, out_message
-        subjectnode = message.find(NAMESPACE + 'Subject')
+        subjectnode = first_node(SUBJECT_PATH, message)
         for node in secret :
             subjectnode.addprevious(node)
         return PROCESS_OK, message
@@ -290,6 +533,8 @@ class ReceiveMessageToPlainFile(ReceiveMessage) :
     If there are more than one recepient than hard link (os.link())
     to original message is created in all other folders
     (so it doesn't metter if the message would be deleted in other folder). 
+    Header of the message is saved to the same name in '.headers'
+    subdirectory for header-only fetches.
     
     Plugin parameters:
       base_dir -- root directory for user directories
@@ -298,34 +543,92 @@ class ReceiveMessageToPlainFile(ReceiveMessage) :
     """
     def store(self, usernames, message) :
         folders = [self.basedir + os.sep + uname for uname in usernames]
-        not_exist = filter(lambda dir: not os.access(dir, os.F_OK), folders)
+        not_exist = filter(lambda dir: not os.access(dir + os.sep\
+                                                     + HEADERS_DIR, os.F_OK)\
+                           , folders)
         for folder in not_exist :
-            os.mkdir(folder)
+            if not os.access(folder, os.F_OK) :
+                os.mkdir(folder)
+            os.mkdir(folder + os.sep + HEADERS_DIR)
             
 
-        rawdata = etree.tostring(message)
-        filename = md5.new(rawdata).hexdigest() + '.xml'
+        chunks = message_chunks(message)
+        digest = md5.new()
+        map(digest.update, chunks)
+        filename = digest.hexdigest() + '.xml'
         
         fullname = folders[0] + os.sep + filename
         while os.access(fullname, os.F_OK) :
             filename = '_' + filename;
             fullname = folders[0] + os.sep + filename
-        file(fullname, 'wb').write(rawdata)
+        out = file(fullname, 'wb')
+        try:
+            map(out.write, chunks)
+        finally:
+            out.close()
+        headername = os.sep.join([folders[0], HEADERS_DIR, filename])
+        file(headername, 'wb').write(make_header(message))
 
         for folder in folders[1:] :
             os.link(fullname, folder + os.sep + filename)
+            os.link(headername, os.sep.join([folder, HEADERS_DIR, filename]))
         return PROCESS_OK, message
     
+def encode_cursor(account, key) :
+    """Opaque cursor of the message 'key' of 'account'"""
+    if isinstance(account, unicode) :
+        account = account.encode('utf-8')
+    return base64.urlsafe_b64encode(CURSOR_SEP.join([account, key]))
+
+def decode_cursor(cursor) :
+    """Returns (account, key) of encode_cursor() result.
+    Raises ValueError for malformed cursors."""
+    try:
+        account, key = base64.urlsafe_b64decode(cursor.strip().encode(\
+            'ascii')).split(CURSOR_SEP, 1)
+        return account.decode('utf-8'), key
+    except (TypeError, UnicodeError), err :
+        raise ValueError('Bad cursor: %s' % err)
+
+def optional_limit(value) :
+    if value is None :
+        return None
+    value = int(value)
+    if value <= 0 :
+        raise ValueError('Limit should be positive: %d' % value)
+    return value
+
 class FetchConditions(object) :
-    __slots__ = ['onlyheaders', 'maxdate', 'mindate', 'removeafter']
+    """Conditions of chaski:Fetch and the page being fetched.
+
+    Fetch with MaxMessages or MaxBytes is sent in pages. Stores go through
+    messages of each account in a stable order of string keys and call
+    admit() for every message to send, the first message that doesn't
+    fit the page becomes the cursor of the next page (see mail_tail()).
+    Fetch with the cursor starts from that message: accounts() skips
+    accounts of previous pages and before_cursor() the messages.
+
+    """
+    __slots__ = ['onlyheaders', 'maxdate', 'mindate', 'removeafter'\
+                 , 'maxmessages', 'maxbytes', 'cursor'\
+                 , 'messages', 'bytes', 'next_cursor']
 
     def __init__(self, onlyheaders = 'false'\
-                 , maxdate = None, mindate = None, removeafter = 'false') :
+                 , maxdate = None, mindate = None, removeafter = 'false'\
+                 , maxmessages = None, maxbytes = None, cursor = None) :
         """arguments are in the same order
         as in chaski.xsd:chaski_fetch_restrictions"""
         
         self.onlyheaders = onlyheaders in XSD_BOOL_TRUE
         self.removeafter = removeafter in XSD_BOOL_TRUE
+        self.maxmessages = optional_limit(maxmessages)
+        self.maxbytes = optional_limit(maxbytes)
+        if cursor is not None :
+            cursor = decode_cursor(cursor)
+        self.cursor = cursor
+        self.messages = 0
+        self.bytes = 0
+        self.next_cursor = None
 
         if maxdate is None :
             maxdate = date.max
@@ -341,14 +644,60 @@ class FetchConditions(object) :
             
         self.maxdate = maxdate
         self.mindate = mindate
+
+    def accounts(self, recepients) :
+        """Accounts left to fetch, starting from the one of the cursor"""
+        if self.cursor is None :
+            return recepients
+        return recepients[recepients.index(self.cursor[0]):]
+
+    def before_cursor(self, account, key) :
+        """True for the messages sent in previous pages"""
+        return self.cursor is not None and account == self.cursor[0] \
+               and key < self.cursor[1]
+
+    def admit(self, account, key, size) :
+        """Count message of 'size' bytes in the page. Returns False
+        when the page is full, the message then starts the next page.
+        The first message of a page is admitted whatever its size."""
+        if self.next_cursor is not None :
+            return False
+        if (self.maxmessages is not None \
+            and self.messages >= self.maxmessages) \
+           or (self.maxbytes is not None and self.messages \
+               and self.bytes + size > self.maxbytes) :
+            self.next_cursor = encode_cursor(account, key)
+            return False
+        self.messages += 1
+        self.bytes += size
+        return True
+
+    def mail_tail(self) :
+        """End of the fetched mail with the cursor of the next page"""
+        if self.next_cursor is None :
+            return MAIL_TAIL
+        return NEXT_CURSOR_PATTERN % self.next_cursor + MAIL_TAIL
     
 class FetchMessage(ChaskiPlugin) :
     """Base plugin for fetching messages.
     Subclasses should implement:
 
     fetch(recepients, conditions)->chaski:Mail -- fetch a batch by conditions
+    check_cursor(key) -- (optional) reject malformed cursor keys
+
+    Paged fetches should pass messages through conditions.admit() and
+    end the mail with conditions.mail_tail() (see FetchConditions).
+
+    Response is sent while fetch() produces it, so fetch() should
+    yield message by message (or file chunk by chunk). Things to be
+    done after successful send (e.g. RemoveAfterFetch) should follow
+    FLUSH yielded after the end of the mail. A message failing after
+    a part of it was yielded can't be skipped: fetch() raises
+    FetchAborted (see guard_message()) and the connection is closed
+    without Result.
     
     """
+    stores = True
 
     def __init__(self, params) :
         ChaskiPlugin.__init__(self, params)
@@ -360,26 +709,59 @@ class FetchMessage(ChaskiPlugin) :
     def process(self, mail, src_sock) :
         def parseconditions(conds) :
             result = {}
-            result['onlyheaders'] = conds.findtext(NAMESPACE + 'OnlyHeader')
-            result['mindate'] = conds.findtext(NAMESPACE + 'MinReceiveDate')
-            result['maxdate'] = conds.findtext(NAMESPACE + 'MaxReceiveDate')
-            result['removeafter'] = conds.findtext(NAMESPACE + 'RemoveAfterFetch')
+            result['onlyheaders'] = node_text(ONLY_HEADER_PATH, conds)
+            result['mindate'] = node_text(MIN_DATE_PATH, conds)
+            result['maxdate'] = node_text(MAX_DATE_PATH, conds)
+            result['removeafter'] = node_text(REMOVE_AFTER_PATH, conds)
+            result['maxmessages'] = node_text(MAX_MESSAGES_PATH, conds)
+            result['maxbytes'] = node_text(MAX_BYTES_PATH, conds)
+            result['cursor'] = node_text(CURSOR_PATH, conds)
             return result
-        recepients = [node.text for node in mail.findall(NAMESPACE + 'To')]
-        conditions = FetchConditions(**parseconditions(\
-            mail.find(NAMESPACE + 'Conditions')))
-        result = self.fetch(recepients, conditions)
-        self.logger.debug('Sending mail %s', result)
-        src_sock.send(result)
+        recepients = [node.text for node in TO_PATH(mail)]
+        try:
+            conditions = FetchConditions(**parseconditions(\
+                first_node(CONDITIONS_PATH, mail)))
+        except ValueError, err :
+            return PROCESS_FAIL, 'Bad fetch conditions: %s' % err
+        if conditions.cursor is not None :
+            if conditions.cursor[0] not in recepients :
+                return PROCESS_FAIL, 'Bad fetch conditions: cursor'\
+                       ' of another account'
+            try:
+                self.check_cursor(conditions.cursor[1])
+            except ValueError, err :
+                return PROCESS_FAIL, 'Bad fetch conditions: %s' % err
+        chunks = self.fetch(recepients, conditions)
+        if isinstance(chunks, basestring) :
+            chunks = [chunks]
+        try:
+            sent = send_chunks(src_sock, chunks)
+        except socket.error, err :
+            return PROCESS_FAIL, 'Failed to send mail: %s' % err
+        except FetchAborted, err :
+            self.logger.error('Fetch aborted: %s', err)
+            # the client sees the connection closed before the mail ended
+            close_connection(src_sock)
+            return PROCESS_FAIL, 'Fetch aborted: %s' % err
+        finally:
+            if hasattr(chunks, 'close') :
+                chunks.close()
+        self.logger.debug('Sent mail of %d bytes', sent)
         return PROCESS_OK, mail
 
+    def check_cursor(self, key) :
+        """Raise ValueError if the paging key of a cursor
+        can't be a key of the store"""
+        pass
+
     def fetch(self, recepients, restr) :
         """Fetch messages by conditions for recepients
 
         recepients -- list of strings representing e-mail account names
         restr -- FetchRestrions object representing conditions which
                    should be met by message to put it to result
-        returns xml string to be sent over network
+        returns xml string or iterable of strings (e.g. generator)
+                to be sent over network
         
         """
         pass
@@ -391,7 +773,9 @@ class FetchMessagesFromPlainFile(FetchMessage) :
     User should configure 'base_dir' parameter specifying
     base folder for mail storage. The plugin works in assumption
     that authentification is done by previous plugin(s). The file
-    with message will be deleted after read. 
+    with message will be deleted after read. Headers are read from
+    files saved by ReceiveMessageToPlainFile (messages stored without
+    them are parsed).
     
     Plugin parameters:
       base_dir -- root directory for user directories
@@ -399,113 +783,182 @@ class FetchMessagesFromPlainFile(FetchMessage) :
     
     """
     
+    def headername(self, fname) :
+        dirname, basename = os.path.split(fname)
+        return os.sep.join([dirname, HEADERS_DIR, basename])
+
     def fetch(self, recepients, cond) :
         def fetchheader(fname) :
-            wholemail = etree.parse(fname).getroot()
-            chapters = wholemail.findall(NAMESPACE + 'Chapter')
-            [wholemail.remove(ch) for ch in chapters]
-            return etree.tostring(wholemail)
+            try:
+                return [open(self.headername(fname)).read()]
+            except IOError :
+                return [make_header(etree.parse(fname).getroot())]
 
         def fetchwhole(fname) :
-            return open(fname).read()
+            return file_chunks(open(fname, 'rb'))
                 
+        def filesize(fname) :
+            if cond.onlyheaders :
+                fname = self.headername(fname)
+            try:
+                return os.stat(fname).st_size
+            except OSError :
+                return 0
+
         mesfnames = []
-        for account in recepients :
+        for account in cond.accounts(recepients) :
             accountdir = ''.join([self.basedir, os.sep, account])
+            # files are paged in the order of modification time
+            files = []
             for fname in os.listdir(accountdir) :
+                if fname.startswith('.') :
+                    continue
                 fullfname = ''.join([accountdir, os.sep, fname])
-                modtime = date.fromtimestamp(os.stat(fullfname).st_mtime)
-                if cond.mindate <= modtime <= cond.maxdate :
-                    mesfnames.append(fullfname)
+                mtime = os.stat(fullfname).st_mtime
+                key = '%020.6f %s' % (mtime, fname)
+                if cond.before_cursor(account, key) :
+                    continue
+                if cond.mindate <= date.fromtimestamp(mtime) <= cond.maxdate :
+                    files.append((key, fullfname))
+            files.sort()
+            for key, fullfname in files :
+                if not cond.admit(account, key, filesize(fullfname)) :
+                    break
+                mesfnames.append(fullfname)
+            if cond.next_cursor is not None :
+                break
         self.logger.debug('fetching files: %s', mesfnames)
         if cond.onlyheaders :
             fetchfunc = fetchheader
         else :
             fetchfunc = fetchwhole
-        messages = []
         toremove = []
+        yield MAIL_HEAD
         for f in mesfnames :
             try:
-                data = fetchfunc(f)
-                messages.append(data)
-            except (etree.Error, OSError), errmes :
+                for chunk in guard_message(fetchfunc(f), (IOError, OSError)) :
+                    yield chunk
+            except (etree.Error, IOError, OSError), errmes :
                 self.logger.error(errmes)
-            else :
-                toremove.append(f)
-        
-        mail = EMPTY_MAIL_PATTERN % ''.join(messages)
+                continue
+            toremove.append(f)
+        yield cond.mail_tail()
+        yield FLUSH
+
         if cond.removeafter :
             try:
                 map(os.remove, toremove)
             except OSError, err :
                 self.logger.error(err)
-        return mail
+            for fname in toremove :
+                try:
+                    os.remove(self.headername(fname))
+                except OSError :
+                    pass
         
 
 class SendMessage(ChaskiPlugin) :
     """Plugin for sending message to other servers over network.
-    No configuration required."""
+    Mails go through a pool of connections kept to peers
+    (see chaski_relay), Results of peers are logged.
+
+    With spooldir mails are queued on disk (see chaski_spool) and
+    relayed by a background thread with retries, the plugin returns
+    as soon as the mails are queued. Mails queued for a peer are
+    relayed together in one chaski:Mail, up to batch_mails mails
+    and batch_bytes bytes, after waiting at most batch_age seconds
+    for others. Otherwise mails are relayed at once and mails
+    to unreachable peers are lost.
+
+    Plugin parameters (all optional):
+      port -- port of peer servers (25)
+      relay_max_per_host -- mails relayed to a peer at a time (4)
+      relay_idle_timeout -- seconds to keep idle connections (60)
+      relay_timeout -- seconds to wait for a peer (30)
+      spooldir -- directory of the outbound queue
+      retry_delay -- seconds before the first retry (60)
+      max_retry_delay -- maximal seconds between retries (3600)
+      max_age -- seconds to retry a mail before dropping it (5 days)
+      spool_scan_interval -- seconds between scans of spooldir (30)
+      batch_mails -- queued mails relayed in one mail (64)
+      batch_bytes -- maximal size of the mail relayed (1Mb)
+      batch_age -- seconds a mail waits for others to relay with (0)
+
+    """
+    stores = True
 
     def __init__(self, params) :
         self.port = CHASKI_PORT
         ChaskiPlugin.__init__(self, params)
+        self.port = int(self.port)
         self.match_xpath = 'chaski:Credentials'
+        self.relays = get_relay_pool(\
+            int(params.get('relay_max_per_host', MAX_PER_HOST))\
+            , float(params.get('relay_idle_timeout', IDLE_TIMEOUT))\
+            , float(params.get('relay_timeout', IO_TIMEOUT)))
+        self.spool = None
+        if params.get('spooldir') :
+            self.spool = get_spool(params['spooldir'], self.relays\
+                , retry_delay=float(params.get('retry_delay', RETRY_DELAY))\
+                , max_retry_delay=float(params.get('max_retry_delay'\
+                                                   , MAX_RETRY_DELAY))\
+                , max_age=float(params.get('max_age', MAX_AGE))\
+                , scan_interval=float(params.get('spool_scan_interval'\
+                                                 , SCAN_INTERVAL))\
+                , batch_mails=int(params.get('batch_mails', BATCH_MAILS))\
+                , batch_bytes=int(params.get('batch_bytes', BATCH_BYTES))\
+                , batch_age=float(params.get('batch_age', BATCH_AGE)))
+            self.spool.start()
 
     match = ChaskiPlugin.xpath_exists
 
     def process(self, mail, src_sock) :
         def getdesthosts(message) :
-            destusernodes = message.findall(NAMESPACE + 'To')
-            destusernodes.extend(message.findall(NAMESPACE + 'SecretTo'))
+            destusernodes = TO_PATH(message)
+            destusernodes.extend(SECRET_TO_PATH(message))
             destusers = [node.text for node in destusernodes]
             desthosts = [user[user.find(ADDRESS_DELIM) + 1:] \
                          for user in destusers]
             return list(set(desthosts))
         
-        messages = mail[1:] # take all children except chaski:Credentials
         mes_to_serv = {}
-        for message in messages :
+        for message in mail.iterchildren(NAMESPACE + 'Message') :
             hosts = getdesthosts(message)
             try:
                 hosts.remove(self.conf.my_name)
             except ValueError, ve:
                 pass
-            data = etree.tostring(message)
-            print hosts
+            # spilled contents are read only when the mail is written
+            chunks = message_chunks(message)
             for host in hosts :
                 if not mes_to_serv.has_key(host) :
-                    mes_to_serv[host] = []
-                mes_to_serv[host].append(data)
+                    mes_to_serv[host] = [[MAIL_HEAD]]
+                mes_to_serv[host].append(chunks)
 
         ### TODO: allow only dedicated chaski:SecretTo to be sent to servers
         ###          i.e. no SecretTo for server1 should be sent to server2
-        waitingsockets = select.poll()
-        openedconns = 0
-        for host, messages in mes_to_serv.iteritems() :
-            s = socket.socket()
+        if self.spool is not None :
+            # plugin might have been made before fork()
+            self.spool.start()
             try:
-                self.logger.debug('Connecting to %s:%d', host, self.port)
-                s.connect((host, self.port))
-                s.setblocking(False)
-                mail = EMPTY_MAIL_PATTERN % ''.join(messages)
-                s.send(mail)
-            except socket.error, e:
-                self.logger.error('Network error occured: %s', e)
-                s.close()
+                for host, parts in mes_to_serv.iteritems() :
+                    self.spool.enqueue(host, self.port\
+                        , ChainedChunks(parts + [[MAIL_TAIL]]))
+            except (IOError, OSError), err :
+                self.logger.error('Failed to queue mail: %s', err)
+                return PROCESS_FAIL, 'Failed to queue mail'
+            return PROCESS_OK, mail
+        deliveries = [Delivery(host, self.port\
+                               , ChainedChunks(parts + [[MAIL_TAIL]]))\
+                      for host, parts in mes_to_serv.iteritems()]
+        for delivery in self.relays.relay(deliveries) :
+            if delivery.ok :
+                self.logger.debug('Mail relayed to %s: %s'\
+                                  , delivery.host, delivery.description)
             else :
-                waitingsockets.register(s, select.POLLOUT)
-                openedconns += 1
-        while openedconns > 0 :
-            finished = waitingsockets.poll()
-            self.logger.debug(finished)
-            fds = [fin[0] for fin in finished]
-            for fd in fds :
-                waitingsockets.unregister(fd)
-                openedconns -= 1
-                try:
-                    os.close(fd)
-                except OSError:
-                    pass
+                self.logger.error('Failed to relay mail to %s: %s'\
+                                  , delivery.host, delivery.description)
+        self.logger.debug('%s', self.relays)
         return PROCESS_OK, mail
             
         
@@ -516,5 +969,5 @@ class SizePlugin(ChaskiPlugin) :
 
 
     def process(self, mail, sock) :
-        self.logger.info('Mail size is %d', len(etree.tostring(mail)))
+        self.logger.info('Mail size is %d', mail_size(mail))
         return PROCESS_OK, mail
@@ -0,0 +1,127 @@
+"""Bounded worker pool used by chaski server to run message processing"""
+
+import thread
+import threading
+import Queue
+
+__all__ = ['WorkerPool', 'PendingResult', 'CallTimeout']
+
+
+class CallTimeout(Exception) :
+    """Raised by PendingResult.get() if the call didn't finish in time"""
+    pass
+
+
+class PendingResult(object) :
+    """Result of a call made through WorkerPool.call()"""
+
+    def __init__(self) :
+        self.finished = threading.Event()
+        self.cancelled = False
+        self.value = None
+        self.error = None
+
+    def run(self, func, args) :
+        if not self.cancelled :
+            try:
+                self.value = func(*args)
+            except Exception, ex :
+                self.error = ex
+        self.finished.set()
+
+    def cancel(self) :
+        """Don't run the call if it hasn't been started yet"""
+        self.cancelled = True
+
+    def get(self, timeout=None) :
+        """Wait for the call to finish and return its result
+        or raise its exception. CallTimeout is raised if the call
+        hasn't finished in timeout seconds."""
+        if not self.finished.wait(timeout) :
+            raise CallTimeout('Call has not finished in %s seconds' % timeout)
+        if self.error is not None :
+            raise self.error
+        return self.value
+
+
+class WorkerPool(object) :
+    """Fixed set of worker threads fed from a bounded queue.
+
+    submit() never blocks: a job is refused if 'queue_size' jobs are
+    already waiting or 'max_in_flight' jobs are waiting or running.
+
+    Attributes defined:
+    accepted, rejected, completed -- counters of submitted jobs
+
+    """
+
+    def __init__(self, workers, queue_size, max_in_flight, logger) :
+        self.logger = logger
+        self.max_in_flight = max_in_flight
+        self.jobs = Queue.Queue(queue_size)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.completed = 0
+        for i in range(workers) :
+            thread.start_new_thread(self.work, ())
+
+    def submit(self, func, *args) :
+        """Queue func(*args) for execution.
+        Returns False if the pool is overloaded and job was refused.
+
+        """
+        self.lock.acquire()
+        try:
+            if self.in_flight >= self.max_in_flight :
+                self.rejected += 1
+                return False
+            try:
+                self.jobs.put_nowait((func, args))
+            except Queue.Full :
+                self.rejected += 1
+                return False
+            self.in_flight += 1
+            self.accepted += 1
+            return True
+        finally:
+            self.lock.release()
+
+    def call(self, func, *args) :
+        """Run func(*args) in the pool and return PendingResult.
+        If the pool is overloaded func is run in the calling thread.
+
+        """
+        result = PendingResult()
+        if not self.submit(result.run, func, args) :
+            result.run(func, args)
+        return result
+
+    def work(self) :
+        """Worker thread body: run jobs from the queue forever"""
+        while True :
+            func, args = self.jobs.get()
+            try:
+                func(*args)
+            except Exception, ex :
+                self.logger.exception('Worker job failed: %s', ex)
+            self.lock.acquire()
+            self.in_flight -= 1
+            self.completed += 1
+            self.lock.release()
+
+    def stats(self) :
+        """Returns dict with current queue depth and job counters"""
+        self.lock.acquire()
+        try:
+            return {'queued': self.jobs.qsize()
+                    , 'in_flight': self.in_flight
+                    , 'accepted': self.accepted
+                    , 'rejected': self.rejected
+                    , 'completed': self.completed}
+        finally:
+            self.lock.release()
+
+    def __str__(self) :
+        return 'WorkerPool: %s' % self.stats()
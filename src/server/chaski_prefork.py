@@ -0,0 +1,82 @@
+"""Prefork process manager for chaski server
+
+The master process forks a number of workers, each running the whole
+accept/serve loop, and restarts any worker that dies.
+
+"""
+
+import os
+import sys
+import signal
+import errno
+import time
+
+__all__ = ['PreforkMaster']
+
+RESPAWN_DELAY = 1 # seconds between restarts of a crashing worker
+
+
+class PreforkMaster(object) :
+    """Forks and supervises 'processes' worker processes.
+
+    worker() -- callable run in every child. It is expected to serve
+                forever; the child exits when it returns or raises.
+
+    """
+
+    def __init__(self, processes, worker, logger) :
+        self.processes = processes
+        self.worker = worker
+        self.logger = logger
+        self.children = {}
+        self.stopping = False
+        self.last_spawn = 0
+
+    def spawn(self, slot) :
+        pid = os.fork()
+        if pid == 0 :
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            status = 0
+            try:
+                try:
+                    self.worker()
+                except Exception, ex :
+                    self.logger.exception('Worker %d failed: %s', slot, ex)
+                    status = 1
+            finally:
+                os._exit(status)
+        self.logger.info('Started worker %d with pid %d', slot, pid)
+        self.children[pid] = slot
+        self.last_spawn = time.time()
+
+    def stop(self, signum=None, frame=None) :
+        """Terminate all workers and exit"""
+        self.stopping = True
+        for pid in self.children.keys() :
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError :
+                pass
+
+    def run(self) :
+        """Start workers and restart them as they die until stop()"""
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for slot in range(self.processes) :
+            self.spawn(slot)
+        while self.children :
+            try:
+                pid, status = os.wait()
+            except OSError, err :
+                if err.errno == errno.EINTR :
+                    continue
+                raise
+            slot = self.children.pop(pid, None)
+            if slot is None or self.stopping :
+                continue
+            self.logger.error('Worker %d (pid %d) died with status %d'\
+                              , slot, pid, status)
+            if time.time() - self.last_spawn < RESPAWN_DELAY :
+                time.sleep(RESPAWN_DELAY)
+            self.spawn(slot)
+        sys.exit()
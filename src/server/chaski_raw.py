@@ -0,0 +1,413 @@
+"""Bytes of chaski mails shared by the plugin chain
+
+MessageReader keeps the buffer a mail was parsed from. RawMail finds
+byte ranges of the messages (children of the root element) and of
+their children in the buffer, so a message could be written, hashed,
+sized and forwarded as the bytes it was received in instead of being
+serialized again with etree.tostring().
+
+The server opens a MailContext for the mail (with RawMail of the
+buffer if any) for the time plugins run. Plugins get the bytes with
+message_chunks()/message_bytes() (mail_chunks() and mail_size() for
+the whole mail): received bytes when they are usable, otherwise
+serialization made once and cached in the context. Removed children
+of a message are noticed (e.g. SecretTo taken out by ReceiveMessage),
+any other change of the tree should be reported with mark_mutated()
+or by the plugin's 'mutates' attribute (see ChaskiPlugin).
+
+Chapter contents spilled to files while parsing (see chaski_spill)
+are kept in the context too. Bytes of messages with spilled contents
+are StreamedChunks reading the files each time they are iterated.
+
+"""
+
+import re
+import uuid
+from xml.sax.saxutils import quoteattr
+from lxml import etree
+
+from chaski_const import NAMESPACE
+
+__all__ = ['RawMail', 'MailContext', 'StreamedChunks', 'ChainedChunks'\
+           , 'register', 'release', 'replace', 'mail_context', 'open_context'\
+           , 'mark_mutated', 'spilled', 'message_chunks', 'message_bytes'\
+           , 'mail_chunks', 'mail_size']
+
+# markup of the buffer: comments, CDATA, PIs, DOCTYPE, end and start tags
+TAG_RE = re.compile(r'<(?:!--.*?-->|!\[CDATA\[.*?\]\]>|\?.*?\?>|![^>]*>'\
+                    r'|/[^>]*>|[^>"\']*(?:(?:"[^"]*"|\'[^\']*\')[^>"\']*)*>)'\
+                    , re.S)
+TAG_NAME_RE = re.compile(r'<([^\s/>]+)')
+XMLNS_RE = re.compile(r'\sxmlns(?::([^\s=]+))?\s*=')
+ENCODING_RE = re.compile(r'\s*<\?xml[^>]*encoding\s*=\s*["\']([^"\']+)')
+# the bytes are embedded in documents without XML declaration
+RAW_ENCODINGS = ['utf-8', 'utf8', 'ascii', 'us-ascii']
+UTF8_BOM = '\xef\xbb\xbf'
+# levels of elements with ranges: root, messages and their children
+SPAN_LEVELS = 3
+CONTENT_TAG = NAMESPACE + 'ChapterContent'
+
+
+def scan(data) :
+    """Finds ranges of root children and of their children.
+    Returns (end of the root, spans of root children) or None
+    if the buffer can't be used as is. Span of an element is list
+    [start, end, end of tag name, declared prefixes, start of end tag
+    , spans of children]"""
+    stack = []
+    for match in TAG_RE.finditer(data) :
+        token = match.group(0)
+        if token.startswith('<!--') or token.startswith('<![CDATA[')\
+               or token.startswith('<?') :
+            continue
+        if token.startswith('<!') :
+            # DOCTYPE may define entities used in the messages
+            return None
+        if token.startswith('</') :
+            span = stack.pop()
+            span[1] = match.end()
+            span[4] = match.start()
+        else :
+            name = TAG_NAME_RE.match(token).group(1)
+            span = [match.start(), match.end(), match.start() + 1 + len(name)\
+                    , XMLNS_RE.findall(token), match.start(), []]
+            if stack and len(stack) < SPAN_LEVELS :
+                stack[-1][5].append(span)
+            if not token.endswith('/>') :
+                stack.append(span)
+        if not stack :
+            return span[1], span[5]
+    return None
+
+def elements(elem) :
+    return [child for child in elem if isinstance(child.tag, basestring)]
+
+def structure(root) :
+    """Messages of the mail and their children"""
+    return [(message, elements(message)) for message in elements(root)]
+
+def removed(original, current) :
+    """Indexes of original elements missing in current or None
+    if current isn't original with some elements removed"""
+    skipped = []
+    pos = 0
+    for i, elem in enumerate(original) :
+        if pos < len(current) and current[pos] is elem :
+            pos += 1
+        else :
+            skipped.append(i)
+    if pos != len(current) :
+        return None
+    return skipped
+
+def to_str(chunk) :
+    if isinstance(chunk, memoryview) :
+        return chunk.tobytes()
+    return chunk
+
+def chunks_size(chunks) :
+    if isinstance(chunks, (StreamedChunks, ChainedChunks)) :
+        return chunks.size()
+    return sum([len(chunk) for chunk in chunks])
+
+
+class StreamedChunks(object) :
+    """Bytes of serialized XML with spilled contents in between.
+    Iteration reads the spill files, so it may be repeated."""
+
+    def __init__(self, parts) :
+        self.parts = parts # strings and Spills
+
+    def __iter__(self) :
+        for part in self.parts :
+            if isinstance(part, str) :
+                yield part
+            else :
+                for chunk in part.chunks() :
+                    yield chunk
+
+    def size(self) :
+        size = 0
+        for part in self.parts :
+            if isinstance(part, str) :
+                size += len(part)
+            else :
+                size += part.text_size
+        return size
+
+
+class ChainedChunks(object) :
+    """Chunks of several lists of chunks or StreamedChunks one after
+    another. Nothing is read before iteration, which may be repeated."""
+
+    def __init__(self, parts) :
+        self.parts = parts
+
+    def __iter__(self) :
+        for part in self.parts :
+            for chunk in part :
+                yield chunk
+
+    def size(self) :
+        return sum([chunks_size(part) for part in self.parts])
+
+
+class RawMail(object) :
+    """Received buffer of a mail and ranges of its messages.
+
+    Attributes defined:
+    view -- memoryview of the buffer
+    size -- length of the mail in the buffer
+    mutated -- elements changed after parsing (see mark_mutated())
+
+    """
+
+    def __init__(self, data, root) :
+        self.view = memoryview(data)
+        self.size = len(data)
+        self.root = root
+        self.nsmap = root.nsmap
+        self.messages = {} # message -> (span, original children)
+        self.children = elements(root)
+        self.mutated = set()
+        spans = None
+        if self.raw_encoding(data) :
+            spans = scan(data)
+        if spans is None or len(spans[1]) != len(self.children) :
+            self.mutated.add(root)
+            return
+        self.size = spans[0]
+        for message, span in zip(self.children, spans[1]) :
+            children = elements(message)
+            if len(children) == len(span[5]) :
+                self.messages[message] = (span, children)
+
+    def raw_encoding(self, data) :
+        if data.startswith(UTF8_BOM) :
+            data = data[len(UTF8_BOM):]
+        elif not data.lstrip().startswith('<') :
+            return False # UTF-16 or garbage
+        encoding = ENCODING_RE.match(data)
+        return encoding is None \
+               or encoding.group(1).lower() in RAW_ENCODINGS
+
+    def declarations(self, declared) :
+        """Namespace declarations of the root for a message
+        which doesn't declare 'declared' prefixes itself"""
+        decls = []
+        for prefix, uri in self.nsmap.items() :
+            if (prefix or '') not in declared :
+                if prefix is None :
+                    decls.append(' xmlns=%s' % quoteattr(uri))
+                else :
+                    decls.append(' xmlns:%s=%s' % (prefix, quoteattr(uri)))
+        return ''.join(decls)
+
+    def message_chunks(self, message) :
+        """Pieces of the message bytes (without removed children)
+        or None if the message should be serialized"""
+        try:
+            span, children = self.messages[message]
+        except KeyError :
+            return None
+        if message in self.mutated :
+            return None
+        skipped = removed(children, elements(message))
+        if skipped is None :
+            return None
+        start, end, name_end, declared, close, spans = span
+        chunks = [self.view[start:name_end], self.declarations(declared)]
+        pos = name_end
+        for i in skipped :
+            # the child goes with its tail as in Element.remove()
+            chunks.append(self.view[pos:spans[i][0]])
+            if i + 1 < len(spans) :
+                pos = spans[i + 1][0]
+            else :
+                pos = close
+        chunks.append(self.view[pos:end])
+        return chunks
+
+    def mail_chunks(self) :
+        """Bytes of the whole mail or None if it has changed"""
+        if self.mutated or elements(self.root) != self.children :
+            return None
+        for message, (span, children) in self.messages.items() :
+            if elements(message) != children :
+                return None
+        return [self.view[:self.size]]
+
+    def mark_mutated(self, message) :
+        self.mutated.add(self.root)
+        self.mutated.add(message)
+
+
+class MailContext(object) :
+    """Bytes of one mail shared by the plugins processing it.
+
+    Serialized messages and mail are cached along with the children
+    they were made of, so the cache survives removal and return
+    of children (as of SecretTo by ReceiveMessage). Changes
+    reported with mark_mutated() or invalidate() drop the cache.
+
+    Attributes defined:
+    root -- root element of the mail
+    raw -- RawMail of the received buffer or None
+    spills -- ChapterContent element -> Spill of its text
+    serializations -- number of etree.tostring() calls made
+
+    """
+
+    def __init__(self, root, raw=None, spills=None) :
+        self.root = root
+        self.raw = raw
+        self.spills = spills or {}
+        self.messages = {} # message -> (children, chunks)
+        self.mail = None # (structure, chunks, size)
+        self.serializations = 0
+
+    def serialize(self, elem) :
+        self.serializations += 1
+        contents = [content for content in elem.iter(CONTENT_TAG)\
+                    if content in self.spills]
+        if not contents :
+            return [etree.tostring(elem)]
+        # spilled contents are put in place of markers
+        marker = uuid.uuid4().hex
+        for content in contents :
+            content.text = marker
+        try:
+            pieces = etree.tostring(elem).split(marker)
+        finally:
+            for content in contents :
+                content.text = None
+        parts = [pieces[0]]
+        for content, piece in zip(contents, pieces[1:]) :
+            parts.append(self.spills[content])
+            parts.append(piece)
+        return StreamedChunks(parts)
+
+    def message_chunks(self, message) :
+        if self.raw is not None :
+            chunks = self.raw.message_chunks(message)
+            if chunks is not None :
+                return chunks
+        children = elements(message)
+        cached = self.messages.get(message)
+        if cached is not None and cached[0] == children :
+            return cached[1]
+        chunks = self.serialize(message)
+        self.messages[message] = (children, chunks)
+        return chunks
+
+    def mail_chunks(self) :
+        return self.cached_mail()[1]
+
+    def mail_size(self) :
+        return self.cached_mail()[2]
+
+    def cached_mail(self) :
+        if self.raw is not None :
+            chunks = self.raw.mail_chunks()
+            if chunks is not None :
+                return None, chunks, self.raw.size
+        shape = structure(self.root)
+        if self.mail is None or self.mail[0] != shape :
+            chunks = self.serialize(self.root)
+            self.mail = (shape, chunks, chunks_size(chunks))
+        return self.mail
+
+    def mark_mutated(self, elem) :
+        """Drop bytes of the message containing elem and of the mail"""
+        parent = elem.getparent()
+        while parent is not None and parent is not self.root :
+            elem, parent = parent, parent.getparent()
+        self.messages.pop(elem, None)
+        self.mail = None
+        if self.raw is not None :
+            self.raw.mark_mutated(elem)
+
+    def invalidate(self) :
+        """Forget all the bytes after unknown changes of the tree"""
+        self.messages.clear()
+        self.mail = None
+        self.raw = None
+
+    def close(self) :
+        """Remove spilled files"""
+        for spill in self.spills.values() :
+            spill.remove()
+        self.spills = {}
+
+_CONTEXTS = {} # root element -> MailContext
+
+def register(root, raw=None, spills=None) :
+    """Open MailContext of the mail (with received bytes and spilled
+    contents if any)"""
+    context = _CONTEXTS[root] = MailContext(root, raw, spills)
+    return context
+
+def release(root) :
+    context = _CONTEXTS.pop(root, None)
+    if context is not None :
+        context.close()
+
+def replace(root, new_root) :
+    """MailContext of the mail a plugin returned instead of root,
+    spilled contents of root go over to it"""
+    context = _CONTEXTS.pop(root, None)
+    new_context = open_context(new_root)
+    if context is not None and context is not new_context :
+        new_context.spills.update(context.spills)
+    return new_context
+
+def mail_context(elem) :
+    """MailContext of the mail elem belongs to or None"""
+    return _CONTEXTS.get(elem.getroottree().getroot())
+
+def open_context(root) :
+    """Registered MailContext of the mail or a new one"""
+    context = _CONTEXTS.get(root)
+    if context is None :
+        context = register(root)
+    return context
+
+def spilled(content) :
+    """Spill of ChapterContent element or None"""
+    context = mail_context(content)
+    if context is None :
+        return None
+    return context.spills.get(content)
+
+def mark_mutated(elem) :
+    """Report change of elem (or its subtree), the message containing
+    elem and the whole mail are serialized again after the change"""
+    context = mail_context(elem)
+    if context is not None :
+        context.mark_mutated(elem)
+
+def message_chunks(message) :
+    """Bytes of the message as a list of strings and memoryviews,
+    the message is serialized if received bytes can't be used"""
+    context = mail_context(message)
+    if context is None :
+        return [etree.tostring(message)]
+    return context.message_chunks(message)
+
+def message_bytes(message) :
+    """Bytes of the message as one string"""
+    return ''.join([to_str(chunk) for chunk in message_chunks(message)])
+
+def mail_chunks(mail) :
+    """Bytes of the whole mail, see message_chunks()"""
+    context = mail_context(mail)
+    if context is None :
+        return [etree.tostring(mail)]
+    return context.mail_chunks()
+
+def mail_size(mail) :
+    """Size of the whole mail in bytes"""
+    context = mail_context(mail)
+    if context is None :
+        return len(etree.tostring(mail))
+    return context.mail_size()
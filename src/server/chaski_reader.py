@@ -0,0 +1,287 @@
+"""Incremental (push) ingestion of chaski messages
+
+MessageReader wraps lxml feed parser. Whoever owns the socket
+pushes received data into it with feed() until the whole
+message is parsed. Parsed message is then checked by a validator:
+schema_validator() for full XML Schema validation or
+structural_check() for a fast check of root and required children.
+Received data is kept for plugins as RawMail (see chaski_raw),
+unless big chapter contents are spilled to files (see chaski_spill).
+
+Size of the message is checked before every piece of data is parsed
+and no more than the limit is asked from the socket. The limit may
+change once chaski:Credentials of the message is parsed: user_limit
+gives the limit of the user. A lower limit applies at once. A higher
+one is only provisional, as anyone may claim a username before
+plugins authenticate the mail: the worker calls verify_user() on
+the received message, which rejects it if it exceeds the original
+limit and verify refuses the username and password. Verifying
+(e.g. PBKDF2) is too slow for the thread feeding the reader, which
+may be the event loop. So is full schema validation: after
+defer_validation() the validator runs in check() instead of feed().
+
+"""
+
+import time
+import socket
+from lxml import etree
+
+from chaski_const import NAMESPACE, VALIDATE_FULL, VALIDATE_STRUCTURAL
+from chaski_raw import RawMail
+
+__all__ = ['MessageReader', 'ConnectionClosed', 'StructureError'\
+           , 'MessageTooBig', 'DEFAULT_READ_SIZE', 'structural_check'\
+           , 'schema_validator', 'make_validator']
+
+DEFAULT_READ_SIZE = 64*1024
+
+# required children of elements checked by structural_check()
+# as (tag, min occurs) in document order
+REQUIRED_CHILDREN = {
+    NAMESPACE + 'Mail': [(NAMESPACE + 'Message', 1)],
+    NAMESPACE + 'Fetch': [(NAMESPACE + 'Credentials', 1)\
+                          , (NAMESPACE + 'To', 1)\
+                          , (NAMESPACE + 'Conditions', 1)],
+    NAMESPACE + 'Message': [(NAMESPACE + 'From', 1)\
+                            , (NAMESPACE + 'Subject', 1)],
+    NAMESPACE + 'Credentials': [(NAMESPACE + 'Username', 1)\
+                                , (NAMESPACE + 'Password', 1)],
+}
+CHECKED_CHILDREN = [NAMESPACE + 'Credentials', NAMESPACE + 'Message']
+CREDENTIALS_TAG = NAMESPACE + 'Credentials'
+USERNAME_TAG = NAMESPACE + 'Username'
+PASSWORD_TAG = NAMESPACE + 'Password'
+
+
+class ConnectionClosed(Exception) :
+    """Raised when peer closes connection before the message is received"""
+    pass
+
+
+class StructureError(ValueError) :
+    """Raised by structural_check() for malformed messages"""
+    pass
+
+
+class MessageTooBig(MemoryError) :
+    """Raised when received data exceeds the size limit of the message"""
+
+    def __init__(self, received, max_size) :
+        MemoryError.__init__(self\
+            , 'Message exceeds size limit of %d bytes' % max_size)
+        self.received = received
+        self.max_size = max_size
+
+
+def check_children(elem) :
+    counts = {}
+    for child in elem :
+        counts[child.tag] = counts.get(child.tag, 0) + 1
+    for tag, min_occurs in REQUIRED_CHILDREN.get(elem.tag, []) :
+        if counts.get(tag, 0) < min_occurs :
+            raise StructureError('Element %s requires %s' % (elem.tag, tag))
+
+def structural_check(root) :
+    """Fast replacement of schema validation for trusted peers:
+    checks root tag and presence of required children only"""
+    if not REQUIRED_CHILDREN.has_key(root.tag) \
+           or root.tag in CHECKED_CHILDREN :
+        raise StructureError('Unexpected root element %s' % root.tag)
+    check_children(root)
+    for child in root :
+        if child.tag in CHECKED_CHILDREN :
+            check_children(child)
+
+def schema_validator(schema) :
+    """Full validation with etree.XMLSchema"""
+    return schema.assertValid
+
+def make_validator(validation, schema) :
+    """Returns validator for one of VALIDATE_* modes or None"""
+    if validation == VALIDATE_STRUCTURAL :
+        return structural_check
+    if validation == VALIDATE_FULL and schema is not None :
+        return schema_validator(schema)
+    return None
+
+
+class MessageReader(object) :
+    """Incremental parser of one chaski message.
+
+    max_size -- MessageTooBig is raised when more data is fed
+    validator -- callable raising an exception for invalid messages
+                 or None
+    spiller -- Spiller of chapter contents or None
+    user_limit -- callable returning size limit of the username
+                  in chaski:Credentials (or None to keep max_size)
+    verify -- callable(username, password) returning True for valid
+              credentials, called by verify_user(), without it
+              user_limit may only lower max_size
+
+    Attributes defined:
+    validation_time -- seconds spent by validator on the message
+    raw -- RawMail of the received message (None with spiller)
+    spills -- Spills of the message contents (empty without spiller)
+
+    """
+    __slots__ = ['parser', 'received', 'max_size', 'depth'\
+                 , 'validator', 'validation_time', 'chunks', 'raw'\
+                 , 'builder', 'spills', 'user_limit', 'verify', 'root'\
+                 , 'unverified', 'deferred']
+
+    def __init__(self, max_size, validator=None, spiller=None\
+                 , user_limit=None, verify=None) :
+        self.builder = None
+        if spiller is not None :
+            self.builder = spiller.builder()
+            self.parser = etree.XMLParser(target=self.builder)
+        else :
+            self.parser = etree.XMLPullParser(events=('start', 'end'))
+        self.received = 0
+        self.max_size = max_size
+        self.depth = 0
+        self.validator = validator
+        self.validation_time = 0.0
+        self.chunks = []
+        self.raw = None
+        self.spills = {}
+        self.user_limit = user_limit
+        self.verify = verify
+        self.root = None # set while user_limit is not checked
+        # (username, password, max_size) while a raised limit is unverified
+        self.unverified = None
+        self.deferred = False
+
+    def feed(self, data) :
+        """Feed data to the parser raising MessageTooBig if overall
+        data received exceeds max_size.
+        Empty data means end of stream and raises ConnectionClosed.
+        Returns root element when whole message is received, None otherwise.
+        Spilled files of a message which failed are removed.
+
+        """
+        if self.builder is None :
+            return self.parse(data)
+        try:
+            root = self.parse(data)
+        except :
+            self.discard()
+            raise
+        if root is not None :
+            self.spills = self.builder.spills
+        return root
+
+    def discard(self) :
+        """Remove files spilled for the message being received"""
+        if self.builder is not None :
+            self.builder.discard()
+
+    def parse(self, data) :
+        if not data :
+            raise ConnectionClosed('Connection closed by peer')
+        self.received += len(data)
+        self.check_size()
+        if self.builder is not None :
+            self.parser.feed(data)
+            if self.user_limit is not None :
+                self.check_user(self.builder.root)
+            if self.builder.done :
+                return self.validate(self.parser.close())
+            return None
+        self.chunks.append(data)
+        self.parser.feed(data)
+        for act, elem in self.parser.read_events() :
+            if act == 'start' :
+                if self.user_limit is not None :
+                    if self.depth == 0 :
+                        self.root = elem
+                    else :
+                        self.check_user(self.root)
+                self.depth += 1
+            else :
+                self.depth -= 1
+                if self.depth == 0 :
+                    root = self.validate(self.parser.close())
+                    self.raw = RawMail(''.join(self.chunks), root)
+                    self.chunks = None
+                    return root
+        return None
+
+    def check_size(self) :
+        if self.received > self.max_size :
+            raise MessageTooBig(self.received, self.max_size)
+
+    def check_user(self, root) :
+        """Apply the limit of the user once chaski:Credentials
+        (the first child of the root) is parsed"""
+        if root is None or len(root) == 0 :
+            return
+        first = root[0]
+        if first.tag == CREDENTIALS_TAG :
+            if len(root) == 1 :
+                return # next sibling shows credentials are complete
+            username = first.findtext(USERNAME_TAG)
+            limit = self.user_limit(username)
+            if limit is not None and (limit < self.max_size\
+                                      or self.verify is not None) :
+                if limit > self.max_size :
+                    self.unverified = (username\
+                        , first.findtext(PASSWORD_TAG) or '', self.max_size)
+                self.max_size = limit
+        self.user_limit = None
+        self.root = None
+        self.check_size()
+
+    def verify_user(self) :
+        """Check the credentials the limit was raised for, if the
+        message needs it. Raises MessageTooBig (removing spilled files)
+        if verify refuses them. Call it from a worker thread."""
+        if self.unverified is None :
+            return
+        username, password, max_size = self.unverified
+        self.unverified = None
+        if self.received > max_size and not self.verify(username, password) :
+            self.discard()
+            raise MessageTooBig(self.received, max_size)
+
+    def defer_validation(self) :
+        """Leave the validator to check()"""
+        self.deferred = True
+
+    def check(self, root) :
+        """Worker part of receiving the message: run the deferred
+        validator and verify_user(). Spilled files of a message
+        which failed are removed."""
+        if self.deferred :
+            self.deferred = False
+            try:
+                self.validate(root)
+            except :
+                self.discard()
+                raise
+        self.verify_user()
+
+    def validate(self, root) :
+        if self.validator is not None and not self.deferred :
+            started = time.time()
+            try:
+                self.validator(root)
+            finally:
+                self.validation_time = time.time() - started
+        return root
+
+    def recv_size(self, read_size) :
+        """Amount of data to ask from socket: at most read_size
+        and never much more than message size limit allows"""
+        return max(1, min(read_size, self.max_size - self.received + 1))
+
+    def read_message(self, sock, read_size=DEFAULT_READ_SIZE) :
+        """Receive whole message from blocking socket"""
+        message = None
+        try:
+            while message is None :
+                message = self.feed(sock.recv(self.recv_size(read_size)))
+        except socket.error :
+            self.discard()
+            raise
+        return message
@@ -0,0 +1,434 @@
+"""Pooled connections to peer chaski servers
+
+SendMessage relays mails through a RelayPool. A connection is kept per
+(host, port) after the peer has answered with chaski:Result and is
+reused for next mails while it is idle less than idle_timeout. At most
+max_per_host mails are relayed to one peer at a time, by all threads
+of the process together.
+
+A mail is written with a non-blocking write loop and the peer's Result
+is read before the connection goes back to the pool, so a connection
+carries one mail at a time. Peers close connections after the Result
+unless they serve with keep_alive (see ChaskiConfig), such connections
+are noticed and dropped before they are used for the next mail.
+Closing may be noticed too late, so a mail is relayed again over a new
+connection if the reused one failed before the peer could have read
+the mail: nothing of it was sent or the connection was reset before
+any reply. Otherwise the peer might have stored it already.
+
+"""
+
+import time
+import socket
+import select
+import errno
+import threading
+from lxml import etree
+
+from chaski_reader import MessageReader, ConnectionClosed
+from chaski_const import STATUS_REJECTED
+
+__all__ = ['RelayPool', 'RelayConnection', 'Delivery', 'RelayError'\
+           , 'get_relay_pool']
+
+MAX_PER_HOST = 4
+IDLE_TIMEOUT = 60
+IO_TIMEOUT = 30
+# Result is small, anything bigger is not a Result
+RESULT_MAX_SIZE = 64*1024
+WRITE_SIZE = 64*1024
+READ_SIZE = 4096
+STATUS_OK = 'Success'
+POLL_ERROR_MASK = select.POLLHUP | select.POLLNVAL | select.POLLERR
+
+
+class RelayError(Exception) :
+    """Raised for failed relay connections"""
+    pass
+
+
+def to_bytes(chunk) :
+    if isinstance(chunk, memoryview) :
+        return chunk.tobytes()
+    return str(chunk)
+
+def child_text(elem, localname) :
+    """Text of the child regardless of its namespace"""
+    for child in elem :
+        if isinstance(child.tag, basestring) \
+               and etree.QName(child).localname == localname :
+            return child.text
+    return None
+
+
+class Delivery(object) :
+    """One mail to relay.
+
+    chunks -- mail bytes as an iterable of strings and buffers, read
+              only while the mail is written (again if it's retried)
+
+    Attributes defined after RelayPool.relay():
+    ok -- True if the peer accepted the mail
+    rejected -- True if the peer refused the mail before keeping
+                any of it (see STATUS_REJECTED)
+    answered -- True if the peer sent Result (False on errors)
+    description -- Description of peer's Result or error text
+
+    """
+    __slots__ = ['host', 'port', 'chunks', 'ok', 'rejected', 'answered'\
+                 , 'description', 'retried']
+
+    def __init__(self, host, port, chunks) :
+        self.host = host
+        self.port = port
+        self.chunks = chunks
+        self.ok = False
+        self.rejected = False
+        self.answered = False
+        self.description = None
+        self.retried = False
+
+    def key(self) :
+        return self.host, self.port
+
+
+class RelayConnection(object) :
+    """Non-blocking connection to a peer.
+
+    start(chunks) -- begin relaying a mail
+    events() -- poll() events the connection waits for
+    handle(mask) -- go on after poll() event, True when relaying ended
+
+    Attributes defined:
+    ok, rejected, description -- Status and Description of peer's Result
+    error -- exception relaying failed with or None
+    used -- number of mails relayed over the connection
+    sent -- number of bytes of the mail sent
+
+    """
+    RESET_ERRORS = (errno.ECONNRESET, errno.EPIPE)
+
+    def __init__(self, key, sock) :
+        self.key = key
+        self.sock = sock
+        sock.setblocking(False)
+        self.chunks = None # iterator of the mail's chunks not taken yet
+        self.buffer = memoryview('') # bytes taken but not sent
+        self.reader = None
+        self.ok = False
+        self.rejected = False
+        self.description = None
+        self.error = None
+        self.used = 0
+        self.sent = 0
+        self.idle_since = time.time()
+
+    def fileno(self) :
+        return self.sock.fileno()
+
+    def start(self, chunks) :
+        self.chunks = iter(chunks)
+        self.buffer = memoryview('')
+        self.reader = MessageReader(RESULT_MAX_SIZE)
+        self.ok = False
+        self.rejected = False
+        self.description = None
+        self.error = None
+        self.sent = 0
+
+    def writing(self) :
+        return self.chunks is not None or len(self.buffer) > 0
+
+    def events(self) :
+        if self.writing() :
+            return select.POLLOUT
+        return select.POLLIN
+
+    def handle(self, mask) :
+        try:
+            if self.writing() :
+                if mask & POLL_ERROR_MASK and not mask & select.POLLOUT :
+                    raise RelayError('Connection error, mask: %x' % mask)
+                self.write()
+                return False
+            return self.read()
+        except (socket.error, IOError, RelayError, ConnectionClosed\
+                , MemoryError, etree.Error), err :
+            self.error = err
+            return True
+
+    def fill(self) :
+        """Take chunks of the mail into the buffer up to WRITE_SIZE,
+        small chunks are joined (as send_chunks does) so they go out
+        in one send(). Returns False when the mail is sent."""
+        if self.chunks is not None and len(self.buffer) < WRITE_SIZE :
+            parts = [self.buffer.tobytes()]
+            size = len(self.buffer)
+            for chunk in self.chunks :
+                parts.append(to_bytes(chunk))
+                size += len(chunk)
+                if size >= WRITE_SIZE :
+                    break
+            else :
+                self.chunks = None
+            self.buffer = memoryview(''.join(parts))
+        return len(self.buffer) > 0
+
+    def check_open(self) :
+        """Raise ConnectionClosed if the peer has closed the connection"""
+        try:
+            if not self.sock.recv(1, socket.MSG_PEEK) :
+                raise ConnectionClosed('Connection closed by peer')
+        except socket.error, err :
+            if err.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK\
+                                   , errno.EINTR) :
+                raise
+
+    def write(self) :
+        """Write as much as the socket takes"""
+        if self.used and not self.sent :
+            self.check_open()
+        while self.fill() :
+            try:
+                sent = self.sock.send(self.buffer)
+            except socket.error, err :
+                if err.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK\
+                                   , errno.EINTR) :
+                    return
+                raise
+            self.sent += sent
+            self.buffer = self.buffer[sent:]
+
+    def read(self) :
+        try:
+            data = self.sock.recv(READ_SIZE)
+        except socket.error, err :
+            if err.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR) :
+                return False
+            raise
+        result = self.reader.feed(data)
+        if result is None :
+            return False
+        status = child_text(result, 'Status')
+        self.ok = status == STATUS_OK
+        self.rejected = status == STATUS_REJECTED
+        self.description = child_text(result, 'Description')
+        self.used += 1
+        return True
+
+    def unread(self) :
+        """True if the peer failed before it could have read the mail"""
+        if not self.sent :
+            return True
+        return self.reader.received == 0 \
+               and isinstance(self.error, socket.error) \
+               and self.error.args[0] in self.RESET_ERRORS
+
+    def idle(self) :
+        """True if peer hasn't closed the idle connection"""
+        poller = select.poll()
+        poller.register(self.sock, select.POLLIN)
+        return not poller.poll(0)
+
+    def close(self) :
+        try:
+            self.sock.close()
+        except socket.error :
+            pass
+
+
+class RelayPool(object) :
+    """Connections to peers shared by the threads of a process.
+
+    relay(deliveries) -- relay mails to their peers concurrently
+
+    Attributes defined:
+    connected, reused -- counters of new and pooled connections taken
+
+    """
+
+    def __init__(self, max_per_host=MAX_PER_HOST, idle_timeout=IDLE_TIMEOUT\
+                 , io_timeout=IO_TIMEOUT) :
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.io_timeout = io_timeout
+        self.lock = threading.Condition()
+        self.idle = {} # key -> RelayConnections in the order of release
+        self.active = {} # key -> number of connections taken
+        self.connected = 0
+        self.reused = 0
+
+    def connect(self, key) :
+        sock = socket.create_connection(key, self.io_timeout)
+        self.connected += 1
+        return RelayConnection(key, sock)
+
+    def acquire(self, key, wait=True) :
+        """Connection to the peer. Waits while max_per_host
+        connections to the peer are taken, returns None then
+        if not wait."""
+        self.lock.acquire()
+        try:
+            while self.active.get(key, 0) >= self.max_per_host :
+                if not wait :
+                    return None
+                self.lock.wait()
+            self.active[key] = self.active.get(key, 0) + 1
+            conn = None
+            idle = self.idle.get(key, [])
+            now = time.time()
+            while idle and conn is None :
+                candidate = idle.pop()
+                if now - candidate.idle_since < self.idle_timeout \
+                       and candidate.idle() :
+                    conn = candidate
+                else :
+                    candidate.close()
+        finally:
+            self.lock.release()
+        if conn is not None :
+            self.reused += 1
+            return conn
+        try:
+            return self.connect(key)
+        except :
+            self.release(key, None)
+            raise
+
+    def release(self, key, conn, reusable=False) :
+        """Give back the connection slot, keep the connection
+        for next mails if reusable"""
+        self.lock.acquire()
+        try:
+            self.active[key] -= 1
+            if conn is not None :
+                if reusable :
+                    conn.idle_since = time.time()
+                    self.idle.setdefault(key, []).append(conn)
+                else :
+                    conn.close()
+            self.lock.notifyAll()
+        finally:
+            self.lock.release()
+
+    def relay(self, deliveries) :
+        """Relay every mail to its peer. All the mails are written
+        and their Results read from one poll() loop. Mails to a peer
+        beyond max_per_host wait for a connection of the call to be
+        done with the previous mail. Returns when all the deliveries
+        are finished."""
+        poller = select.poll()
+        running = {} # fd -> (connection, delivery, deadline)
+        queues = {} # key -> deliveries waiting for a connection
+        for delivery in deliveries :
+            queues.setdefault(delivery.key(), []).append(delivery)
+
+        def start(conn, delivery) :
+            conn.start(delivery.chunks)
+            poller.register(conn, conn.events())
+            running[conn.fileno()] = (conn, delivery\
+                                      , time.time() + self.io_timeout)
+
+        def take(key, wait) :
+            """Start next mail to the peer on a new slot"""
+            queue = queues[key]
+            while queue :
+                try:
+                    conn = self.acquire(key, wait)
+                except socket.error, err :
+                    queue.pop(0).description = 'Failed to connect: %s' % err
+                    continue
+                if conn is not None :
+                    start(conn, queue.pop(0))
+                return conn
+            return None
+
+        def proceed(key, conn) :
+            """Start next mail to the peer in the slot of conn
+            or give the slot back"""
+            queue = queues[key]
+            while queue :
+                delivery = queue.pop(0)
+                # peer may have closed the connection after Result
+                if conn.error is not None or not conn.idle() :
+                    conn.close()
+                    conn.error = conn.error or RelayError('Closed by peer')
+                    try:
+                        conn = self.connect(key)
+                    except socket.error, err :
+                        delivery.description = 'Failed to connect: %s' % err
+                        continue
+                else :
+                    self.reused += 1
+                start(conn, delivery)
+                return
+            self.release(key, conn, conn.error is None)
+
+        # the first slots are taken in one order so threads
+        # don't wait for each other, the others only if free
+        for key in sorted(queues.keys()) :
+            if take(key, True) is not None :
+                while take(key, False) is not None :
+                    pass
+
+        while running :
+            timeout = min([deadline for conn, delivery, deadline\
+                           in running.values()]) - time.time()
+            try:
+                events = poller.poll(max(0, timeout) * 1000)
+            except select.error, err :
+                if err.args[0] == errno.EINTR :
+                    continue
+                raise
+            now = time.time()
+            finished = []
+            for fd, mask in events :
+                conn, delivery, deadline = running[fd]
+                if conn.handle(mask) :
+                    finished.append(fd)
+                else :
+                    poller.modify(fd, conn.events())
+                    running[fd] = (conn, delivery, now + self.io_timeout)
+            for fd, (conn, delivery, deadline) in running.items() :
+                if deadline <= now and fd not in finished :
+                    conn.error = RelayError('Timed out')
+                    finished.append(fd)
+            for fd in finished :
+                conn, delivery, deadline = running.pop(fd)
+                poller.unregister(fd)
+                key = delivery.key()
+                if conn.error is not None and conn.used \
+                       and conn.unread() and not delivery.retried :
+                    # reused connection was closed by peer
+                    delivery.retried = True
+                    queues[key].insert(0, delivery)
+                else :
+                    delivery.ok = conn.ok
+                    delivery.rejected = conn.rejected
+                    delivery.answered = conn.error is None
+                    if conn.error is not None :
+                        delivery.description = str(conn.error)
+                    else :
+                        delivery.description = conn.description
+                proceed(key, conn)
+        return deliveries
+
+    def __str__(self) :
+        return 'RelayPool: %d connected, %d reused' \
+               % (self.connected, self.reused)
+
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+def get_relay_pool(max_per_host=MAX_PER_HOST, idle_timeout=IDLE_TIMEOUT\
+                   , io_timeout=IO_TIMEOUT) :
+    """RelayPool with the settings shared in the process"""
+    key = (max_per_host, idle_timeout, io_timeout)
+    _POOLS_LOCK.acquire()
+    try:
+        try:
+            return _POOLS[key]
+        except KeyError :
+            return _POOLS.setdefault(key, RelayPool(*key))
+    finally:
+        _POOLS_LOCK.release()
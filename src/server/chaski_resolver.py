@@ -0,0 +1,155 @@
+"""Reverse DNS resolution with a TTL-bounded LRU cache"""
+
+import socket
+import threading
+import time
+import logging
+from collections import OrderedDict
+
+from chaski_pool import WorkerPool, PendingResult, CallTimeout
+
+__all__ = ['CachingResolver', 'HostTable', 'ResolveError']
+
+
+class ResolveError(Exception) :
+    """Raised when the answer is not available in time"""
+    pass
+
+
+class HostTable(object) :
+    """Stand-in for socket.gethostbyaddr() answering from a dict
+    {ip: [hostname, alias, ...]}"""
+
+    def __init__(self, table) :
+        self.table = table
+
+    def __call__(self, ip) :
+        try:
+            names = self.table[ip]
+        except KeyError :
+            raise socket.herror(1, 'Unknown host')
+        return names[0], list(names[1:]), [ip]
+
+
+class CachingResolver(object) :
+    """Resolves peer addresses to host names on a dedicated pool
+    of threads, caching answers.
+
+    ttl -- seconds to keep successful answers
+    negative_ttl -- seconds to keep failed lookups
+    max_entries -- cache size, least recently used answers are dropped
+    timeout -- seconds to wait for the lookup
+    workers -- lookup threads
+    lookup -- socket.gethostbyaddr() or a stand-in like HostTable
+
+    Attributes defined:
+    hits, negative_hits, misses, timeouts -- lookup counters
+
+    """
+
+    def __init__(self, ttl=300, negative_ttl=60, max_entries=10000\
+                 , timeout=5.0, workers=2, lookup=socket.gethostbyaddr) :
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.workers = workers
+        self.lookup = lookup
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.lock = threading.Lock()
+        self.cache = OrderedDict() # ip -> (expires, names)
+        self.pending = {} # ip -> PendingResult of lookup in progress
+        self.pool = None
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.timeouts = 0
+
+    def cached(self, ip) :
+        """Cached names for ip or None. Called with lock held."""
+        try:
+            expires, names = self.cache.pop(ip)
+        except KeyError :
+            return None
+        if expires < time.time() :
+            return None
+        self.cache[ip] = (expires, names) # most recently used now
+        return names
+
+    def store(self, ip, names) :
+        if names :
+            ttl = self.ttl
+        else :
+            ttl = self.negative_ttl
+        self.lock.acquire()
+        try:
+            self.pending.pop(ip, None)
+            self.cache.pop(ip, None)
+            self.cache[ip] = (time.time() + ttl, names)
+            while len(self.cache) > self.max_entries :
+                self.cache.popitem(last=False)
+        finally:
+            self.lock.release()
+
+    def resolve(self, ip) :
+        """Runs in the pool: returns [hostname, alias, ...]
+        or [] if ip can't be resolved"""
+        try:
+            hostname, aliases, ips = self.lookup(ip)
+        except socket.error, err :
+            self.logger.debug('Failed to resolve %s: %s', ip, err)
+            names = []
+        else :
+            names = list(aliases)
+            names.append(hostname)
+        self.store(ip, names)
+        return names
+
+    def names(self, ip) :
+        """Returns list of host names of ip, empty if it has none.
+        Raises ResolveError if lookup took longer than timeout.
+
+        """
+        self.lock.acquire()
+        try:
+            names = self.cached(ip)
+            if names is not None :
+                if names :
+                    self.hits += 1
+                else :
+                    self.negative_hits += 1
+                return names
+            self.misses += 1
+            result = self.pending.get(ip)
+            started = result is None
+            if started :
+                result = self.pending[ip] = PendingResult()
+                if self.pool is None :
+                    self.pool = WorkerPool(self.workers, self.max_entries\
+                                           , self.max_entries, self.logger)
+        finally:
+            self.lock.release()
+        if started and not self.pool.submit(result.run, self.resolve, (ip,)) :
+            result.run(self.resolve, (ip,))
+        try:
+            return result.get(self.timeout)
+        except CallTimeout :
+            self.lock.acquire()
+            self.timeouts += 1
+            self.lock.release()
+            raise ResolveError('Timed out resolving %s' % ip)
+
+    def stats(self) :
+        """Returns dict with cache size and lookup counters"""
+        self.lock.acquire()
+        try:
+            return {'entries': len(self.cache)
+                    , 'hits': self.hits
+                    , 'negative_hits': self.negative_hits
+                    , 'misses': self.misses
+                    , 'timeouts': self.timeouts}
+        finally:
+            self.lock.release()
+
+    def __str__(self) :
+        return 'CachingResolver: %s' % self.stats()
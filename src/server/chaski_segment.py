@@ -0,0 +1,529 @@
+"""Append-only segment storage of mail
+
+Messages are appended to segment files
+  <basedir>/segments/00000001.seg, 00000002.seg, ...
+each message once whatever number of recepients it has. Record of
+a message is its header (see make_header()) followed by the message.
+<basedir>/catalog is an append-only log of operations:
+  +  id segment offset length received header_length users
+  -  id user               -- user removed the message (tombstone)
+State of the store (places of messages and mailboxes) is built
+from the catalog once and then kept up to date reading only
+the appended lines.
+
+Segments holding mostly removed messages are compacted in background:
+live messages are copied to the active segment, catalog is rewritten
+and the old segments are deleted. Records are never changed in place,
+readers holding Records of the old places read the old segments
+(or relocate() once they are deleted). Writers flock() the catalog
+so the store could be shared by processes.
+
+"""
+
+import os
+import time
+import uuid
+import errno
+import logging
+import threading
+from datetime import date
+from collections import OrderedDict
+
+from chaski_const import PROCESS_OK
+from chaski_raw import message_bytes
+from chaski_plugin import ReceiveMessage, FetchMessage, FetchAborted\
+     , make_header, MAIL_HEAD, FLUSH, CHUNK_SIZE
+from chaski_store import makedirs, open_locked
+
+__all__ = ['ReceiveMessageToSegments', 'FetchMessagesFromSegments'\
+           , 'SegmentStore', 'Record', 'get_segment_store']
+
+CATALOG_NAME = 'catalog'
+SEGMENTS_DIR = 'segments'
+SEGMENT_NAME = '%08d.seg'
+SEGMENT_SIZE = 64*1024*1024
+# segments with less live data are compacted
+COMPACT_RATIO = 0.5
+COMPACT_INTERVAL = 60
+# catalog is rewritten when it has so many garbage lines
+# and they outnumber live messages
+CATALOG_GARBAGE = 1000
+
+OP_STORE = '+'
+OP_REMOVE = '-'
+SEP = '\t'
+USER_SEP = ','
+
+
+def write_all(fd, data) :
+    while data :
+        data = data[os.write(fd, data):]
+
+def disk_order(record) :
+    return record.segno, record.offset
+
+
+class Record(object) :
+    """Place and users of one stored message.
+    'length' is the length of whole record (header and message)."""
+    __slots__ = ['msgid', 'segno', 'offset', 'length', 'received'\
+                 , 'header_length', 'users']
+
+    def __init__(self, msgid, segno, offset, length, received\
+                 , header_length, users) :
+        self.msgid = msgid
+        self.segno = segno
+        self.offset = offset
+        self.length = length
+        self.received = received
+        self.header_length = header_length
+        self.users = users
+
+    def catalog_line(self) :
+        return SEP.join([OP_STORE, self.msgid, str(self.segno)\
+                         , str(self.offset), str(self.length)\
+                         , '%.3f' % self.received, str(self.header_length)\
+                         , USER_SEP.join(self.users)]) + '\n'
+
+    def key(self) :
+        """Paging key of the record ordered by receive time"""
+        return '%020.3f %s' % (self.received, self.msgid)
+
+    def whole(self) :
+        return self.offset, self.length
+
+    def header(self) :
+        return self.offset, self.header_length
+
+    def message(self) :
+        return self.offset + self.header_length\
+               , self.length - self.header_length
+
+
+class SegmentStore(object) :
+    """Segments and catalog of 'basedir'.
+
+    Methods defined:
+    store(usernames, rawdata, header) -- append message and its header
+    entries(username) -- Records of user's messages
+    read(records, onlyheader) -- (Record, chunk) of messages in disk order
+    remove(username, msgids) -- tombstone messages of the user
+    compact() -- compact sparse segments and the catalog
+
+    """
+
+    def __init__(self, basedir, segment_size=SEGMENT_SIZE\
+                 , compact_ratio=COMPACT_RATIO\
+                 , compact_interval=COMPACT_INTERVAL) :
+        self.basedir = basedir
+        self.catalog_path = os.path.join(basedir, CATALOG_NAME)
+        self.segments_dir = os.path.join(basedir, SEGMENTS_DIR)
+        self.segment_size = segment_size
+        self.compact_ratio = compact_ratio
+        self.compact_interval = compact_interval
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.lock = threading.RLock()
+        self.compactor = None
+        self.inode = None
+        self.reset()
+        makedirs(self.segments_dir)
+
+    def reset(self) :
+        self.offset = 0
+        self.records = OrderedDict() # msgid -> Record in catalog order
+        self.mailboxes = {} # username -> OrderedDict of msgid -> Record
+        self.active = 1
+        self.garbage = 0
+
+    def segment_path(self, segno) :
+        return os.path.join(self.segments_dir, SEGMENT_NAME % segno)
+
+    def apply(self, fields) :
+        op, msgid = fields[:2]
+        if op == OP_STORE :
+            users = fields[7].split(USER_SEP)
+            record = Record(msgid, int(fields[2]), int(fields[3])\
+                            , int(fields[4]), float(fields[5])\
+                            , int(fields[6]), set(users))
+            self.records[msgid] = record
+            for username in users :
+                self.mailboxes.setdefault(username, OrderedDict())[msgid]\
+                    = record
+            self.active = max(self.active, record.segno)
+            return
+        self.garbage += 1
+        record = self.records.get(msgid)
+        if op == OP_REMOVE and record is not None :
+            record.users.discard(fields[2])
+            self.mailboxes.get(fields[2], {}).pop(msgid, None)
+            if not record.users :
+                del self.records[msgid]
+
+    def refresh(self) :
+        """Apply catalog lines appended since last call"""
+        try:
+            catalog = open(self.catalog_path, 'rb')
+        except IOError, err :
+            if err.errno == errno.ENOENT :
+                return
+            raise
+        try:
+            inode = os.fstat(catalog.fileno()).st_ino
+            if inode != self.inode :
+                self.inode = inode
+                self.reset()
+            catalog.seek(self.offset)
+            data = catalog.read()
+        finally:
+            catalog.close()
+        complete = data.rfind('\n') + 1 # skip line being written
+        for line in data[:complete].splitlines() :
+            if line :
+                self.apply(line.split(SEP))
+        self.offset += complete
+
+    def open_append(self, length) :
+        """Open the active segment for appending length bytes,
+        the catalog should be locked. Returns (fd, segment, offset)"""
+        try:
+            size = os.path.getsize(self.segment_path(self.active))
+        except OSError :
+            size = 0
+        if size and size + length > self.segment_size :
+            self.active += 1
+        fd = os.open(self.segment_path(self.active)\
+                     , os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        return fd, self.active, os.fstat(fd).st_size
+
+    def append_data(self, rawdata) :
+        """Append data to the active segment, the catalog
+        should be locked. Returns (segment, offset)"""
+        fd, segno, offset = self.open_append(len(rawdata))
+        try:
+            write_all(fd, rawdata)
+        finally:
+            os.close(fd)
+        return segno, offset
+
+    def store(self, usernames, rawdata, header) :
+        """Append message for all the users"""
+        users = []
+        for username in usernames :
+            if username not in users :
+                users.append(username)
+        fd = open_locked(self.catalog_path)
+        try:
+            self.lock.acquire()
+            try:
+                self.refresh()
+                segno, offset = self.append_data(header + rawdata)
+                record = Record(uuid.uuid4().hex, segno, offset\
+                                , len(header) + len(rawdata), time.time()\
+                                , len(header), users)
+                write_all(fd, record.catalog_line())
+                self.refresh()
+            finally:
+                self.lock.release()
+        finally:
+            os.close(fd)
+        self.start_compactor()
+        return record
+
+    def entries(self, username) :
+        self.lock.acquire()
+        try:
+            self.refresh()
+            return self.mailboxes.get(username, {}).values()
+        finally:
+            self.lock.release()
+
+    def relocate(self, records) :
+        """Current places of records (after compaction)"""
+        self.lock.acquire()
+        try:
+            self.refresh()
+            return [self.records[r.msgid] for r in records\
+                    if self.records.has_key(r.msgid)]
+        finally:
+            self.lock.release()
+
+    def read_records(self, records, part, chunk_size=None) :
+        """Yields (Record, chunk) of part(record) of the records
+        in disk order. Part is read in one chunk if chunk_size is None."""
+        records = sorted(records, key=disk_order)
+        relocated = False
+        segment = None
+        segno = None
+        i = 0
+        try:
+            while i < len(records) :
+                record = records[i]
+                if segno != record.segno :
+                    if segment is not None :
+                        segment.close()
+                        segment = None
+                        segno = None
+                    try:
+                        segment = open(self.segment_path(record.segno), 'rb')
+                    except IOError, err :
+                        if err.errno != errno.ENOENT or relocated :
+                            raise
+                        # segment was compacted meanwhile
+                        records = sorted(self.relocate(records[i:])\
+                                         , key=disk_order)
+                        relocated = True
+                        i = 0
+                        continue
+                    segno = record.segno
+                offset, length = part(record)
+                segment.seek(offset)
+                while length > 0 :
+                    chunk = segment.read(min(chunk_size or length, length))
+                    if not chunk :
+                        raise IOError('Segment %d is truncated' % segno)
+                    length -= len(chunk)
+                    yield record, chunk
+                i += 1
+        finally:
+            if segment is not None :
+                segment.close()
+
+    def read(self, records, onlyheader=False, chunk_size=None) :
+        """Read messages (or headers only) in disk order so bulk
+        reads are sequential. Yields (Record, chunk)."""
+        if onlyheader :
+            part = Record.header
+        else :
+            part = Record.message
+        return self.read_records(records, part, chunk_size)
+
+    def remove(self, username, msgids) :
+        """Record tombstones of user's messages"""
+        fd = open_locked(self.catalog_path)
+        try:
+            write_all(fd, ''.join([SEP.join([OP_REMOVE, msgid, username])\
+                                   + '\n' for msgid in msgids]))
+        finally:
+            os.close(fd)
+
+    def compact(self) :
+        """Move live messages out of sparse segments, rewrite
+        the catalog and delete the segments.
+        Returns number of deleted segments."""
+        fd = open_locked(self.catalog_path)
+        try:
+            self.lock.acquire()
+            try:
+                self.refresh()
+                victims = self.sparse_segments()
+                if not victims and (self.garbage < CATALOG_GARBAGE \
+                                    or self.garbage < len(self.records)) :
+                    return 0
+                moved = self.move([r for r in self.records.values()\
+                                   if r.segno in victims])
+                self.rewrite_catalog(moved)
+            finally:
+                self.lock.release()
+        finally:
+            os.close(fd)
+        for segno in victims :
+            os.remove(self.segment_path(segno))
+        self.logger.info('Compacted %d segments, %d messages moved'\
+                         , len(victims), len(moved))
+        return len(victims)
+
+    def move(self, records) :
+        """Copy records to the active segment chunk by chunk, the catalog
+        should be locked. Returns msgid -> new Record"""
+        moved = {}
+        out = None
+        try:
+            for record, chunk in self.read_records(records, Record.whole\
+                                                   , CHUNK_SIZE) :
+                if not moved.has_key(record.msgid) :
+                    if out is not None :
+                        os.close(out)
+                        out = None
+                    out, segno, offset = self.open_append(record.length)
+                    moved[record.msgid] = Record(record.msgid, segno\
+                        , offset, record.length, record.received\
+                        , record.header_length, set(record.users))
+                write_all(out, chunk)
+        finally:
+            if out is not None :
+                os.close(out)
+        return moved
+
+    def sparse_segments(self) :
+        live = {}
+        for record in self.records.values() :
+            live[record.segno] = live.get(record.segno, 0) + record.length
+        victims = []
+        for name in os.listdir(self.segments_dir) :
+            try:
+                segno = int(name.split('.')[0])
+            except ValueError :
+                continue
+            if segno == self.active :
+                continue
+            size = os.path.getsize(self.segment_path(segno))
+            if live.get(segno, 0) < size * self.compact_ratio :
+                victims.append(segno)
+        return victims
+
+    def rewrite_catalog(self, moved) :
+        """Write catalog of live records with new places of moved ones,
+        the state is then rebuilt from it with new Records"""
+        tmpname = '%s.%d.tmp' % (self.catalog_path, os.getpid())
+        out = open(tmpname, 'wb')
+        try:
+            for record in self.records.values() :
+                out.write(moved.get(record.msgid, record).catalog_line())
+        finally:
+            out.close()
+        os.rename(tmpname, self.catalog_path)
+        self.inode = None
+        self.refresh()
+
+    def start_compactor(self) :
+        if self.compactor is not None or self.compact_interval <= 0 :
+            return
+        self.lock.acquire()
+        try:
+            if self.compactor is None :
+                self.compactor = threading.Thread(target=self.compact_forever)
+                self.compactor.setDaemon(True)
+                self.compactor.start()
+        finally:
+            self.lock.release()
+
+    def compact_forever(self) :
+        while True :
+            time.sleep(self.compact_interval)
+            try:
+                self.compact()
+            except (IOError, OSError), err :
+                self.logger.error('Compaction failed: %s', err)
+
+_STORES = {}
+_STORES_LOCK = threading.Lock()
+
+def get_segment_store(basedir, **params) :
+    """SegmentStore of basedir shared in the process"""
+    key = os.path.abspath(basedir)
+    _STORES_LOCK.acquire()
+    try:
+        try:
+            return _STORES[key]
+        except KeyError :
+            return _STORES.setdefault(key, SegmentStore(basedir, **params))
+    finally:
+        _STORES_LOCK.release()
+
+def segment_store(params) :
+    return get_segment_store(params['basedir']\
+        , segment_size=int(params.get('segment_size', SEGMENT_SIZE))\
+        , compact_ratio=float(params.get('compact_ratio', COMPACT_RATIO))\
+        , compact_interval=float(params.get('compact_interval'\
+                                            , COMPACT_INTERVAL)))
+
+
+class ReceiveMessageToSegments(ReceiveMessage) :
+    """Plugin for storing messages in append-only segments.
+    It's brother plugin for FetchMessagesFromSegments
+
+    Message is written once whatever number of recepients it has.
+    The plugin works in assumption that authentification is done
+    by previous plugin(s).
+
+    Plugin parameters:
+      basedir -- directory of the catalog and segments
+      segment_size -- bytes in segment before the next one is started
+      compact_ratio -- segments with less live data are compacted (0.5)
+      compact_interval -- seconds between compactions, 0 to disable (60)
+
+    """
+
+    def __init__(self, params) :
+        ReceiveMessage.__init__(self, params)
+        self.segments = segment_store(params)
+
+    def store(self, usernames, message) :
+        if usernames :
+            self.segments.store(usernames, message_bytes(message)\
+                                , make_header(message))
+        return PROCESS_OK, message
+
+
+class FetchMessagesFromSegments(FetchMessage) :
+    """Plugin for fetching messages from append-only segments.
+    It's brother plugin for ReceiveMessageToSegments
+
+    Messages of an account are read in the order they lie in
+    segments. RemoveAfterFetch leaves tombstones, the space
+    is reclaimed by compaction.
+
+    Plugin parameters are the same as of ReceiveMessageToSegments.
+
+    """
+
+    def __init__(self, params) :
+        FetchMessage.__init__(self, params)
+        self.segments = segment_store(params)
+
+    def fetch(self, recepients, cond) :
+        if cond.onlyheaders :
+            part = Record.header
+        else :
+            part = Record.message
+        yield MAIL_HEAD
+        removed = []
+        for account in cond.accounts(recepients) :
+            candidates = [(r.key(), r) for r in self.segments.entries(account)\
+                          if cond.mindate <= date.fromtimestamp(r.received)\
+                          <= cond.maxdate]
+            candidates.sort()
+            # the page is selected in receive order and read in disk order
+            records = []
+            for key, record in candidates :
+                if cond.before_cursor(account, key) :
+                    continue
+                if cond.onlyheaders :
+                    size = record.header_length
+                else :
+                    size = record.length - record.header_length
+                if not cond.admit(account, key, size) :
+                    break
+                records.append(record)
+            fetched = []
+            left = 0 # bytes of the message being sent
+            try:
+                for record, chunk in self.segments.read(records\
+                        , cond.onlyheaders, CHUNK_SIZE) :
+                    if not fetched or fetched[-1] != record.msgid :
+                        fetched.append(record.msgid)
+                        left = part(record)[1]
+                    left -= len(chunk)
+                    yield chunk
+            except IOError, errmes :
+                if left > 0 :
+                    raise FetchAborted('Failed in the middle of a message:'\
+                                       ' %s' % errmes)
+                # rest of the account is skipped, sent messages
+                # are still removed
+                self.logger.error(errmes)
+            self.logger.debug('fetched %d messages of %s'\
+                              , len(fetched), account)
+            removed.append((account, fetched))
+            if cond.next_cursor is not None :
+                break
+        yield cond.mail_tail()
+        yield FLUSH
+
+        if cond.removeafter :
+            for account, fetched in removed :
+                try:
+                    if fetched :
+                        self.segments.remove(account, fetched)
+                except (IOError, OSError), err :
+                    self.logger.error(err)
@@ -7,47 +7,53 @@ Usage: chaski.py [-c configfile]
 
 import os
 import sys
-import thread
+import time
+import Queue
 import select
 import socket
+import errno
 import array
 from getopt import getopt
 import logging
 from lxml import etree
 
 from chaski_config import ChaskiConfig
-from chaski_const import DEFAULT_CFG, PROCESS_FAIL, PROCESS_OK, RESULT_MESSAGE
+from chaski_engine import EventLoopServer
+from chaski_reader import MessageTooBig
+from chaski_raw import register as register_raw, release as release_raw\
+     , open_context, replace as replace_raw
+from chaski_pool import WorkerPool
+from chaski_prefork import PreforkMaster
+from chaski_const import DEFAULT_CFG, PROCESS_FAIL, PROCESS_OK, RESULT_MESSAGE\
+     , SERVE_THREAD, SERVE_POLL, STATUS_REJECTED
 
 
-class SockWrapper(object) :
-    """A socket wrapper implementing read amount limitation and read() method"""
-    
-    def __init__(self, sock, max_size) :
-        self.s = sock
-        self.max_size = max_size
-        self.current = 0
-
-    def read(self, size=256) :
-        """Read at most 'size' data from socket raising MemoryError
-        if overall data read exceeds max_size
-
-        """
-        if (self.current >= self.max_size) :
-            raise MemoryError('Read to much data %d/%d' \
-                              % (self.current, self.max_size))
-        data = self.s.recv(size)
-        self.current += len(data)
-        return data
-
-
-def fetch_message(sock, max_message_len, schema) :
-    w = SockWrapper(sock, max_message_len)
-    context = etree.iterparse(w, events=("start", "end"), schema=schema)
-    act, root_elem = context.next()
-    elem = None
-    while elem != root_elem:
-        act, elem = context.next()
-    return root_elem
+def fetch_message(sock, reader, read_size, logger) :
+    """Receive, parse and validate one message from blocking socket"""
+    message = reader.read_message(sock, read_size)
+    reader.check(message)
+    log_validation(reader, logger)
+    register_raw(message, reader.raw, reader.spills)
+    return message
+
+def wait_message(sock, timeout) :
+    """Wait for the next message of kept alive connection.
+    Returns False (and closes the socket) if the client has closed
+    the connection or stayed idle for timeout seconds."""
+    poller = select.poll()
+    poller.register(sock, select.POLLIN)
+    try:
+        events = poller.poll(timeout * 1000)
+        if events and sock.recv(1, socket.MSG_PEEK) :
+            return True
+    except (select.error, socket.error) :
+        pass
+    close_socket(sock)
+    return False
+
+def log_validation(reader, logger) :
+    logger.debug('Message of %d bytes validated in %.3f ms'\
+                 , reader.received, reader.validation_time * 1000)
 
 def get_success_response(descriprion_text='Success') :
     return RESULT_MESSAGE % ('Success', descriprion_text)
@@ -55,61 +61,143 @@ def get_success_response(descriprion_text='Success') :
 def get_fail_response(descriprion_text) :
     return RESULT_MESSAGE % ('Fail', descriprion_text)
 
+def get_reject_response(descriprion_text) :
+    """Result for the mail nothing of which has been kept"""
+    return RESULT_MESSAGE % (STATUS_REJECTED, descriprion_text)
+
+def respond(sock, mes, keep_alive=False) :
+    """Send result to the client closing the connection unless
+    keep_alive. socket.error is raised if a kept connection failed."""
+    if keep_alive :
+        sock.sendall(mes)
+    else :
+        send_mes_and_close(sock, mes)
+
 def send_mes_and_close(sock, mes) :
     try:
-        sock.send(mes)
+        sock.sendall(mes)
     except socket.error :
         pass
     finally:
-        try:
-            sock.close()
-        except socket.error :
-            pass
+        close_socket(sock)
 
-def run_plugins(plugins, message, sock, logger) :
-    if len(plugins) > 0 :
-        head = plugins[0]
-        logger.debug('running plugin %s', head.__class__)
-        status, out_message = head.process(message, sock)
-        if status == PROCESS_OK :
-            return run_plugins(plugins[1:], out_message, sock, logger)
+def close_socket(sock) :
+    try:
+        sock.close()
+    except socket.error :
+        pass
+
+def run_plugins(plugins, message, sock, logger, keep_alive=False) :
+    """Run plugins one by one sharing MailContext of the message.
+    Failure is reported as rejection until a plugin which stores
+    the mail has run."""
+    context = open_context(message)
+    stored = False
+    try:
+        for plugin in plugins :
+            logger.debug('running plugin %s', plugin.__class__)
+            stored = stored or plugin.stores
+            status, out_message = plugin.process(message, sock)
+            if status != PROCESS_OK :
+                if stored :
+                    response = get_fail_response(out_message)
+                else :
+                    response = get_reject_response(out_message)
+                respond(sock, response, keep_alive)
+                logger.info('%s plugin refused message with status %s: %s'\
+                         , plugin, status, out_message)
+                if logger.getEffectiveLevel() <= logging.DEBUG :
+                    logger.debug('on message %s', etree.tostring(message))
+                return False
+            if out_message is not message :
+                context = replace_raw(message, out_message)
+                message = out_message
+            elif plugin.mutates :
+                context.invalidate()
+        respond(sock, get_success_response(), keep_alive)
+        return True
+    finally:
+        logger.debug('mail serialized %d times', context.serializations)
+        release_raw(message)
+
+def handle_message(message, sock, logger, conf) :
+    """Run matching plugins on already received message.
+    Returns True if the connection is kept for the next message."""
+    try:
+        if conf.match_workers > 0 :
+            # match()es run in parallel and process()es start upon
+            # match() end, rest of the pipeline is cancelled on failure
+            actual_plugins = conf.dispatch.pipeline(message)
+            try:
+                run_plugins(actual_plugins, message, sock, logger\
+                            , conf.keep_alive)
+            finally:
+                actual_plugins.close()
         else :
-            send_mes_and_close(sock, get_fail_response(out_message))
-            logger.info('%s plugin refused message with status %s: %s'\
-                     , head, status, out_message)
-            if logger.getEffectiveLevel() <= logging.DEBUG :
-                logger.debug('on message %s', etree.tostring(message))
-            return False
+            actual_plugins = conf.dispatch.resolve(message)
+            run_plugins(actual_plugins, message, sock, logger\
+                        , conf.keep_alive)
+    except socket.error, err :
+        logger.info('Connection lost: %s', err)
+        close_socket(sock)
+        return False
+    finally:
+        release_raw(message)
+    return conf.keep_alive
+
+def reject_message(sock, address_info, logger, ex) :
+    """Report message which failed to be received to the sender"""
+    logger.info('Failed to fetch message from %s. Reason: %s'
+              , address_info[0], ex)
+    if isinstance(ex, MessageTooBig) :
+        description = str(ex)
     else :
-        send_mes_and_close(sock, get_success_response())
-        return True
+        description = 'Bad xml: %s' % ex
+    send_mes_and_close(sock, get_reject_response(description))
 
-def process_message(connection, logger, conf) :
+def reject_overloaded(sock, address_info, logger, pool) :
+    """Refuse connection which the worker pool has no room for"""
+    logger.warning('Overloaded, refusing connection from %s. %s'
+                   , address_info[0], pool)
+    send_mes_and_close(sock, get_reject_response(OVERLOAD_DESCRIPTION))
+
+def make_pool(logger, conf) :
+    return WorkerPool(conf.workers, conf.queue_size, conf.max_in_flight\
+                      , logger)
+
+def process_message(connection, listener, logger, conf, park=None) :
     """Process one chaski message.
 
     connection -- result of socket.accept()
+    listener -- Listener the connection was accepted on
     logger -- an open logger class
     conf -- ChaskiConfig instance
+    park -- called with (connection, listener) kept alive after
+            the message, without it the worker itself waits for
+            the next message
     returns None
     
     """
 
     sock, address_info = connection
-    logger.debug('Starting message processing from %s:%d', *address_info)
-    try:
-        message = fetch_message(sock, conf.max_message_size, conf.schema)
-    except Exception, ex :
-        logger.info('Failed to fetch message from %s. Reason: %s'
-                  , address_info[0], ex)
-        send_mes_and_close(sock, get_fail_response('Bad xml: %s' % ex))
-    else :
-        # these 2 actions could be pipelined 
-        # i.e. run match()es fully parallel and run process()es upon
-        # match() end if possible
-        actual_plugins = filter(lambda plugin: plugin.match(message) \
-                                , conf.plugins)
-        run_plugins(actual_plugins, message, sock, logger)
-    logger.debug('Message processing finished')
+    keep = True
+    while keep :
+        logger.debug('Starting message processing from %s:%d'\
+                     , *address_info)
+        try:
+            message = fetch_message(sock, conf.size_limits.reader(listener\
+                , address_info[0], conf.spiller), conf.read_size, logger)
+        except Exception, ex :
+            reject_message(sock, address_info, logger, ex)
+            keep = False
+        else :
+            keep = handle_message(message, sock, logger, conf)
+            if keep and park is not None :
+                park(connection, listener)
+                keep = False
+            else :
+                keep = keep and wait_message(sock, conf.keep_alive_timeout)
+        logger.debug('Message processing finished')
 
         
 def demonize() :
@@ -120,9 +208,25 @@ def exit_gently():
     """Exit from application waiting all threads to finish"""
     sys.exit()
 
-def init_serv_sock(portnum, listen_backlog) :
-    """Init listening TCP socket"""
+def init_serv_socks(listeners, listen_backlog, logger, reuse_port=False) :
+    """Init listening sockets for all listeners.
+    Returns list of (socket, listener)"""
+    servers = []
+    for listener in listeners :
+        logger.info('Creating server socket on port %d', listener.port)
+        servers.append((init_serv_sock(listener.port, listen_backlog\
+                                       , reuse_port), listener))
+    return servers
+
+def init_serv_sock(portnum, listen_backlog, reuse_port=False) :
+    """Init listening TCP socket.
+    With reuse_port several processes may bind the same port
+    and kernel balances connections between them.
+
+    """
     s = socket.socket()
+    if reuse_port :
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     s.bind(('', portnum)) # INADDR_ANY
     s.listen(listen_backlog)
     return s
@@ -130,41 +234,197 @@ def init_serv_sock(portnum, listen_backlog) :
 def get_config(filename) :
     return ChaskiConfig(file(filename).read())
 
+class IdleConnections(object) :
+    """Kept alive connections of thread mode waiting for their next
+    message in the accept loop, so they don't hold workers.
+
+    park(connection, listener) -- called by a worker for the kept
+                  alive connection
+    resume() -- wait for connections parked since the last call,
+                  called when wakeup_fd is readable
+    readable(fd) -- (connection, listener) with the next message
+                  or None if the client closed the connection
+    close_idle() -- close connections idle for keep_alive_timeout
+
+    """
+
+    def __init__(self, poller, timeout, logger) :
+        self.poller = poller
+        self.timeout = timeout
+        self.logger = logger
+        self.parked = Queue.Queue()
+        self.waiting = {} # fd -> (connection, listener, deadline)
+        self.wakeup_fd, self.wakeup_write_fd = os.pipe()
+        poller.register(self.wakeup_fd, select.POLLIN)
+
+    def park(self, connection, listener) :
+        self.parked.put((connection, listener))
+        os.write(self.wakeup_write_fd, 'x')
+
+    def resume(self) :
+        os.read(self.wakeup_fd, 4096)
+        try:
+            while True :
+                connection, listener = self.parked.get_nowait()
+                fd = connection[0].fileno()
+                self.waiting[fd] = (connection, listener\
+                                    , time.time() + self.timeout)
+                self.poller.register(fd, select.POLLIN)
+        except Queue.Empty :
+            pass
+
+    def readable(self, fd) :
+        connection, listener, deadline = self.waiting.pop(fd)
+        self.poller.unregister(fd)
+        try:
+            if connection[0].recv(1, socket.MSG_PEEK) :
+                return connection, listener
+        except socket.error :
+            pass
+        close_socket(connection[0])
+        return None
+
+    def close_idle(self) :
+        """Returns milliseconds till the next deadline or None"""
+        now = time.time()
+        deadlines = []
+        for fd, (connection, listener, deadline) in self.waiting.items() :
+            if deadline <= now :
+                self.logger.debug('Closing idle connection from %s:%d'\
+                                  , *connection[1])
+                del self.waiting[fd]
+                self.poller.unregister(fd)
+                close_socket(connection[0])
+            else :
+                deadlines.append(deadline)
+        if not deadlines :
+            return None
+        return (min(deadlines) - now) * 1000
+
+def serve_threads(servers, logger, conf) :
+    """Accept loop handing every connection over to the worker pool.
+    Kept alive connections wait for the next message in the loop."""
+    pool = make_pool(logger, conf)
+    poller = select.poll()
+    idle = IdleConnections(poller, conf.keep_alive_timeout, logger)
+    by_fd = {}
+    for serv_sock, listener in servers :
+        serv_sock.setblocking(False)
+        poller.register(serv_sock)
+        by_fd[serv_sock.fileno()] = (serv_sock, listener)
+
+    def submit(connection, listener) :
+        if not pool.submit(process_message, connection, listener\
+                           , logger, conf, idle.park) :
+            reject_overloaded(connection[0], connection[1], logger, pool)
+
+    while True :
+        # poll returns list of (fd, bitmask)
+        for fd, res_mask in poller.poll(idle.close_idle()) :
+            if fd == idle.wakeup_fd :
+                idle.resume()
+                continue
+            if idle.waiting.has_key(fd) :
+                kept = idle.readable(fd)
+                if kept is not None :
+                    submit(*kept)
+                continue
+            if res_mask & ERROR_MASK :
+                logger.error('An error occured while waiting for connection.'\
+                          + ' Error mask: %x', res_mask)
+                exit_gently()
+            serv_sock, listener = by_fd[fd]
+            try:
+                connection = serv_sock.accept()
+            except socket.error, (err, errtext) :
+                # another prefork worker was faster
+                if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR) :
+                    continue
+                raise
+            connection[0].setblocking(True)
+            submit(connection, listener)
+
+def serve_event_loop(servers, logger, conf) :
+    """Serve all connections from one poll() loop,
+    running plugins in the worker pool"""
+    pool = make_pool(logger, conf)
+    def on_message(message, sock, address_info) :
+        logger.debug('Starting message processing from %s:%d'\
+                     , *address_info)
+        keep = handle_message(message, sock, logger, conf)
+        logger.debug('Message processing finished')
+        return keep
+
+    def on_error(sock, address_info, ex) :
+        reject_message(sock, address_info, logger, ex)
+
+    def on_overload(sock, address_info) :
+        reject_overloaded(sock, address_info, logger, pool)
+
+    EventLoopServer(servers, conf, logger, pool\
+                    , on_message, on_error, on_overload).serve_forever()
+    exit_gently()
+
+SERVE_FUNCTIONS = {SERVE_THREAD: serve_threads, SERVE_POLL: serve_event_loop}
+
+def serve(servers, logger, conf) :
+    logger.info('Start listening in %s mode', conf.serve_mode);
+    SERVE_FUNCTIONS[conf.serve_mode](servers, logger, conf)
+
+def serve_prefork(config_file, logger, conf) :
+    """Fork conf.processes workers each serving with its own
+    configuration and plugin instances.
+    Listening sockets are either shared by all the workers or,
+    with conf.reuse_port, opened by every worker on its own.
+
+    """
+    if conf.reuse_port :
+        servers = None
+    else :
+        servers = init_serv_socks(conf.listeners, LISTEN_BACKLOG, logger)
+
+    def worker() :
+        worker_conf = get_config(config_file)
+        if servers is None :
+            worker_servers = init_serv_socks(worker_conf.listeners\
+                                             , LISTEN_BACKLOG, logger, True)
+        else :
+            # listeners of the worker's own configuration
+            worker_servers = zip([sock for sock, listener in servers]\
+                                 , worker_conf.listeners)
+        serve(worker_servers, logger, worker_conf)
+
+    PreforkMaster(conf.processes, worker, logger).run()
+
+ERROR_MASK = select.POLLHUP | select.POLLNVAL | select.POLLERR
+OVERLOAD_DESCRIPTION = 'Server is overloaded, try again later'
+LISTEN_BACKLOG = 10
+
 # here routines are finished and real code starts
 OPTION_STRING = 'c:'
 USAGE = 'Usage:  %s [-c <configfile>]' % (sys.argv[0])
 
-if len(sys.argv) > 1 :
-    try:
-        result = getopt(sys.argv[1:], OPTION_STRING)
-        config_file = result[0][0][1]
-    except IndexError :
-        print USAGE
-        sys.exit(1)
-else :
-    config_file = DEFAULT_CFG
-
+if __name__ == '__main__' :
+    if len(sys.argv) > 1 :
+        try:
+            result = getopt(sys.argv[1:], OPTION_STRING)
+            config_file = result[0][0][1]
+        except IndexError :
+            print USAGE
+            sys.exit(1)
+    else :
+        config_file = DEFAULT_CFG
 
-print 'fetch configuration from file %s' % config_file
-conf = get_config(config_file)
-print conf
-logger = logging.getLogger('chaski_server')
 
-demonize()
+    print 'fetch configuration from file %s' % config_file
+    conf = get_config(config_file)
+    print conf
+    logger = logging.getLogger('chaski_server')
 
-logger.info('Creating server socket on port %d', conf.port)
-serv_sock = init_serv_sock(conf.port, 10)
-poller = select.poll()
-poller.register(serv_sock)
-logger.info('Start listening');
+    demonize()
 
-ERROR_MASK = select.POLLHUP | select.POLLNVAL | select.POLLERR
-while True :
-    poll_res = poller.poll()
-    # poll returns list of (fd, bitmask)
-    res_mask = poll_res[0][1]
-    if res_mask & ERROR_MASK :
-        logger.error('An error occured while waiting for connection.'\
-                  + ' Error mask: %x', res_mask)
-        exit_gently()
-    thread.start_new_thread(process_message, (serv_sock.accept(), logger, conf))
+    if conf.processes > 1 :
+        serve_prefork(config_file, logger, conf)
+    else :
+        serve(init_serv_socks(conf.listeners, LISTEN_BACKLOG, logger)\
+              , logger, conf)
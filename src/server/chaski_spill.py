@@ -0,0 +1,236 @@
+"""Chapter contents spilled to temporary files while mails are parsed
+
+MessageReader given a Spiller parses with SpillingBuilder (a parser
+target): text of chaski:ChapterContent growing over 'threshold' bytes
+is written to a temporary file in 'spill_dir' as it is received
+instead of into the tree, so memory held by a connection is bounded
+by the headers of the mail, not by its attachments. With 'decode'
+base64 contents are decoded on the way to the file.
+
+The element is left empty in the tree and its Spill is kept in
+the MailContext of the mail (see chaski_raw): message_chunks() streams
+the content back from the file (escaped or base64 encoded again) and
+content_size() reads the size from the Spill. The files are removed
+when the MailContext is released. Plugins reading ChapterContent text
+themselves don't see spilled contents.
+
+"""
+
+import os
+import errno
+import base64
+import binascii
+import tempfile
+from xml.sax.saxutils import escape
+from lxml import etree
+
+from chaski_const import NAMESPACE
+
+__all__ = ['Spill', 'SpillingBuilder', 'Spiller', 'make_spiller']
+
+CONTENT_TAG = NAMESPACE + 'ChapterContent'
+BASE64 = 'base64'
+HEX = 'hex'
+SPILL_PREFIX = 'chaski-'
+# decoded bytes encoded at once, multiple of 3 gives no padding inside
+ENCODE_SIZE = 48*1024
+READ_SIZE = 64*1024
+
+
+class Spill(object) :
+    """Content of one ChapterContent element in a temporary file.
+
+    Attributes defined:
+    path -- the file
+    decoded -- True if the file holds decoded base64 data
+    text_size -- size of the content as XML text
+
+    """
+
+    def __init__(self, spill_dir, encoding, decode) :
+        fd, self.path = tempfile.mkstemp(prefix=SPILL_PREFIX, dir=spill_dir)
+        self.out = os.fdopen(fd, 'wb')
+        self.encoding = encoding
+        self.decoded = decode and encoding == BASE64
+        self.pending = '' # base64 text not decoded yet
+        self.written = 0
+        self.chars = 0 # encoded characters without whitespace
+        self.tail = '' # last encoded characters (for padding)
+        self.text_size = 0
+
+    def write(self, text) :
+        if isinstance(text, unicode) :
+            text = text.encode('utf-8')
+        if self.decoded :
+            self.pending += ''.join(text.split())
+            whole = len(self.pending) - len(self.pending) % 4
+            try:
+                data = base64.b64decode(self.pending[:whole])
+            except (TypeError, binascii.Error), err :
+                raise ValueError('Bad base64 content: %s' % err)
+            self.pending = self.pending[whole:]
+            self.out.write(data)
+            self.written += len(data)
+            self.text_size = (self.written + 2) / 3 * 4
+            return
+        self.out.write(text)
+        self.written += len(text)
+        self.text_size += len(escape(text))
+        if self.encoding in (BASE64, HEX) :
+            chars = ''.join(text.split())
+            self.chars += len(chars)
+            self.tail = (self.tail + chars)[-2:]
+
+    def close(self) :
+        self.out.close()
+        if self.pending :
+            raise ValueError('Bad base64 content: %d extra characters'\
+                             % len(self.pending))
+
+    def content_size(self) :
+        """Size of the content after decoding"""
+        if self.encoding == BASE64 and not self.decoded :
+            return self.chars * 3 / 4 - self.tail.count('=')
+        if self.encoding == HEX :
+            return self.chars / 2
+        return self.written
+
+    def chunks(self) :
+        """Yields the content as XML text read from the file"""
+        infile = open(self.path, 'rb')
+        try:
+            while True :
+                if self.decoded :
+                    data = infile.read(ENCODE_SIZE)
+                else :
+                    data = infile.read(READ_SIZE)
+                if not data :
+                    break
+                if self.decoded :
+                    yield base64.b64encode(data)
+                else :
+                    yield escape(data)
+        finally:
+            infile.close()
+
+    def remove(self) :
+        if not self.out.closed :
+            self.out.close()
+        try:
+            os.remove(self.path)
+        except OSError, err :
+            if err.errno != errno.ENOENT :
+                raise
+
+
+class SpillingBuilder(object) :
+    """Parser target building the tree with etree.TreeBuilder
+    and spilling big ChapterContent texts to files.
+
+    Attributes defined:
+    root -- the root element once started
+    done -- True when the root element is closed
+    spills -- ChapterContent element -> Spill
+
+    """
+
+    def __init__(self, threshold, spill_dir=None, decode=False) :
+        self.threshold = threshold
+        self.spill_dir = spill_dir
+        self.decode = decode
+        self.builder = etree.TreeBuilder()
+        self.depth = 0
+        self.root = None
+        self.done = False
+        self.spills = {}
+        self.content = None # ChapterContent being parsed
+        self.text = [] # its text while under threshold
+        self.text_size = 0
+        self.spill = None
+
+    def start(self, tag, attrib, nsmap) :
+        self.plain_content()
+        self.depth += 1
+        elem = self.builder.start(tag, attrib, nsmap)
+        if self.root is None :
+            self.root = elem
+        if tag == CONTENT_TAG :
+            self.content = elem
+        return elem
+
+    def data(self, text) :
+        if self.content is None :
+            self.builder.data(text)
+        elif self.spill is not None :
+            self.spill.write(text)
+        else :
+            self.text.append(text)
+            self.text_size += len(text)
+            if self.text_size > self.threshold :
+                self.spill = Spill(self.spill_dir\
+                    , self.content.get('encoding', 'plain'), self.decode)
+                self.spills[self.content] = self.spill
+                for piece in self.text :
+                    self.spill.write(piece)
+                self.text = []
+
+    def end(self, tag) :
+        if self.content is not None :
+            if self.spill is not None :
+                self.spill.close()
+            else :
+                self.builder.data(''.join(self.text))
+            self.reset_content()
+        self.depth -= 1
+        self.done = self.depth == 0
+        return self.builder.end(tag)
+
+    def plain_content(self) :
+        """Markup inside ChapterContent: keep it in the tree"""
+        if self.content is None :
+            return
+        if self.spill is not None :
+            raise ValueError('Markup inside ChapterContent')
+        self.builder.data(''.join(self.text))
+        self.reset_content()
+
+    def reset_content(self) :
+        self.content = None
+        self.text = []
+        self.text_size = 0
+        self.spill = None
+
+    def comment(self, text) :
+        self.plain_content()
+        return self.builder.comment(text)
+
+    def pi(self, target, data=None) :
+        self.plain_content()
+        return self.builder.pi(target, data)
+
+    def close(self) :
+        return self.builder.close()
+
+    def discard(self) :
+        """Remove the files of the mail which failed"""
+        for spill in self.spills.values() :
+            spill.remove()
+        self.spills = {}
+
+
+class Spiller(object) :
+    """Spilling settings of MessageReader"""
+
+    def __init__(self, threshold, spill_dir=None, decode=False) :
+        self.threshold = threshold
+        self.spill_dir = spill_dir
+        self.decode = decode
+
+    def builder(self) :
+        return SpillingBuilder(self.threshold, self.spill_dir, self.decode)
+
+def make_spiller(threshold, spill_dir=None, decode=False) :
+    """Spiller or None if threshold is 0 (spilling is off)"""
+    if not threshold :
+        return None
+    return Spiller(threshold, spill_dir, decode)
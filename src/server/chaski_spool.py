@@ -0,0 +1,553 @@
+"""Durable queue of mails to relay to peer servers
+
+Layout of 'spooldir':
+  <host>,<port>/<id>.mail   -- mail to relay to the peer as sent
+  <host>,<port>/lock        -- flock()ed while the mails are relayed
+  <host>,<port>/state       -- retry schedule of the peer (PeerQueue)
+
+host is quoted with urllib.quote(). Mail files are written under
+a temporary name, fsync()ed and renamed, so a queued mail survives
+a crash. id starts with the time the mail was queued, mails of a peer
+are relayed in that order.
+
+A delivery thread relays the mails through a RelayPool. Queued mails
+of a peer are coalesced: their messages are relayed in one chaski:Mail
+of at most batch_mails queued mails and batch_bytes bytes. A peer is
+relayed to when its queue fills a batch or its oldest mail has waited
+batch_age seconds, so batch_age bounds the delay added by batching.
+
+Mails accepted by the peer are removed, mails it fails are logged and
+removed too (chaski doesn't bounce mails). Mails of a batch rejected
+before the peer kept any of it (Result with STATUS_REJECTED) are
+relayed again one by one, so only the mail the peer doesn't take is
+dropped. A batch failed otherwise might be stored in part and is
+dropped as a whole rather than delivered twice. Failed connections
+leave the mails queued and put the peer off for retry_delay, doubled
+with every failure in a row up to max_retry_delay, unless the peer
+answered other batches of the round: then the mails are retried in
+the next round at once. The schedule is
+saved in the state file, so it is shared by the processes relaying
+to the peer and survives restarts. Mails queued longer
+than max_age are dropped. The directory is scanned every scan_interval
+seconds, so mails queued by other processes sharing it are relayed
+as well; the lock file keeps them from relaying the same mails.
+Every process runs its own delivery thread, started by the first
+start() of the process, so a Spool made before fork() is relayed
+from the children too.
+
+"""
+
+import os
+import time
+import uuid
+import errno
+import fcntl
+import urllib
+import logging
+import threading
+
+from chaski_relay import Delivery
+from chaski_raw import ChainedChunks
+from chaski_const import MAIL_HEAD, MAIL_TAIL
+
+__all__ = ['Spool', 'PeerQueue', 'Batch', 'get_spool']
+
+MAIL_SUFFIX = '.mail'
+TMP_SUFFIX = '.tmp'
+LOCK_NAME = 'lock'
+STATE_NAME = 'state'
+PORT_SEP = ','
+ID_SEP = '-'
+RETRY_DELAY = 60
+MAX_RETRY_DELAY = 3600
+MAX_AGE = 5*24*3600 # 5 days
+SCAN_INTERVAL = 30
+BATCH_MAILS = 64
+BATCH_BYTES = 1024*1024
+BATCH_AGE = 0
+# batches relayed to a peer in one round
+BATCHES_PER_ROUND = 4
+READ_SIZE = 64*1024
+
+
+def makedirs(path) :
+    try:
+        os.makedirs(path)
+    except OSError, err :
+        if err.errno != errno.EEXIST :
+            raise
+
+def fsync_dir(path) :
+    """Make renames in the directory durable"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def remove(path) :
+    try:
+        os.remove(path)
+    except OSError, err :
+        if err.errno != errno.ENOENT :
+            raise
+
+def queued_time(name) :
+    """Time the mail file was queued at"""
+    try:
+        return float(name.split(ID_SEP, 1)[0])
+    except ValueError :
+        return None
+
+def mail_file(path) :
+    """Size of the queued mail and True if it's written by SendMessage
+    (its messages could be relayed without the chaski:Mail element)"""
+    infile = open(path, 'rb')
+    try:
+        size = os.fstat(infile.fileno()).st_size
+        if size < len(MAIL_HEAD) + len(MAIL_TAIL) :
+            return size, False
+        head = infile.read(len(MAIL_HEAD))
+        infile.seek(size - len(MAIL_TAIL))
+        return size, head == MAIL_HEAD and infile.read() == MAIL_TAIL
+    finally:
+        infile.close()
+
+
+class FileRange(object) :
+    """length bytes of the file from offset, read in chunks every
+    time it's iterated"""
+
+    def __init__(self, path, offset, length) :
+        self.path = path
+        self.offset = offset
+        self.length = length
+
+    def __iter__(self) :
+        infile = open(self.path, 'rb')
+        try:
+            infile.seek(self.offset)
+            left = self.length
+            while left > 0 :
+                chunk = infile.read(min(READ_SIZE, left))
+                if not chunk :
+                    raise IOError('File %s is truncated' % self.path)
+                left -= len(chunk)
+                yield chunk
+        finally:
+            infile.close()
+
+
+class PeerQueue(object) :
+    """Directory of mails to one peer and its retry schedule.
+    The schedule is read by load() and written by save() with the lock
+    file held."""
+
+    def __init__(self, path, host, port) :
+        self.path = path
+        self.host = host
+        self.port = port
+        self.failures = 0
+        self.next_attempt = 0
+        self.flush_at = 0 # when the oldest mail has waited batch_age
+        # mails up to the name are relayed one by one (see Spool)
+        self.split_until = ''
+
+    def mail_names(self) :
+        """Names of queued mail files in the order of queueing"""
+        try:
+            names = os.listdir(self.path)
+        except OSError, err :
+            if err.errno == errno.ENOENT :
+                return []
+            raise
+        names = [name for name in names if name.endswith(MAIL_SUFFIX)]
+        names.sort()
+        return names
+
+    def lock(self) :
+        """Descriptor of the flock()ed lock file or None if other
+        process relays the mails. Closing it releases the lock."""
+        fd = os.open(os.path.join(self.path, LOCK_NAME)\
+                     , os.O_WRONLY | os.O_CREAT, 0644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, err :
+            os.close(fd)
+            if err.errno in (errno.EAGAIN, errno.EACCES) :
+                return None
+            raise
+        return fd
+
+    def load(self) :
+        """Read the schedule saved by any process"""
+        try:
+            fields = open(os.path.join(self.path, STATE_NAME)).read().split()
+        except IOError, err :
+            if err.errno == errno.ENOENT :
+                return
+            raise
+        try:
+            failures, next_attempt = int(fields[0]), float(fields[1])
+        except (IndexError, ValueError) :
+            return # written by an older version, keep ours
+        self.failures = failures
+        self.next_attempt = next_attempt
+        self.split_until = ''.join(fields[2:])
+
+    def save(self) :
+        path = os.path.join(self.path, STATE_NAME)
+        out = open(path + TMP_SUFFIX, 'w')
+        try:
+            out.write('%d %r %s\n' % (self.failures, self.next_attempt\
+                                      , self.split_until))
+        finally:
+            out.close()
+        os.rename(path + TMP_SUFFIX, path)
+
+    def failed(self, now, retry_delay, max_retry_delay) :
+        self.next_attempt = now + min(retry_delay * 2 ** self.failures\
+                                      , max_retry_delay)
+        self.failures += 1
+
+    def succeeded(self) :
+        self.failures = 0
+        self.next_attempt = 0
+
+
+class Batch(object) :
+    """Queued mails to a peer relayed together in one chaski:Mail.
+
+    Attributes defined:
+    paths -- files of the mails, read only when the batch is relayed
+    delivery -- Delivery of the batch once relayed
+
+    """
+
+    def __init__(self, queue, max_mails, max_bytes) :
+        self.queue = queue
+        self.max_mails = max_mails
+        self.max_bytes = max_bytes
+        self.paths = []
+        self.parts = []
+        self.size = 0
+        self.whole = False # a mail relayed as it was queued
+        self.delivery = None
+
+    def add(self, path, size, body) :
+        """Add the queued mail of size bytes if it fits, body tells
+        if its messages could be taken (see mail_file()).
+        Returns True if added."""
+        if body :
+            part = FileRange(path, len(MAIL_HEAD)\
+                             , size - len(MAIL_HEAD) - len(MAIL_TAIL))
+        else :
+            part = FileRange(path, 0, size)
+        if self.paths and (not body or self.whole\
+                           or len(self.paths) >= self.max_mails\
+                           or self.size + part.length > self.max_bytes) :
+            return False
+        self.paths.append(path)
+        self.parts.append(part)
+        self.whole = not body
+        self.size += part.length
+        return True
+
+    def chunks(self) :
+        """Bytes of the batch, the files are read again every time
+        they are iterated"""
+        if self.whole :
+            return ChainedChunks(self.parts)
+        return ChainedChunks([[MAIL_HEAD]] + self.parts + [[MAIL_TAIL]])
+
+
+class Spool(object) :
+    """Queues of 'spooldir' and the thread relaying them.
+    Use get_spool() to share one Spool in the process.
+
+    enqueue(host, port, chunks) -- queue a mail for the peer
+    deliver() -- relay the mails due, one round
+    start() -- start the delivery thread unless it runs in the process
+
+    """
+
+    def __init__(self, spooldir, relays, retry_delay=RETRY_DELAY\
+                 , max_retry_delay=MAX_RETRY_DELAY, max_age=MAX_AGE\
+                 , scan_interval=SCAN_INTERVAL, batch_mails=BATCH_MAILS\
+                 , batch_bytes=BATCH_BYTES, batch_age=BATCH_AGE\
+                 , batches_per_round=BATCHES_PER_ROUND) :
+        self.spooldir = spooldir
+        self.relays = relays
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.max_age = max_age
+        self.scan_interval = scan_interval
+        self.batch_mails = batch_mails
+        self.batch_bytes = batch_bytes
+        self.batch_age = batch_age
+        self.batches_per_round = batches_per_round
+        self.lock = threading.Condition()
+        self.queues = {} # directory name -> PeerQueue
+        self.woken = False
+        self.worker = None
+        self.pid = None # process the delivery thread runs in
+        self.logger = logging.getLogger(self.__class__.__name__)
+        makedirs(spooldir)
+
+    def queue(self, host, port) :
+        name = '%s%s%d' % (urllib.quote(host, ''), PORT_SEP, port)
+        self.lock.acquire()
+        try:
+            try:
+                return self.queues[name]
+            except KeyError :
+                return self.queues.setdefault(name, PeerQueue(\
+                    os.path.join(self.spooldir, name), host, port))
+        finally:
+            self.lock.release()
+
+    def scan(self) :
+        """Queues of the directory, including ones made by other
+        processes"""
+        for name in os.listdir(self.spooldir) :
+            host, sep, port = name.rpartition(PORT_SEP)
+            if sep and port.isdigit() :
+                self.queue(urllib.unquote(host), int(port))
+        self.lock.acquire()
+        try:
+            return self.queues.values()
+        finally:
+            self.lock.release()
+
+    def enqueue(self, host, port, chunks) :
+        """Write the mail (list of strings and buffers) for the peer
+        to disk and wake the delivery thread. Returns id of the mail."""
+        queue = self.queue(host, port)
+        makedirs(queue.path)
+        mailid = '%017.6f%s%s' % (time.time(), ID_SEP, uuid.uuid4().hex)
+        tmpname = os.path.join(queue.path, mailid + TMP_SUFFIX)
+        out = open(tmpname, 'wb')
+        try:
+            for chunk in chunks :
+                out.write(chunk)
+            out.flush()
+            os.fsync(out.fileno())
+        finally:
+            out.close()
+        os.rename(tmpname, os.path.join(queue.path, mailid + MAIL_SUFFIX))
+        fsync_dir(queue.path)
+        self.wake()
+        return mailid
+
+    def expire(self, queue, names, now) :
+        """Drop mails queued longer than max_age, returns the others"""
+        kept = []
+        for name in names :
+            queued = queued_time(name)
+            if queued is not None and now - queued > self.max_age :
+                self.logger.error('Mail %s to %s:%d expired after %d '\
+                                  'attempts', name, queue.host, queue.port\
+                                  , queue.failures)
+                remove(os.path.join(queue.path, name))
+            else :
+                kept.append(name)
+        return kept
+
+    def due(self, queue, names, now) :
+        """True if the queued mails fill a batch or the oldest one
+        has waited batch_age, otherwise sets queue.flush_at"""
+        queue.flush_at = 0
+        queued = queued_time(names[0])
+        if len(names) >= self.batch_mails or names[0] <= queue.split_until\
+               or queued is None or now - queued >= self.batch_age :
+            return True
+        size = 0
+        for name in names :
+            try:
+                size += os.path.getsize(os.path.join(queue.path, name))
+            except OSError, err :
+                if err.errno != errno.ENOENT :
+                    raise
+        if size >= self.batch_bytes :
+            return True
+        queue.flush_at = queued + self.batch_age
+        return False
+
+    def batches(self, queue, names) :
+        """Puts the mails into at most batches_per_round batches.
+        Returns the batches and True if mails are left."""
+        batches = []
+        for name in names :
+            path = os.path.join(queue.path, name)
+            try:
+                size, body = mail_file(path)
+            except IOError, err :
+                if err.errno == errno.ENOENT :
+                    continue # relayed by other process
+                raise
+            if batches and batches[-1].add(path, size, body) :
+                continue
+            if len(batches) == self.batches_per_round :
+                return batches, True
+            if name <= queue.split_until :
+                batch = Batch(queue, 1, self.batch_bytes)
+            else :
+                batch = Batch(queue, self.batch_mails, self.batch_bytes)
+            batch.add(path, size, body)
+            batches.append(batch)
+        return batches, False
+
+    def deliver(self, now=None) :
+        """Relay the mails of every peer which is due, at most
+        batches_per_round batches a peer. Returns True if mails
+        are left to relay at once."""
+        if now is None :
+            now = time.time()
+        locks = []
+        batches = []
+        left = set() # queues with mails for next round
+        try:
+            for queue in self.scan() :
+                queue.load()
+                if queue.next_attempt > now :
+                    continue
+                names = self.expire(queue, queue.mail_names(), now)
+                if not names or not self.due(queue, names, now) :
+                    continue
+                fd = queue.lock()
+                if fd is None :
+                    continue
+                locks.append(fd)
+                queue.load() # the holder of the lock might have changed it
+                queued, more = self.batches(queue, names)
+                batches.extend(queued)
+                if more :
+                    left.add(queue)
+            if not batches :
+                return False
+            for batch in batches :
+                batch.delivery = Delivery(batch.queue.host, batch.queue.port\
+                                          , batch.chunks())
+            self.relays.relay([batch.delivery for batch in batches])
+            failed = set()
+            answered = set()
+            for batch in batches :
+                queue, delivery = batch.queue, batch.delivery
+                if not delivery.answered :
+                    failed.add(queue)
+                    self.logger.warning('Failed to relay %d mails to %s:%d'\
+                                        ': %s', len(batch.paths), queue.host\
+                                        , queue.port, delivery.description)
+                    continue
+                answered.add(queue)
+                if delivery.ok :
+                    self.logger.debug('%d mails relayed to %s:%d: %s'\
+                                      , len(batch.paths), queue.host\
+                                      , queue.port, delivery.description)
+                elif len(batch.paths) > 1 and delivery.rejected :
+                    # any of the mails could fail the batch
+                    self.logger.warning('%d mails rejected by %s:%d, '\
+                                        'relaying them one by one: %s'\
+                                        , len(batch.paths), queue.host\
+                                        , queue.port, delivery.description)
+                    queue.split_until = max(queue.split_until\
+                        , os.path.basename(batch.paths[-1]))
+                    left.add(queue)
+                    continue
+                else :
+                    self.logger.error('Mails %s rejected by %s:%d: %s'\
+                        , ', '.join([os.path.basename(path)\
+                                     for path in batch.paths])\
+                        , queue.host, queue.port, delivery.description)
+                for path in batch.paths :
+                    remove(path)
+            # a peer which answered other batches is up, the failures
+            # were its connections' (e.g. closed while kept alive)
+            left.update(failed & answered)
+            failed -= answered
+            for queue in set([batch.queue for batch in batches]) :
+                if queue in failed :
+                    queue.failed(now, self.retry_delay\
+                                 , self.max_retry_delay)
+                    self.logger.info('Relaying to %s:%d put off for %d s'\
+                                     , queue.host, queue.port\
+                                     , queue.next_attempt - now)
+                else :
+                    queue.succeeded()
+                queue.save()
+            return bool(left - failed)
+        finally:
+            for fd in locks :
+                os.close(fd)
+
+    def wait_time(self, now) :
+        """Seconds till the next retry, flush of a batch or scan"""
+        timeout = self.scan_interval
+        self.lock.acquire()
+        try:
+            for queue in self.queues.values() :
+                for at in (queue.next_attempt, queue.flush_at) :
+                    if at > now :
+                        timeout = min(timeout, at - now)
+        finally:
+            self.lock.release()
+        return timeout
+
+    def wake(self) :
+        self.lock.acquire()
+        try:
+            self.woken = True
+            self.lock.notify()
+        finally:
+            self.lock.release()
+
+    def start(self) :
+        pid = os.getpid()
+        if self.pid == pid :
+            return
+        _SPOOLS_LOCK.acquire()
+        try:
+            if self.pid != pid :
+                # a thread of the parent might have held the lock at fork
+                self.lock = threading.Condition()
+                self.woken = False
+                self.worker = threading.Thread(target=self.deliver_forever)
+                self.worker.setDaemon(True)
+                self.worker.start()
+                self.pid = pid
+        finally:
+            _SPOOLS_LOCK.release()
+
+    def deliver_forever(self) :
+        while True :
+            more = False
+            try:
+                more = self.deliver()
+            except (IOError, OSError), err :
+                self.logger.error('Relaying spooled mails failed: %s', err)
+            if more :
+                continue
+            timeout = self.wait_time(time.time())
+            self.lock.acquire()
+            try:
+                if not self.woken :
+                    self.lock.wait(timeout)
+                self.woken = False
+            finally:
+                self.lock.release()
+
+_SPOOLS = {}
+_SPOOLS_LOCK = threading.Lock()
+
+def get_spool(spooldir, relays, **params) :
+    """Spool of spooldir shared in the process. Its delivery thread
+    is not started, start() it in every process which enqueue()s."""
+    key = os.path.abspath(spooldir)
+    _SPOOLS_LOCK.acquire()
+    try:
+        try:
+            return _SPOOLS[key]
+        except KeyError :
+            return _SPOOLS.setdefault(key, Spool(spooldir, relays, **params))
+    finally:
+        _SPOOLS_LOCK.release()
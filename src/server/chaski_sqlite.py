@@ -0,0 +1,310 @@
+"""SQLite mail storage
+
+Message is stored once in 'messages' (whole message and its header,
+see make_header()), recepients are rows of 'recipients' indexed by
+(username, received) so a fetch by account and date range is an index
+range scan. Database works in WAL mode: fetches read through their own
+per-thread connections while one writer thread commits writes
+of all the threads in groups (one transaction for everything queued).
+The writer thread and the connections are started in the process
+using them, so a database configured before fork works in the workers.
+
+"""
+
+import os
+import time
+import thread
+import threading
+import Queue
+import sqlite3
+from datetime import timedelta
+
+from chaski_const import PROCESS_OK
+from chaski_pool import PendingResult, CallTimeout
+from chaski_raw import message_bytes
+from chaski_plugin import ReceiveMessage, FetchMessage, make_header\
+     , MAIL_HEAD, FLUSH
+
+__all__ = ['ReceiveMessageToSQLite', 'FetchMessagesFromSQLite'\
+           , 'MailDatabase', 'get_database']
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS messages (
+         id INTEGER PRIMARY KEY,
+         received REAL NOT NULL,
+         size INTEGER NOT NULL,
+         header BLOB NOT NULL,
+         body BLOB NOT NULL)''',
+    '''CREATE TABLE IF NOT EXISTS recipients (
+         username TEXT NOT NULL,
+         received REAL NOT NULL,
+         message_id INTEGER NOT NULL REFERENCES messages (id),
+         PRIMARY KEY (username, received, message_id))''',
+    '''CREATE INDEX IF NOT EXISTS recipients_message
+         ON recipients (message_id)''',
+]
+MAX_BATCH = 256
+# seconds a write waits for the writer thread
+WRITE_TIMEOUT = 30
+
+
+def insert_message(db, usernames, received, rawdata, header) :
+    cursor = db.execute('INSERT INTO messages (received, size, header, body)'\
+                        ' VALUES (?, ?, ?, ?)', (received, len(rawdata)\
+                        , sqlite3.Binary(header), sqlite3.Binary(rawdata)))
+    db.executemany('INSERT OR IGNORE INTO recipients VALUES (?, ?, ?)'\
+                   , [(username, received, cursor.lastrowid)\
+                      for username in usernames])
+    return cursor.lastrowid
+
+def remove_messages(db, username, message_ids) :
+    for message_id in message_ids :
+        db.execute('DELETE FROM recipients WHERE username = ?'\
+                   ' AND message_id = ?', (username, message_id))
+        db.execute('DELETE FROM messages WHERE id = ? AND NOT EXISTS'\
+                   ' (SELECT 1 FROM recipients WHERE message_id = ?)'\
+                   , (message_id, message_id))
+
+def cursor_key(received, message_id) :
+    """Paging key of a recipients row (see FetchConditions)"""
+    return '%r %d' % (received, message_id)
+
+def cursor_position(key) :
+    """received, received, message_id of the row of cursor_key()"""
+    try:
+        received, message_id = key.split()
+        return float(received), float(received), int(message_id)
+    except ValueError :
+        raise ValueError('Bad cursor: %r' % key)
+
+def date_bounds(cond) :
+    """Receive time range [low, high) of FetchConditions,
+    None for unlimited bounds"""
+    low = high = None
+    if cond.mindate != cond.mindate.min :
+        low = time.mktime(cond.mindate.timetuple())
+    if cond.maxdate != cond.maxdate.max :
+        high = time.mktime((cond.maxdate + timedelta(1)).timetuple())
+    return low, high
+
+
+class MailDatabase(object) :
+    """Mail database file shared by the plugins of a process.
+
+    write(func, *args) -- run func(db, *args) in the writer thread
+                          and wait until it is committed, CallTimeout
+                          is raised after write_timeout seconds
+    query(sql, args) -- rows selected through connection of the thread
+    select(sql, args) -- cursor over the rows
+
+    """
+
+    def __init__(self, path, max_batch=MAX_BATCH\
+                 , write_timeout=WRITE_TIMEOUT) :
+        self.path = path
+        self.max_batch = max_batch
+        self.write_timeout = write_timeout
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.pid = None # process the writer thread runs in
+        self.jobs = None
+        db = self.connect()
+        try:
+            db.execute('PRAGMA journal_mode=WAL')
+            for sql in SCHEMA :
+                db.execute(sql)
+        finally:
+            db.close()
+
+    def connect(self) :
+        db = sqlite3.connect(self.path, isolation_level=None\
+                             , check_same_thread=False)
+        db.execute('PRAGMA synchronous=NORMAL')
+        return db
+
+    def start(self) :
+        """Start the writer thread unless it runs in this process"""
+        pid = os.getpid()
+        if self.pid == pid :
+            return
+        self.lock.acquire()
+        try:
+            if self.pid != pid :
+                self.jobs = Queue.Queue()
+                thread.start_new_thread(self.work\
+                                        , (self.jobs, self.connect()))
+                self.pid = pid
+        finally:
+            self.lock.release()
+
+    def write(self, func, *args) :
+        self.start()
+        result = PendingResult()
+        self.jobs.put((result, func, args))
+        return result.get(self.write_timeout)
+
+    def select(self, sql, args) :
+        pid = os.getpid()
+        if getattr(self.local, 'pid', None) != pid :
+            # connection of the thread made before fork is not used
+            self.local.db = self.connect()
+            self.local.pid = pid
+        return self.local.db.execute(sql, args)
+
+    def query(self, sql, args) :
+        return self.select(sql, args).fetchall()
+
+    def work(self, jobs, db) :
+        """Writer thread body: commit queued jobs in groups"""
+        while True :
+            batch = [jobs.get()]
+            try:
+                while len(batch) < self.max_batch :
+                    batch.append(jobs.get_nowait())
+            except Queue.Empty :
+                pass
+            self.commit(db, batch)
+
+    def commit(self, db, batch) :
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            for result, func, args in batch :
+                db.execute('SAVEPOINT job')
+                try:
+                    result.value = func(db, *args)
+                except Exception, ex :
+                    result.error = ex
+                    db.execute('ROLLBACK TO job')
+                db.execute('RELEASE job')
+            db.execute('COMMIT')
+        except sqlite3.Error, ex :
+            try:
+                db.execute('ROLLBACK')
+            except sqlite3.Error :
+                pass
+            for result, func, args in batch :
+                result.error = ex
+        for result, func, args in batch :
+            result.finished.set()
+
+_DATABASES = {}
+_DATABASES_LOCK = threading.Lock()
+
+def get_database(path, max_batch=MAX_BATCH, write_timeout=WRITE_TIMEOUT) :
+    """MailDatabase of path shared in the process"""
+    key = os.path.abspath(path)
+    _DATABASES_LOCK.acquire()
+    try:
+        try:
+            return _DATABASES[key]
+        except KeyError :
+            return _DATABASES.setdefault(key, MailDatabase(path, max_batch\
+                                                           , write_timeout))
+    finally:
+        _DATABASES_LOCK.release()
+
+def database(path, params) :
+    return get_database(path, int(params.get('max_batch', MAX_BATCH))\
+        , float(params.get('write_timeout', WRITE_TIMEOUT)))
+
+
+class ReceiveMessageToSQLite(ReceiveMessage) :
+    """Plugin for storing messages in SQLite database.
+    It's brother plugin for FetchMessagesFromSQLite
+
+    The plugin works in assumption that authentification is done
+    by previous plugin(s).
+
+    Plugin parameters:
+      database -- database file, created if doesn't exist
+      max_batch -- max writes committed in one transaction (256)
+      write_timeout -- seconds to wait for a commit (30)
+
+    """
+
+    def __init__(self, params) :
+        ReceiveMessage.__init__(self, params)
+        self.db = database(self.database, params)
+
+    def store(self, usernames, message) :
+        if usernames :
+            self.db.write(insert_message, list(set(usernames))\
+                          , time.time(), message_bytes(message)\
+                          , make_header(message))
+        return PROCESS_OK, message
+
+
+class FetchMessagesFromSQLite(FetchMessage) :
+    """Plugin for fetching messages from SQLite database.
+    It's brother plugin for ReceiveMessageToSQLite
+
+    Plugin parameters are the same as of ReceiveMessageToSQLite.
+
+    """
+
+    def __init__(self, params) :
+        FetchMessage.__init__(self, params)
+        self.db = database(self.database, params)
+
+    def check_cursor(self, key) :
+        cursor_position(key)
+
+    def fetch(self, recepients, cond) :
+        if cond.onlyheaders :
+            columns = 'length(m.header), m.header'
+        else :
+            columns = 'm.size, m.body'
+        sql = 'SELECT r.received, m.id, %s FROM recipients r JOIN messages m'\
+              ' ON m.id = r.message_id WHERE r.username = ?' % columns
+        bounds = []
+        low, high = date_bounds(cond)
+        if low is not None :
+            sql += ' AND r.received >= ?'
+            bounds.append(low)
+        if high is not None :
+            sql += ' AND r.received < ?'
+            bounds.append(high)
+        order = ' ORDER BY r.received, r.message_id'
+        position = None
+        if cond.cursor is not None :
+            position = cursor_position(cond.cursor[1])
+        yield MAIL_HEAD
+        removed = []
+        for account in cond.accounts(recepients) :
+            query, args = sql, [account] + bounds
+            if position is not None and cond.cursor[0] == account :
+                # continue from the row of the cursor
+                query += ' AND (r.received > ? OR (r.received = ?'\
+                         ' AND r.message_id >= ?))'
+                args.extend(position)
+            fetched = []
+            try:
+                # rows are read one by one while sending
+                for received, message_id, size, data in self.db.select(\
+                        query + order, args) :
+                    if not cond.admit(account, cursor_key(received\
+                                                          , message_id)\
+                                      , size) :
+                        break
+                    yield str(data)
+                    fetched.append(message_id)
+            except sqlite3.Error, errmes :
+                # rows are sent whole, so the error falls between
+                # messages: rest of the account is skipped and sent
+                # messages are still removed
+                self.logger.error(errmes)
+            self.logger.debug('fetched %d messages of %s'\
+                              , len(fetched), account)
+            removed.append((account, fetched))
+            if cond.next_cursor is not None :
+                break
+        yield cond.mail_tail()
+        yield FLUSH
+
+        if cond.removeafter :
+            for account, fetched in removed :
+                try:
+                    if fetched :
+                        self.db.write(remove_messages, account, fetched)
+                except (sqlite3.Error, CallTimeout), err :
+                    self.logger.error(err)
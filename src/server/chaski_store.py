@@ -0,0 +1,540 @@
+"""Sharded mail storage with a per-user index
+
+Layout of 'basedir':
+  <user>/index              -- append-only index of the mailbox
+  <user>/ab/cd/<id>.xml     -- message files sharded by message id
+
+Message file starts with the message header (see make_header())
+followed by the message itself. Index has one line per stored message:
+  id received size header_size [digest]
+and a line '-id' (tombstone) per removed message. header_size is
+the offset of the message in the file, so header-only fetch reads
+just the header. Fetches by date are answered from the index alone,
+message files are opened only for the messages sent.
+
+With 'blobdir' message files are content-addressed blobs shared
+by all the mailboxes instead (see BlobStore), index entries refer
+to them by digest:
+  <blobdir>/ab/cd/<digest>.xml   -- message file
+  <blobdir>/ab/cd/<digest>.refs  -- journal of references to the blob
+
+"""
+
+import os
+import time
+import uuid
+import errno
+import hashlib
+import fcntl
+import threading
+from datetime import date
+from collections import OrderedDict
+
+from chaski_const import PROCESS_OK
+from chaski_raw import message_chunks
+from chaski_plugin import ReceiveMessage, FetchMessage, make_header\
+     , file_chunks, guard_message, MAIL_HEAD, FLUSH, CHUNK_SIZE
+
+__all__ = ['ReceiveMessageToIndexedStore', 'FetchMessagesFromIndexedStore'\
+           , 'MailStore', 'Mailbox', 'IndexEntry', 'BlobStore', 'get_store'\
+           , 'open_locked']
+
+INDEX_NAME = 'index'
+TOMBSTONE = '-'
+MESSAGE_SUFFIX = '.xml'
+REFS_SUFFIX = '.refs'
+SHARD_LEVELS = 2
+# index is rewritten when it has at least COMPACT_MIN tombstones
+# and they outnumber live entries
+COMPACT_MIN = 1000
+# journal of references to a blob is rewritten at this many lines
+JOURNAL_LINES = 64
+
+
+def makedirs(path) :
+    try:
+        os.makedirs(path)
+    except OSError, err :
+        if err.errno != errno.EEXIST :
+            raise
+
+def open_locked(path) :
+    """Returns descriptor of path opened for append and flock()ed.
+    Closing the descriptor releases the lock. Files replaced with
+    rename() while waiting for the lock are opened again."""
+    while True :
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(fd).st_ino == os.stat(path).st_ino :
+                return fd
+        except OSError :
+            pass
+        os.close(fd)
+
+
+
+def write_message(path, header, chunks) :
+    """Write message file, returns size of the message"""
+    size = 0
+    out = open(path, 'wb')
+    try:
+        out.write(header)
+        for chunk in chunks :
+            out.write(chunk)
+            size += len(chunk)
+    finally:
+        out.close()
+    return size
+
+def shard_path(basedir, name, shard_levels) :
+    shards = [name[2*i:2*i+2] for i in range(shard_levels)]
+    return os.path.join(basedir, *(shards + [name]))
+
+
+class IndexEntry(object) :
+    """One message of mailbox index, blob is digest of the message
+    file in BlobStore or None"""
+    __slots__ = ['msgid', 'received', 'size', 'header_size', 'blob']
+
+    def __init__(self, msgid, received, size, header_size, blob=None) :
+        self.msgid = msgid
+        self.received = received
+        self.size = size
+        self.header_size = header_size
+        self.blob = blob
+
+    def parse(cls, line) :
+        fields = line.split()
+        msgid, received, size, header_size = fields[:4]
+        return cls(msgid, float(received), int(size), int(header_size)\
+                   , (fields[4:] or [None])[0])
+    parse = classmethod(parse)
+
+    def __str__(self) :
+        line = '%s %.3f %d %d' % (self.msgid, self.received, self.size\
+                                  , self.header_size)
+        if self.blob is not None :
+            line += ' ' + self.blob
+        return line + '\n'
+
+    def key(self) :
+        """Paging key of the entry ordered by receive time"""
+        return '%020.3f %s' % (self.received, self.msgid)
+
+
+class Mailbox(object) :
+    """Directory and index of one user.
+
+    Index is read incrementally: entries() parses only the lines
+    appended since the previous call. Writers lock the index
+    with flock() so the index could be shared by processes.
+
+    """
+
+    def __init__(self, path, shard_levels=SHARD_LEVELS) :
+        self.path = path
+        self.index_path = os.path.join(path, INDEX_NAME)
+        self.shard_levels = shard_levels
+        self.lock = threading.Lock()
+        self.inode = None
+        self.offset = 0
+        self.live = OrderedDict() # msgid -> IndexEntry
+        self.removed = 0
+
+    def message_path(self, msgid) :
+        return shard_path(self.path, msgid + MESSAGE_SUFFIX\
+                          , self.shard_levels)
+
+    def open_index(self) :
+        makedirs(self.path)
+        return open_locked(self.index_path)
+
+    def append(self, lines) :
+        fd = self.open_index()
+        try:
+            os.write(fd, ''.join(lines))
+        finally:
+            os.close(fd)
+
+    def refresh(self) :
+        try:
+            index = open(self.index_path, 'rb')
+        except IOError, err :
+            if err.errno == errno.ENOENT :
+                return
+            raise
+        try:
+            inode = os.fstat(index.fileno()).st_ino
+            if inode != self.inode :
+                self.inode = inode
+                self.offset = 0
+                self.live = OrderedDict()
+                self.removed = 0
+            index.seek(self.offset)
+            data = index.read()
+        finally:
+            index.close()
+        complete = data.rfind('\n') + 1 # skip line being written
+        for line in data[:complete].splitlines() :
+            if line.startswith(TOMBSTONE) :
+                self.live.pop(line[len(TOMBSTONE):], None)
+                self.removed += 1
+            elif line :
+                entry = IndexEntry.parse(line)
+                self.live[entry.msgid] = entry
+        self.offset += complete
+
+    def entries(self) :
+        """Returns list of IndexEntry of messages in the mailbox"""
+        self.lock.acquire()
+        try:
+            self.refresh()
+            return self.live.values()
+        finally:
+            self.lock.release()
+
+    def remove(self, msgids) :
+        """Record tombstones in the index and delete message files.
+        Returns IndexEntry of the removed messages, messages removed
+        already (e.g. by a concurrent fetch) are skipped."""
+        fd = self.open_index()
+        try:
+            self.lock.acquire()
+            try:
+                self.refresh()
+                entries = [self.live[msgid] for msgid in msgids\
+                           if msgid in self.live]
+                os.write(fd, ''.join([TOMBSTONE + entry.msgid + '\n'\
+                                      for entry in entries]))
+                self.refresh()
+                compact = self.removed >= COMPACT_MIN \
+                          and self.removed > len(self.live)
+            finally:
+                self.lock.release()
+        finally:
+            os.close(fd)
+        for entry in entries :
+            if entry.blob is None :
+                try:
+                    os.remove(self.message_path(entry.msgid))
+                except OSError, err :
+                    if err.errno != errno.ENOENT :
+                        raise
+        if compact :
+            self.compact()
+        return entries
+
+    def compact(self) :
+        """Rewrite the index without removed messages"""
+        fd = self.open_index()
+        try:
+            self.lock.acquire()
+            try:
+                self.refresh()
+                tmpname = '%s.%d.tmp' % (self.index_path, os.getpid())
+                out = open(tmpname, 'wb')
+                try:
+                    out.write(''.join([str(e) for e in self.live.values()]))
+                finally:
+                    out.close()
+                os.rename(tmpname, self.index_path)
+            finally:
+                self.lock.release()
+        finally:
+            os.close(fd)
+
+
+class BlobStore(object) :
+    """Message files named by SHA-256 of the message, shared by
+    mailboxes. A message received again is not written again.
+
+    The references to a blob are counted in its journal: a line '+n'
+    per n references added and '-n' per n dropped. Journal is flock()ed
+    while it's changed, the blob and the journal are deleted when
+    the count drops to 0. Journal grown to journal_lines lines is
+    replaced with one line of the count.
+
+    """
+
+    def __init__(self, blobdir, shard_levels=SHARD_LEVELS\
+                 , journal_lines=JOURNAL_LINES) :
+        self.blobdir = blobdir
+        self.shard_levels = shard_levels
+        self.journal_lines = journal_lines
+
+    def blob_path(self, digest) :
+        return shard_path(self.blobdir, digest + MESSAGE_SUFFIX\
+                          , self.shard_levels)
+
+    def journal_path(self, digest) :
+        return shard_path(self.blobdir, digest + REFS_SUFFIX\
+                          , self.shard_levels)
+
+    def references(self, digest) :
+        """Reference count of the blob, read under journal lock"""
+        return self.read_journal(digest)[0]
+
+    def read_journal(self, digest) :
+        """Reference count and number of lines of the journal"""
+        try:
+            journal = open(self.journal_path(digest), 'rb')
+        except IOError, err :
+            if err.errno == errno.ENOENT :
+                return 0, 0
+            raise
+        try:
+            lines = journal.read().split()
+        finally:
+            journal.close()
+        return sum([int(line) for line in lines]), len(lines)
+
+    def compact_journal(self, digest, count, lines) :
+        """Replace the journal of journal_lines lines or more with
+        the count, called with the journal locked. Waiters for the lock
+        open the new journal (see open_locked())."""
+        if lines < self.journal_lines :
+            return
+        path = self.journal_path(digest)
+        tmpname = '%s.%d.tmp' % (path, os.getpid())
+        out = open(tmpname, 'wb')
+        try:
+            out.write('+%d\n' % count)
+        finally:
+            out.close()
+        os.rename(tmpname, path)
+
+    def add(self, chunks, header, refs) :
+        """Reference the message (iterable of chunks) refs times,
+        the blob is written if it's not stored yet.
+        Returns digest and size of the message."""
+        digest = hashlib.sha256()
+        size = 0
+        for chunk in chunks :
+            digest.update(chunk)
+            size += len(chunk)
+        digest = digest.hexdigest()
+        path = self.blob_path(digest)
+        makedirs(os.path.dirname(path))
+        fd = open_locked(self.journal_path(digest))
+        try:
+            count, lines = self.read_journal(digest)
+            if count <= 0 or not os.path.exists(path) :
+                tmpname = '%s.%d.tmp' % (path, os.getpid())
+                write_message(tmpname, header, chunks)
+                os.rename(tmpname, path)
+            os.write(fd, '+%d\n' % refs)
+            self.compact_journal(digest, count + refs, lines + 1)
+        finally:
+            os.close(fd)
+        return digest, size
+
+    def drop(self, digest, refs=1) :
+        """Drop references to the blob, deletes unreferenced blob"""
+        path = self.journal_path(digest)
+        fd = open_locked(path)
+        try:
+            os.write(fd, '-%d\n' % refs)
+            count, lines = self.read_journal(digest)
+            if count <= 0 :
+                for name in (self.blob_path(digest), path) :
+                    try:
+                        os.remove(name)
+                    except OSError, err :
+                        if err.errno != errno.ENOENT :
+                            raise
+            else :
+                self.compact_journal(digest, count, lines)
+        finally:
+            os.close(fd)
+
+
+class MailStore(object) :
+    """Mailboxes of 'basedir'. Use get_store() to share one
+    MailStore (and its index caches) among plugins.
+    Message files are kept in blobs (BlobStore) if given."""
+
+    def __init__(self, basedir, shard_levels=SHARD_LEVELS, blobs=None) :
+        self.basedir = basedir
+        self.shard_levels = shard_levels
+        self.blobs = blobs
+        self.lock = threading.Lock()
+        self.mailboxes = {}
+
+    def mailbox(self, username) :
+        self.lock.acquire()
+        try:
+            try:
+                return self.mailboxes[username]
+            except KeyError :
+                return self.mailboxes.setdefault(username, Mailbox(\
+                    os.path.join(self.basedir, username), self.shard_levels))
+        finally:
+            self.lock.release()
+
+    def store(self, usernames, chunks, header) :
+        """Store message (iterable of chunks, see message_chunks())
+        and its header once for all the users (other users get hard
+        links or references to the blob) and add it to their indexes"""
+        entry = IndexEntry(uuid.uuid4().hex, time.time(), 0, len(header))
+        mailboxes = []
+        for username in usernames :
+            mailbox = self.mailbox(username)
+            if mailbox not in mailboxes :
+                mailboxes.append(mailbox)
+        if self.blobs is not None :
+            entry.blob, entry.size = self.blobs.add(chunks, header\
+                                                    , len(mailboxes))
+            line = str(entry)
+            for mailbox in mailboxes :
+                mailbox.append([line])
+            return entry
+        fullname = mailboxes[0].message_path(entry.msgid)
+        makedirs(os.path.dirname(fullname))
+        entry.size = write_message(fullname, header, chunks)
+        for mailbox in mailboxes[1:] :
+            linkname = mailbox.message_path(entry.msgid)
+            makedirs(os.path.dirname(linkname))
+            os.link(fullname, linkname)
+        line = str(entry)
+        for mailbox in mailboxes :
+            mailbox.append([line])
+        return entry
+
+    def read(self, mailbox, entry, onlyheader=False, chunk_size=CHUNK_SIZE) :
+        """Returns iterator over chunks of serialized message
+        or its header only. The file is opened at once."""
+        if entry.blob is not None :
+            message = open(self.blobs.blob_path(entry.blob), 'rb')
+        else :
+            message = open(mailbox.message_path(entry.msgid), 'rb')
+        if onlyheader :
+            return file_chunks(message, entry.header_size, chunk_size)
+        message.seek(entry.header_size)
+        return file_chunks(message, entry.size, chunk_size)
+
+    def remove(self, mailbox, msgids) :
+        """Remove messages from the mailbox and drop its references
+        to their blobs"""
+        blobs = {}
+        for entry in mailbox.remove(msgids) :
+            if entry.blob is not None :
+                blobs[entry.blob] = blobs.get(entry.blob, 0) + 1
+        for digest, refs in blobs.items() :
+            self.blobs.drop(digest, refs)
+
+_STORES = {}
+_STORES_LOCK = threading.Lock()
+
+def get_store(basedir, shard_levels=SHARD_LEVELS, blobdir=None) :
+    """MailStore of basedir shared in the process"""
+    if blobdir is not None :
+        blobdir = os.path.abspath(blobdir)
+    key = (os.path.abspath(basedir), shard_levels, blobdir)
+    _STORES_LOCK.acquire()
+    try:
+        try:
+            return _STORES[key]
+        except KeyError :
+            blobs = None
+            if blobdir is not None :
+                blobs = BlobStore(blobdir, shard_levels)
+            return _STORES.setdefault(key, MailStore(basedir, shard_levels\
+                                                     , blobs))
+    finally:
+        _STORES_LOCK.release()
+
+def indexed_store(params) :
+    return get_store(params['basedir']\
+        , int(params.get('shard_levels', SHARD_LEVELS))\
+        , params.get('blobdir'))
+
+
+class ReceiveMessageToIndexedStore(ReceiveMessage) :
+    """Plugin for storing messages in sharded indexed mailboxes.
+    It's brother plugin for FetchMessagesFromIndexedStore
+
+    Message is written once, other recepients get hard links.
+    With blobdir messages are stored once by content, a message
+    received again (e.g. fan-out of a mailing list) only adds
+    index entries. The plugin works in assumption that
+    authentification is done by previous plugin(s).
+
+    Plugin parameters:
+      basedir -- root directory for user mailboxes
+      shard_levels -- levels of message subdirectories (2)
+      blobdir -- directory of shared message files (optional)
+
+    """
+
+    def __init__(self, params) :
+        ReceiveMessage.__init__(self, params)
+        self.mailstore = indexed_store(params)
+
+    def store(self, usernames, message) :
+        if usernames :
+            self.mailstore.store(usernames, message_chunks(message)\
+                                 , make_header(message))
+        return PROCESS_OK, message
+
+
+class FetchMessagesFromIndexedStore(FetchMessage) :
+    """Plugin for fetching messages from sharded indexed mailboxes.
+    It's brother plugin for ReceiveMessageToIndexedStore
+
+    Messages are selected by the index, header-only fetch reads
+    headers saved at the start of message files.
+
+    Plugin parameters:
+      basedir -- root directory for user mailboxes
+      shard_levels -- levels of message subdirectories (2)
+      blobdir -- directory of shared message files (optional)
+
+    """
+
+    def __init__(self, params) :
+        FetchMessage.__init__(self, params)
+        self.mailstore = indexed_store(params)
+
+    def fetch(self, recepients, cond) :
+        yield MAIL_HEAD
+        removed = []
+        for account in cond.accounts(recepients) :
+            mailbox = self.mailstore.mailbox(account)
+            fetched = []
+            entries = [(entry.key(), entry) for entry in mailbox.entries()]
+            entries.sort()
+            for key, entry in entries :
+                received = date.fromtimestamp(entry.received)
+                if not cond.mindate <= received <= cond.maxdate \
+                       or cond.before_cursor(account, key) :
+                    continue
+                if cond.onlyheaders :
+                    size = entry.header_size
+                else :
+                    size = entry.size
+                if not cond.admit(account, key, size) :
+                    break
+                try:
+                    for chunk in guard_message(self.mailstore.read(mailbox\
+                            , entry, cond.onlyheaders), (IOError, OSError)) :
+                        yield chunk
+                except (IOError, OSError), errmes :
+                    self.logger.error(errmes)
+                    continue
+                fetched.append(entry.msgid)
+            self.logger.debug('fetched %d messages of %s'\
+                              , len(fetched), account)
+            removed.append((mailbox, fetched))
+            if cond.next_cursor is not None :
+                break
+        yield cond.mail_tail()
+        yield FLUSH
+
+        if cond.removeafter :
+            for mailbox, fetched in removed :
+                try:
+                    if fetched :
+                        self.mailstore.remove(mailbox, fetched)
+                except (IOError, OSError), err :
+                    self.logger.error(err)
@@ -0,0 +1,185 @@
+"""User database of SimpleUserAuth
+
+userconf file has one user per line:
+  username, password hash, account, account, ...
+
+UserStore keeps an indexed table of users and replaces it
+when the file changes. The table could be compiled into an
+SQLite snapshot file which later starts open in no time
+regardless of the number of users. A replaced snapshot table
+closes its connection once the last reference to it is gone,
+i.e. no message is looked up in it any more.
+
+"""
+
+import os
+import time
+import threading
+import logging
+import sqlite3
+
+__all__ = ['UserStore', 'UserTable', 'SnapshotTable', 'parse_users']
+
+
+def parse_users(lines) :
+    """Yields (username, password hash, accounts) from userconf lines"""
+    for line in lines :
+        tokens = [x.strip() for x in line.split(',')]
+        if len(tokens) >= 2:
+            yield tokens[0], tokens[1], tokens[2:]
+
+
+class UserTable(object) :
+    """In-memory user table.
+
+    Methods defined (the same for SnapshotTable):
+    password_hash(username) -- hash string or None for unknown user
+    owns(username, account) -- True if account belongs to the user
+    owner(account) -- username the account belongs to or None
+
+    """
+
+    def __init__(self, users) :
+        self.hashes = {}
+        self.accounts = {}
+        self.owners = {}
+        for username, pwd_hash, accounts in users :
+            self.hashes[username] = pwd_hash
+            self.accounts[username] = frozenset(accounts)
+            for account in accounts :
+                self.owners[account] = username
+
+    def password_hash(self, username) :
+        return self.hashes.get(username)
+
+    def owns(self, username, account) :
+        return account in self.accounts.get(username, ())
+
+    def owner(self, account) :
+        return self.owners.get(account)
+
+
+class SnapshotTable(object) :
+    """User table backed by SQLite file created with compile()"""
+
+    def __init__(self, path) :
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+
+    def close(self) :
+        self.lock.acquire()
+        try:
+            self.db.close()
+        finally:
+            self.lock.release()
+
+    def __del__(self) :
+        if hasattr(self, 'db') : # not if connect() failed
+            self.close()
+
+    def compile(cls, users, path) :
+        """Write users to a new snapshot file replacing path atomically"""
+        tmpname = '%s.%d.tmp' % (path, os.getpid())
+        if os.access(tmpname, os.F_OK) :
+            os.remove(tmpname)
+        db = sqlite3.connect(tmpname)
+        db.execute('CREATE TABLE users (username TEXT PRIMARY KEY'\
+                   ', hash TEXT)')
+        db.execute('CREATE TABLE accounts (username TEXT, account TEXT'\
+                   ', PRIMARY KEY (username, account))')
+        for username, pwd_hash, accounts in users :
+            db.execute('INSERT OR REPLACE INTO users VALUES (?, ?)'\
+                       , (username, pwd_hash))
+            db.executemany('INSERT OR REPLACE INTO accounts VALUES (?, ?)'\
+                           , [(username, account) for account in accounts])
+        db.execute('CREATE INDEX account_owner ON accounts (account)')
+        db.commit()
+        db.close()
+        os.rename(tmpname, path)
+    compile = classmethod(compile)
+
+    def query(self, sql, args) :
+        self.lock.acquire()
+        try:
+            row = self.db.execute(sql, args).fetchone()
+        finally:
+            self.lock.release()
+        if row is None :
+            return None
+        return row[0]
+
+    def password_hash(self, username) :
+        pwd_hash = self.query('SELECT hash FROM users WHERE username = ?'\
+                              , (username,))
+        if pwd_hash is not None :
+            pwd_hash = str(pwd_hash)
+        return pwd_hash
+
+    def owns(self, username, account) :
+        return self.query('SELECT 1 FROM accounts WHERE username = ?'\
+                          ' AND account = ?', (username, account)) is not None
+
+    def owner(self, account) :
+        owner = self.query('SELECT username FROM accounts WHERE account = ?'\
+                           , (account,))
+        if owner is not None :
+            owner = str(owner)
+        return owner
+
+
+class UserStore(object) :
+    """User table of userconf file reloaded when the file changes.
+
+    path -- userconf file
+    snapshot -- SQLite snapshot file name or None to keep users in memory
+    check_interval -- seconds between checks of userconf modification
+
+    """
+
+    def __init__(self, path, snapshot=None, check_interval=1.0) :
+        self.path = path
+        self.snapshot = snapshot
+        self.check_interval = check_interval
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.lock = threading.Lock()
+        self.checked = 0
+        self.stamp = None
+        self.current = None
+        self.reload()
+
+    def file_stamp(self) :
+        st = os.stat(self.path)
+        return st.st_mtime, st.st_size, st.st_ino
+
+    def load(self, stamp) :
+        if self.snapshot is None :
+            return UserTable(parse_users(open(self.path)))
+        if not os.access(self.snapshot, os.F_OK) \
+               or os.stat(self.snapshot).st_mtime < stamp[0] :
+            SnapshotTable.compile(parse_users(open(self.path))\
+                                  , self.snapshot)
+        return SnapshotTable(self.snapshot)
+
+    def reload(self) :
+        """Load the table if userconf has changed since last load"""
+        self.lock.acquire()
+        try:
+            self.checked = time.time()
+            stamp = self.file_stamp()
+            if stamp != self.stamp :
+                self.current = self.load(stamp)
+                self.stamp = stamp
+                self.logger.info('Users loaded from %s', self.path)
+        finally:
+            self.lock.release()
+
+    def table(self) :
+        """Returns current user table. The table is a consistent
+        snapshot, use the same one for all lookups of a message."""
+        if time.time() - self.checked >= self.check_interval :
+            try:
+                self.reload()
+            except (IOError, OSError, sqlite3.Error), err :
+                self.logger.error('Keeping old users, reload failed: %s'\
+                                  , err)
+        return self.current
@@ -3,10 +3,11 @@ import os
 from lxml import etree
 
 import chaski_plugin
+from chaski_resolver import CachingResolver, HostTable
 from chaski_const import PROCESS_OK, PROCESS_FAIL
 
 FETCH_MSG = etree.XML('''<?xml version='1.0' encoding='UTF-8'?>
-<chaski:Fetch xmlns:chaski="http://www.some.com/chaski">
+<chaski:Fetch xmlns:chaski="urn:chaski:org">
   <chaski:Credentials>
     <chaski:Username>event</chaski:Username>
     <chaski:Password>Chaski</chaski:Password>
@@ -20,7 +21,7 @@ FETCH_MSG = etree.XML('''<?xml version='1.0' encoding='UTF-8'?>
 ''')
 
 USER_MSG = etree.XML('''<?xml version='1.0' encoding='UTF-8'?>
-<chaski:Mail xmlns:chaski="http://www.some.com/chaski">
+<chaski:Mail xmlns:chaski="urn:chaski:org">
   <chaski:Credentials>
     <chaski:Username>event</chaski:Username>
     <chaski:Password>Chaski</chaski:Password>
@@ -33,7 +34,7 @@ USER_MSG = etree.XML('''<?xml version='1.0' encoding='UTF-8'?>
   </chaski:Message>
 </chaski:Mail>''')
 
-USER_MSG_AFTER = '''<chaski:Mail xmlns:chaski="http://www.some.com/chaski">
+USER_MSG_AFTER = '''<chaski:Mail xmlns:chaski="urn:chaski:org">
   <chaski:Credentials>
     <chaski:Username>event</chaski:Username>
     <chaski:Password>Chaski</chaski:Password>
@@ -48,7 +49,7 @@ USER_MSG_AFTER = '''<chaski:Mail xmlns:chaski="http://www.some.com/chaski">
 
 
 EXTERNAL_MSG_POS = etree.XML('''<?xml version='1.0' encoding='UTF-8'?>
-<chaski:Mail xmlns:chaski="http://www.some.com/chaski">
+<chaski:Mail xmlns:chaski="urn:chaski:org">
   <chaski:Message>
       <chaski:From>spam@localhost</chaski:From>
       <chaski:To>maps@sgge.org</chaski:To>
@@ -58,7 +59,7 @@ EXTERNAL_MSG_POS = etree.XML('''<?xml version='1.0' encoding='UTF-8'?>
 </chaski:Mail>''')
 
 EXTERNAL_MSG_NEG = etree.XML('''<?xml version='1.0' encoding='UTF-8'?>
-<chaski:Mail xmlns:chaski="http://www.some.com/chaski">
+<chaski:Mail xmlns:chaski="urn:chaski:org">
   <chaski:Message>
       <chaski:From>spam@not.me</chaski:From>
       <chaski:To>maps@sgge.org</chaski:To>
@@ -82,6 +83,8 @@ class AuthPluginTest(unittest.TestCase) :
         userconf.close()
         self.plugin = chaski_plugin.SimpleUserAuth(
             {'userconf': 'user.conf'})
+        self.plugin.resolver = CachingResolver(\
+            lookup=HostTable({'127.0.0.1': ['localhost']}))
         conf = DummyConf()
         conf.my_name = 'localhost'
         self.plugin.conf = conf
@@ -99,6 +102,11 @@ class AuthPluginTest(unittest.TestCase) :
         self.assertEquals(PROCESS_OK, status)
         self.assertEquals(USER_MSG_AFTER, etree.tostring(out, encoding=unicode))
 
+    def test_wrong_password(self) :
+        mail = etree.XML(etree.tostring(FETCH_MSG).replace('Chaski', 'Eggs'))
+        status, out = self.plugin.process(mail, None)
+        self.assertEquals(PROCESS_FAIL, status)
+        self.assertEquals('No such user "event" or wrong password', out)
 
     def test_ext_auth_pos(self) :
         class FakeSock(object) :
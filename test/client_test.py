@@ -0,0 +1,88 @@
+import unittest
+import os
+import sys
+import shutil
+import thread
+import logging
+import time
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__))\
+                                , os.pardir, 'src', 'client'))
+
+import chaskilib
+import chaski_server
+from chaski_config import ChaskiConfig
+from chaski_store import ReceiveMessageToIndexedStore\
+     , FetchMessagesFromIndexedStore
+from chaski_const import SERVE_THREAD
+
+
+def start_server(basedir, keep_alive=False) :
+    params = {'basedir': basedir}
+    conf = ChaskiConfig.__new__(ChaskiConfig)
+    conf.from_params(port=0, plugins=[ReceiveMessageToIndexedStore(params)\
+                                      , FetchMessagesFromIndexedStore(params)]\
+                     , serve_mode=SERVE_THREAD, workers=2, validation='none'\
+                     , my_name='localhost', keep_alive=keep_alive\
+                     , keep_alive_timeout=10)
+    sock = chaski_server.init_serv_sock(0, 10)
+    thread.start_new_thread(chaski_server.serve_threads\
+        , ([(sock, conf.listeners[0])], logging.getLogger('client_test')\
+           , conf))
+    return ('127.0.0.1', sock.getsockname()[1])
+
+
+class ClientTest(unittest.TestCase) :
+    def setUp(self) :
+        self.dir = tempfile.mkdtemp()
+        self.address = start_server(self.dir)
+
+    def tearDown(self) :
+        shutil.rmtree(self.dir)
+
+    def send(self, subjects) :
+        messages = [chaskilib.create_message('spam@localhost'\
+            , ['user1@localhost'], None, subject\
+            , [('Text', 'text/plain', 'eggs')])\
+                    for subject in subjects]
+        return chaskilib.send_messages(self.address, ('event', 'Chaski')\
+                                       , messages)
+
+    def test_round_trip(self) :
+        self.assertEquals((True, 'Success'), self.send(['a', 'b', 'c']))
+        ok, messages = chaskilib.fetch_messages(self.address\
+            , ('event', 'Chaski'), ['user1'], page_messages=2)
+        self.assertTrue(ok)
+        self.assertEquals(['a', 'b', 'c']\
+                          , sorted([message[3] for message in messages]))
+        self.assertEquals([('Text', 'text/plain', 'eggs', None)]\
+                          , messages[0][4])
+
+    def test_pages(self) :
+        self.send(['a', 'b', 'c'])
+        pages = chaskilib.fetch_pages(self.address, ('event', 'Chaski')\
+            , ['user1'], {'OnlyHeader': 'true'}, page_messages=2)
+        self.assertEquals([2, 1], [len(page) for page in pages])
+
+    def test_keep_alive(self) :
+        # the client stops at the end of Result, not when
+        # the server closes the kept connection
+        self.address = start_server(self.dir, True)
+        started = time.time()
+        self.assertEquals((True, 'Success'), self.send(['a']))
+        ok, messages = chaskilib.fetch_messages(self.address\
+            , ('event', 'Chaski'), ['user1'])
+        self.assertTrue(ok)
+        self.assertEquals(['a'], [message[3] for message in messages])
+        self.assertTrue(time.time() - started < 5)
+
+    def test_failure(self) :
+        ok, err = chaskilib.fetch_messages(self.address, ('event', 'Chaski')\
+            , ['user1'], {'Cursor': 'spam'})
+        self.assertFalse(ok)
+        self.assertTrue(str(err).startswith('Bad fetch conditions'))
+
+
+if __name__ == '__main__' :
+    unittest.main()
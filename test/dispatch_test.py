@@ -0,0 +1,73 @@
+import unittest
+from lxml import etree
+
+import chaski_plugin
+from chaski_config import DispatchTable
+from chaski_const import MATCH_ALWAYS
+
+MAIL = etree.XML('<chaski:Mail xmlns:chaski="urn:chaski:org">'\
+                 '<chaski:Credentials/></chaski:Mail>')
+FETCH = etree.XML('<chaski:Fetch xmlns:chaski="urn:chaski:org"/>')
+OTHER = etree.XML('<note/>')
+
+
+class AnyPlugin(chaski_plugin.ChaskiPlugin) :
+    match = chaski_plugin.ChaskiPlugin.match_any
+
+
+class XPathPlugin(chaski_plugin.ChaskiPlugin) :
+    match = chaski_plugin.ChaskiPlugin.xpath_exists
+
+
+class CountingPlugin(chaski_plugin.ChaskiPlugin) :
+    calls = 0
+    def match(self, message) :
+        self.calls += 1
+        return True
+
+
+class DispatchTableTest(unittest.TestCase) :
+    def setUp(self) :
+        self.auth = AnyPlugin({})
+        self.receive = chaski_plugin.ReceiveMessage({})
+        self.fetch = chaski_plugin.FetchMessage({})
+        self.send = XPathPlugin({'match_xpath': 'chaski:Credentials'})
+        self.custom = CountingPlugin({})
+        self.table = DispatchTable([self.auth, self.receive, self.fetch\
+                                    , self.send, self.custom])
+
+    def test_dispatch_keys(self) :
+        self.assertEquals(MATCH_ALWAYS, self.auth.dispatch_key())
+        self.assertEquals('{urn:chaski:org}Mail'\
+                          , self.receive.dispatch_key())
+        self.assertEquals(None, self.send.dispatch_key())
+        self.assertEquals(None, self.custom.dispatch_key())
+
+    def test_mail(self) :
+        self.assertEquals([self.auth, self.receive, self.send, self.custom]\
+                          , self.table.resolve(MAIL))
+
+    def test_fetch(self) :
+        self.assertEquals([self.auth, self.fetch, self.custom]\
+                          , self.table.resolve(FETCH))
+
+    def test_pipeline(self) :
+        table = DispatchTable([self.auth, self.receive, self.fetch\
+                               , self.send, self.custom], 2)
+        self.assertEquals(table.resolve(MAIL), list(table.pipeline(MAIL)))
+        self.assertEquals(table.resolve(FETCH), list(table.pipeline(FETCH)))
+
+    def test_pipeline_close(self) :
+        table = DispatchTable([self.auth, self.custom], 1)
+        plugins = table.pipeline(MAIL)
+        self.assertEquals(self.auth, plugins.next())
+        plugins.close()
+        self.assertRaises(StopIteration, plugins.next)
+
+    def test_unknown_root(self) :
+        self.assertEquals([self.auth, self.custom], self.table.resolve(OTHER))
+        self.assertEquals(1, self.custom.calls)
+
+
+if __name__ == '__main__' :
+    unittest.main()
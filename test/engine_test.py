@@ -0,0 +1,154 @@
+import unittest
+import time
+import socket
+import thread
+import logging
+import Queue
+from lxml import etree
+
+from chaski_engine import EventLoopServer
+from chaski_config import ChaskiConfig
+from chaski_server import init_serv_sock, close_socket
+from chaski_pool import WorkerPool
+from chaski_reader import MessageTooBig, StructureError
+from chaski_const import RESULT_MESSAGE
+from relay_test import MAIL
+
+
+class RefusingPool(object) :
+    def submit(self, func, *args) :
+        return False
+
+
+class EventLoopServerTest(unittest.TestCase) :
+    """Callbacks put (event, sock, details) into self.events"""
+
+    def setUp(self) :
+        self.events = Queue.Queue()
+        self.keep = False
+
+    def start(self, pool=None, **params) :
+        conf = ChaskiConfig.__new__(ChaskiConfig)
+        params.setdefault('validation', 'structural')
+        params.setdefault('keep_alive_timeout', 0.5)
+        conf.from_params(port=0, my_name='localhost', **params)
+        logger = logging.getLogger('engine_test')
+        if pool is None :
+            pool = WorkerPool(2, 4, 8, logger)
+        sock = init_serv_sock(0, 10)
+        self.server = EventLoopServer([(sock, conf.listeners[0])], conf\
+            , logger, pool, self.on_message, self.on_error, self.on_overload)
+        thread.start_new_thread(self.server.serve_forever, ())
+        return sock.getsockname()[1]
+
+    def on_message(self, message, sock, address_info) :
+        subject = message.findtext('.//{urn:chaski:org}Subject')
+        self.events.put(('message', sock, subject))
+        sock.sendall(RESULT_MESSAGE % ('Success', subject))
+        if not self.keep :
+            close_socket(sock)
+        return self.keep
+
+    def on_error(self, sock, address_info, ex) :
+        self.events.put(('error', sock, ex))
+        close_socket(sock)
+
+    def on_overload(self, sock, address_info) :
+        self.events.put(('overload', sock, None))
+        close_socket(sock)
+
+    def event(self) :
+        return self.events.get(timeout=5)
+
+    def connect(self, port) :
+        client = socket.create_connection(('127.0.0.1', port))
+        client.settimeout(5)
+        return client
+
+    def result(self, client) :
+        data = ''
+        while '</chaski:Result>' not in data :
+            chunk = client.recv(4096)
+            if not chunk :
+                break
+            data += chunk
+        return etree.XML(data)[1].text
+
+    def closed(self, client) :
+        try:
+            return client.recv(1) == ''
+        except socket.error :
+            return True
+
+    def test_small_sends(self) :
+        port = self.start()
+        client = self.connect(port)
+        data = MAIL % 'eggs'
+        for i in range(0, len(data), 7) :
+            client.sendall(data[i:i+7])
+            time.sleep(0.001)
+        self.assertEquals('eggs', self.event()[2])
+        self.assertEquals('eggs', self.result(client))
+        self.assertTrue(self.closed(client))
+
+    def test_kept_alive(self) :
+        self.keep = True
+        port = self.start()
+        client = self.connect(port)
+        subjects = ['a', 'b', 'c']
+        for subject in subjects :
+            client.sendall(MAIL % subject)
+            self.assertEquals(subject, self.result(client))
+        events = [self.event() for subject in subjects]
+        self.assertEquals(subjects, [event[2] for event in events])
+        # all the messages came on one connection
+        self.assertEquals(1, len(set([event[1] for event in events])))
+
+    def test_overload(self) :
+        port = self.start(RefusingPool())
+        client = self.connect(port)
+        client.sendall(MAIL % 'eggs')
+        self.assertEquals('overload', self.event()[0])
+        self.assertTrue(self.closed(client))
+        self.assertEquals({}, self.server.connections)
+
+    def test_invalid(self) :
+        # validated by the worker, the loop only parses
+        port = self.start()
+        client = self.connect(port)
+        client.sendall((MAIL % 'eggs').replace('Subject', 'Topic'))
+        event, sock, ex = self.event()
+        self.assertEquals('error', event)
+        self.assertTrue(isinstance(ex, StructureError))
+
+    def test_too_big(self) :
+        port = self.start(max_message_size=100)
+        client = self.connect(port)
+        client.sendall(MAIL % 'eggs')
+        event, sock, ex = self.event()
+        self.assertTrue(isinstance(ex, MessageTooBig))
+
+    def test_close_idle(self) :
+        self.keep = True
+        port = self.start(keep_alive_timeout=0.2)
+        client = self.connect(port)
+        client.sendall(MAIL % 'eggs')
+        self.assertEquals('eggs', self.result(client))
+        started = time.time()
+        self.assertTrue(self.closed(client))
+        self.assertTrue(time.time() - started < 2)
+        time.sleep(0.1)
+        self.assertEquals({}, self.server.connections)
+
+    def test_close_half_read(self) :
+        port = self.start()
+        client = self.connect(port)
+        client.sendall((MAIL % 'eggs')[:50])
+        client.close()
+        event, sock, ex = self.event()
+        self.assertEquals('error', event)
+        self.assertEquals({}, self.server.connections)
+
+
+if __name__ == '__main__' :
+    unittest.main()
@@ -0,0 +1,141 @@
+import unittest
+import os
+import socket
+import shutil
+import copy
+import tempfile
+from lxml import etree
+
+from chaski_plugin import ReceiveMessageToPlainFile\
+     , FetchMessagesFromPlainFile, FetchConditions, send_chunks\
+     , encode_cursor, FLUSH
+from chaski_const import PROCESS_OK, PROCESS_FAIL
+
+NS = '{urn:chaski:org}'
+
+MESSAGE = etree.XML('''<chaski:Mail xmlns:chaski="urn:chaski:org">
+  <chaski:Message>
+      <chaski:From>spam@localhost</chaski:From>
+      <chaski:To>user1@localhost</chaski:To>
+      <chaski:Subject>Shalom Haolam!</chaski:Subject>
+      <chaski:Chapter>
+	<chaski:ChapterName>Text</chaski:ChapterName>
+	<chaski:MIMEType>text/plain</chaski:MIMEType>
+	<chaski:ChapterContent>%s</chaski:ChapterContent>
+      </chaski:Chapter>
+  </chaski:Message>
+</chaski:Mail>''' % ('spam ' * 40000))[0]
+
+FETCH = etree.XML('''<chaski:Fetch xmlns:chaski="urn:chaski:org">
+  <chaski:Credentials>
+    <chaski:Username>event</chaski:Username>
+    <chaski:Password>Chaski</chaski:Password>
+  </chaski:Credentials>
+  <chaski:To>user1</chaski:To>
+  <chaski:Conditions>
+    <chaski:OnlyHeader>false</chaski:OnlyHeader>
+    <chaski:RemoveAfterFetch>true</chaski:RemoveAfterFetch>
+  </chaski:Conditions>
+</chaski:Fetch>''')
+
+
+def fetch_pages(fetcher, accounts, **conds) :
+    """Sizes of pages fetched by fetcher with cursors one by one"""
+    sizes = []
+    cursor = None
+    while True :
+        mail = etree.XML(''.join(fetcher.fetch(accounts\
+            , FetchConditions(cursor=cursor, **conds))))
+        sizes.append(len(mail.findall(NS + 'Message')))
+        cursor = mail.findtext(NS + 'NextCursor')
+        if cursor is None :
+            return sizes
+
+
+class FakeSock(object) :
+    def __init__(self, fail_after=None) :
+        self.sent = []
+        self.fail_after = fail_after
+
+    def sendall(self, data) :
+        if self.fail_after is not None \
+               and len(self.sent) >= self.fail_after :
+            raise socket.error(32, 'Broken pipe')
+        self.sent.append(data)
+
+
+class StreamingFetchTest(unittest.TestCase) :
+    def setUp(self) :
+        self.dir = tempfile.mkdtemp()
+        ReceiveMessageToPlainFile({'basedir': self.dir})\
+            .store(['user1'], MESSAGE)
+        self.fetcher = FetchMessagesFromPlainFile({'basedir': self.dir})
+
+    def tearDown(self) :
+        shutil.rmtree(self.dir)
+
+    def messages(self) :
+        return [f for f in os.listdir(os.path.join(self.dir, 'user1'))\
+                if not f.startswith('.')]
+
+    def test_streamed(self) :
+        sock = FakeSock()
+        status, out = self.fetcher.process(FETCH, sock)
+        self.assertEquals(PROCESS_OK, status)
+        self.assertTrue(len(sock.sent) > 1)
+        mail = etree.XML(''.join(sock.sent))
+        self.assertEquals(etree.tostring(MESSAGE), etree.tostring(mail[0]))
+        self.assertEquals([], self.messages())
+
+    def test_kept_on_failure(self) :
+        status, out = self.fetcher.process(FETCH, FakeSock(fail_after=1))
+        self.assertEquals(PROCESS_FAIL, status)
+        self.assertEquals(1, len(self.messages()))
+
+    def fetch_page(self, conds) :
+        fetch = copy.deepcopy(FETCH)
+        conditions = fetch.find(NS + 'Conditions')
+        for name, value in conds :
+            etree.SubElement(conditions, NS + name).text = value
+        sock = FakeSock()
+        status, out = self.fetcher.process(fetch, sock)
+        return status, out, sock
+
+    def test_pages(self) :
+        for i in range(2) :
+            ReceiveMessageToPlainFile({'basedir': self.dir})\
+                .store(['user1'], MESSAGE)
+        cursor = None
+        sizes = []
+        while True :
+            conds = [('MaxMessages', '2')]
+            if cursor is not None :
+                conds.append(('Cursor', cursor))
+            status, out, sock = self.fetch_page(conds)
+            self.assertEquals(PROCESS_OK, status)
+            mail = etree.XML(''.join(sock.sent))
+            sizes.append(len(mail.findall(NS + 'Message')))
+            cursor = mail.findtext(NS + 'NextCursor')
+            if cursor is None :
+                break
+        self.assertEquals([2, 1], sizes)
+        self.assertEquals([], self.messages())
+
+    def test_bad_cursor(self) :
+        status, out, sock = self.fetch_page([('Cursor', '!')])
+        self.assertEquals(PROCESS_FAIL, status)
+        cursor = encode_cursor('user2', '0')
+        status, out, sock = self.fetch_page([('Cursor', cursor)])
+        self.assertEquals(PROCESS_FAIL, status)
+        self.assertEquals([], sock.sent)
+        self.assertEquals(1, len(self.messages()))
+
+    def test_send_chunks(self) :
+        sock = FakeSock()
+        self.assertEquals(7, send_chunks(sock, ['ab', 'c', FLUSH, 'defg']\
+                                         , buffer_size=4))
+        self.assertEquals(['abc', 'defg'], sock.sent)
+
+
+if __name__ == '__main__' :
+    unittest.main()
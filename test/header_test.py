@@ -0,0 +1,96 @@
+import unittest
+import os
+import shutil
+import tempfile
+from lxml import etree
+
+from chaski_plugin import make_header, content_size\
+     , ReceiveMessageToPlainFile, FetchMessagesFromPlainFile\
+     , FetchConditions, HEADERS_DIR
+
+MESSAGE = etree.XML('''<chaski:Mail xmlns:chaski="urn:chaski:org">
+  <chaski:Message>
+      <chaski:From>spam@localhost</chaski:From>
+      <chaski:To>user1@localhost</chaski:To>
+      <chaski:Subject>Shalom Haolam!</chaski:Subject>
+      <chaski:Chapter>
+	<chaski:ChapterName>Text</chaski:ChapterName>
+	<chaski:MIMEType>text/html</chaski:MIMEType>
+	<chaski:ChapterContent>tru &lt;br>la</chaski:ChapterContent>
+      </chaski:Chapter>
+      <chaski:Chapter>
+	<chaski:ChapterName>Photo</chaski:ChapterName>
+	<chaski:MIMEType>image/png</chaski:MIMEType>
+	<chaski:ChapterContent encoding='base64'>c3BhbQ==</chaski:ChapterContent>
+      </chaski:Chapter>
+  </chaski:Message>
+</chaski:Mail>''')[0]
+
+HEADER = '''<chaski:Message xmlns:chaski="urn:chaski:org">
+      <chaski:From>spam@localhost</chaski:From>
+      <chaski:To>user1@localhost</chaski:To>
+      <chaski:Subject>Shalom Haolam!</chaski:Subject>
+      <chaski:Chapter size="10">
+	<chaski:ChapterName>Text</chaski:ChapterName>
+	<chaski:MIMEType>text/html</chaski:MIMEType>
+	</chaski:Chapter>
+      <chaski:Chapter size="4">
+	<chaski:ChapterName>Photo</chaski:ChapterName>
+	<chaski:MIMEType>image/png</chaski:MIMEType>
+	</chaski:Chapter>
+  </chaski:Message>
+'''
+
+
+class DummyConf(object) :
+    __slots__ = ['my_name']
+
+
+class HeaderTest(unittest.TestCase) :
+    def test_make_header(self) :
+        self.assertEquals(HEADER, make_header(MESSAGE))
+
+    def test_content_size(self) :
+        content = etree.Element('ChapterContent', encoding='hex')
+        content.text = '7370616d'
+        self.assertEquals(4, content_size(content))
+        content = etree.Element('ChapterContent')
+        content.text = u'\u0448\u0430\u043b\u043e\u043c'
+        self.assertEquals(10, content_size(content))
+
+
+class PlainFileHeaderTest(unittest.TestCase) :
+    def setUp(self) :
+        self.dir = tempfile.mkdtemp()
+        self.receive = ReceiveMessageToPlainFile({'basedir': self.dir})
+        self.fetcher = FetchMessagesFromPlainFile({'basedir': self.dir})
+
+    def tearDown(self) :
+        shutil.rmtree(self.dir)
+
+    def fetch(self, **conds) :
+        mail = etree.XML(''.join(self.fetcher.fetch(['user1', 'user2']\
+            , FetchConditions(**conds))))
+        return [etree.tostring(m) for m in mail]
+
+    def test_header_files(self) :
+        self.receive.store(['user1', 'user2'], MESSAGE)
+        self.assertEquals(1, len(os.listdir(os.path.join(self.dir, 'user2'\
+                                                         , HEADERS_DIR))))
+        self.assertEquals([HEADER, HEADER], self.fetch(onlyheaders='true'))
+        self.assertEquals(2, len(self.fetch(removeafter='true')))
+        self.assertEquals([], os.listdir(os.path.join(self.dir, 'user1'\
+                                                      , HEADERS_DIR)))
+
+    def test_without_header_file(self) :
+        self.receive.store(['user1', 'user2'], MESSAGE)
+        for user in ['user1', 'user2'] :
+            headers = os.path.join(self.dir, user, HEADERS_DIR)
+            map(os.remove, [os.path.join(headers, fname)\
+                            for fname in os.listdir(headers)])
+        self.assertEquals([HEADER.strip()] * 2\
+                          , [h.strip() for h in self.fetch(onlyheaders='1')])
+
+
+if __name__ == '__main__' :
+    unittest.main()
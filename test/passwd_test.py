@@ -0,0 +1,58 @@
+import unittest
+import time
+
+from chaski_passwd import make_hash, verify_password, CredentialCache
+
+
+class PasswordTest(unittest.TestCase) :
+    def test_pbkdf2(self) :
+        pwd_hash = make_hash('Chaski', iterations=1000)
+        self.assertTrue(pwd_hash.startswith('pbkdf2_sha256$1000$'))
+        self.assertTrue(verify_password(pwd_hash, 'Chaski'))
+        self.assertFalse(verify_password(pwd_hash, 'chaski'))
+
+    def test_salted(self) :
+        self.assertNotEquals(make_hash('Chaski', iterations=1000)\
+                             , make_hash('Chaski', iterations=1000))
+
+    def test_legacy_md5(self) :
+        self.assertTrue(verify_password('f4d5d8f67597b3166b042c81a581bfea'\
+                                        , 'Chaski'))
+        self.assertFalse(verify_password('f4d5d8f67597b3166b042c81a581bfea'\
+                                         , 'Spam'))
+
+    def test_broken_hash(self) :
+        self.assertFalse(verify_password('pbkdf2_sha256$x$y', 'Chaski'))
+
+
+class CredentialCacheTest(unittest.TestCase) :
+    def test_cache(self) :
+        cache = CredentialCache()
+        key = cache.key('event', 'Chaski', 'hash')
+        self.assertFalse(cache.verified(key))
+        cache.add(key)
+        self.assertTrue(cache.verified(key))
+        self.assertFalse(cache.verified(cache.key('event', 'Chaski', 'new')))
+        stats = cache.stats()
+        self.assertEquals(1, stats['hits'])
+        self.assertEquals(2, stats['misses'])
+
+    def test_expire(self) :
+        cache = CredentialCache(ttl=0.05)
+        key = cache.key('event', 'Chaski', 'hash')
+        cache.add(key)
+        time.sleep(0.1)
+        self.assertFalse(cache.verified(key))
+
+    def test_bounded(self) :
+        cache = CredentialCache(max_entries=2)
+        keys = [cache.key('user%d' % i, 'pwd', 'hash') for i in range(3)]
+        for key in keys :
+            cache.add(key)
+        self.assertEquals(2, cache.stats()['entries'])
+        self.assertFalse(cache.verified(keys[0]))
+        self.assertTrue(cache.verified(keys[2]))
+
+
+if __name__ == '__main__' :
+    unittest.main()
@@ -0,0 +1,43 @@
+import unittest
+import threading
+import logging
+import time
+
+from chaski_pool import WorkerPool
+
+
+class WorkerPoolTest(unittest.TestCase) :
+    def setUp(self) :
+        self.gate = threading.Event()
+        self.pool = WorkerPool(1, 2, 3, logging.getLogger('pool_test'))
+
+    def tearDown(self) :
+        self.gate.set()
+
+    def test_run(self) :
+        done = threading.Event()
+        self.assertTrue(self.pool.submit(done.set))
+        done.wait(5)
+        self.assertTrue(done.isSet())
+
+    def test_max_in_flight(self) :
+        self.assertTrue(self.pool.submit(self.gate.wait))
+        time.sleep(0.1) # let the worker take the first job
+        for i in range(2) :
+            self.assertTrue(self.pool.submit(self.gate.wait))
+        self.assertFalse(self.pool.submit(self.gate.wait))
+        stats = self.pool.stats()
+        self.assertEquals(3, stats['in_flight'])
+        self.assertEquals(1, stats['rejected'])
+
+    def test_queue_size(self) :
+        pool = WorkerPool(1, 1, 10, logging.getLogger('pool_test'))
+        self.assertTrue(pool.submit(self.gate.wait))
+        time.sleep(0.1) # let the worker take the first job
+        self.assertTrue(pool.submit(self.gate.wait))
+        self.assertFalse(pool.submit(self.gate.wait))
+        self.assertEquals(1, pool.stats()['queued'])
+
+
+if __name__ == '__main__' :
+    unittest.main()
@@ -0,0 +1,117 @@
+import unittest
+import os
+import errno
+import signal
+import socket
+import shutil
+import logging
+import logging.config
+import tempfile
+
+import chaski_prefork
+from chaski_prefork import PreforkMaster
+
+LOG_CONF = os.path.join(os.path.dirname(chaski_prefork.__file__)\
+                        , 'logger_conf.ini')
+
+
+class PreforkMasterTest(unittest.TestCase) :
+    """The master runs in a forked process, its workers report
+    their pids through a pipe and serve a shared socket"""
+
+    def setUp(self) :
+        self.logdir = tempfile.mkdtemp()
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(10)
+        self.address = self.server.getsockname()
+        self.pipe, self.pipe_write = os.pipe()
+        self.master = os.fork()
+        if self.master == 0 :
+            status = 1
+            try:
+                signal.alarm(30)
+                os.close(self.pipe)
+                os.chdir(self.logdir)
+                # as the server does before forking, and every worker
+                # with its own configuration
+                logging.config.fileConfig(LOG_CONF)
+                logging.getLogger().info('master')
+                chaski_prefork.RESPAWN_DELAY = 0
+                try:
+                    PreforkMaster(3, self.worker, logging.getLogger()).run()
+                except SystemExit :
+                    status = 0
+            finally:
+                os._exit(status)
+        os.close(self.pipe_write)
+        self.server.close()
+        self.pipe_file = os.fdopen(self.pipe)
+
+    def tearDown(self) :
+        if self.master :
+            try:
+                os.kill(self.master, signal.SIGKILL)
+                os.waitpid(self.master, 0)
+            except OSError :
+                pass
+        self.pipe_file.close()
+        shutil.rmtree(self.logdir)
+
+    def worker(self) :
+        logging.config.fileConfig(LOG_CONF)
+        logging.getLogger().info('worker %d', os.getpid())
+        os.write(self.pipe_write, '%d\n' % os.getpid())
+        while True :
+            conn, address = self.server.accept()
+            conn.sendall('%d' % os.getpid())
+            conn.close()
+
+    def started(self) :
+        return int(self.pipe_file.readline())
+
+    def served_by(self) :
+        client = socket.create_connection(self.address)
+        client.settimeout(5)
+        try:
+            return int(client.recv(32))
+        finally:
+            client.close()
+
+    def alive(self, pid) :
+        try:
+            os.kill(pid, 0)
+        except OSError, err :
+            if err.errno == errno.ESRCH :
+                return False
+            raise
+        return True
+
+    def test_respawn(self) :
+        workers = set([self.started() for i in range(3)])
+        self.assertEquals(3, len(workers))
+        self.assertTrue(self.served_by() in workers)
+        killed = workers.pop()
+        os.kill(killed, signal.SIGKILL)
+        respawned = self.started()
+        self.assertFalse(respawned in workers or respawned == killed)
+        workers.add(respawned)
+        for i in range(5) :
+            self.assertTrue(self.served_by() in workers)
+        os.kill(self.master, signal.SIGTERM)
+        pid, status = os.waitpid(self.master, 0)
+        self.master = None
+        self.assertEquals(0, status)
+        # the master has reaped every worker before exiting
+        for pid in workers :
+            self.assertFalse(self.alive(pid))
+        # the log configuration is applied by every worker, none of
+        # them truncates the log
+        log = open(os.path.join(self.logdir, 'chaski.log')).read()
+        self.assertTrue(' master' in log)
+        for pid in workers | set([killed]) :
+            self.assertTrue(' worker %d' % pid in log)
+
+
+if __name__ == '__main__' :
+    unittest.main()
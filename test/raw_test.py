@@ -0,0 +1,178 @@
+import unittest
+import os
+import shutil
+import tempfile
+from lxml import etree
+
+import chaski_raw
+from chaski_reader import MessageReader
+from chaski_raw import RawMail, register, release, message_bytes\
+     , mail_chunks, mail_size, mark_mutated, mail_context
+from chaski_plugin import ChaskiPlugin, ReceiveMessageToPlainFile
+from chaski_const import PROCESS_OK
+import chaski_server
+
+NS = '{urn:chaski:org}'
+
+MAIL = '''<?xml version='1.0' encoding='UTF-8'?>
+<chaski:Mail xmlns:chaski="urn:chaski:org">
+  <!-- <chaski:Message> -->
+  <chaski:Message>
+      <chaski:From>spam@localhost</chaski:From>
+      <chaski:To>user1@localhost</chaski:To>
+      <chaski:SecretTo>user2@localhost</chaski:SecretTo>
+      <chaski:Subject a="1 > 0">Shalom Haolam!</chaski:Subject>
+      <chaski:Chapter>
+	<chaski:ChapterName>Text</chaski:ChapterName>
+	<chaski:MIMEType>text/plain</chaski:MIMEType>
+	<chaski:ChapterContent><![CDATA[</chaski:Message>]]> &#1488;</chaski:ChapterContent>
+      </chaski:Chapter>
+  </chaski:Message>
+  <chaski:Message xmlns:chaski="urn:chaski:org"><chaski:From>eggs</chaski:From><chaski:Subject/><chaski:Chapter/></chaski:Message>
+</chaski:Mail>
+'''
+
+
+class RawMailTest(unittest.TestCase) :
+    def setUp(self) :
+        reader = MessageReader(len(MAIL))
+        for i in range(0, len(MAIL), 7) :
+            mail = reader.feed(MAIL[i:i+7])
+        self.mail = mail
+        self.messages = mail.findall(NS + 'Message')
+        register(mail, reader.raw)
+
+    def tearDown(self) :
+        release(self.mail)
+
+    def assertSameXML(self, message, data) :
+        self.assertEquals(etree.tostring(message, with_tail=False)\
+                          , etree.tostring(etree.XML(data)))
+
+    def test_messages(self) :
+        for message in self.messages :
+            data = message_bytes(message)
+            self.assertTrue(data in MAIL.replace('<chaski:Message>'\
+                , '<chaski:Message xmlns:chaski="urn:chaski:org">'))
+            self.assertSameXML(message, data)
+
+    def test_mail(self) :
+        self.assertEquals(MAIL.rstrip(), ''.join([chunk.tobytes()\
+            for chunk in mail_chunks(self.mail)]))
+        self.assertEquals(len(MAIL.rstrip()), mail_size(self.mail))
+
+    def test_removed_child(self) :
+        message = self.messages[0]
+        secret = message.find(NS + 'SecretTo')
+        message.remove(secret)
+        data = message_bytes(message)
+        self.assertFalse('SecretTo' in data)
+        self.assertSameXML(message, data)
+        self.assertEquals(etree.tostring(self.mail), ''.join(\
+            mail_chunks(self.mail)))
+        message.find(NS + 'Subject').addprevious(secret)
+        self.assertEquals(MAIL.rstrip(), ''.join([chunk.tobytes()\
+            for chunk in mail_chunks(self.mail)]))
+
+    def test_mutated(self) :
+        sender = self.messages[0].find(NS + 'From')
+        sender.text = 'ham@localhost'
+        mark_mutated(sender)
+        self.assertEquals(etree.tostring(self.messages[0])\
+                          , message_bytes(self.messages[0]))
+        self.assertTrue(message_bytes(self.messages[1]) in MAIL)
+        self.assertEquals(etree.tostring(self.mail), ''.join(\
+            mail_chunks(self.mail)))
+
+    def test_other_encoding(self) :
+        data = MAIL.replace('UTF-8', 'ISO-8859-1')
+        mail = etree.XML(data)
+        raw = RawMail(data, mail)
+        self.assertEquals(None, raw.message_chunks(mail[0]))
+        self.assertEquals(None, raw.mail_chunks())
+
+    def test_unregistered(self) :
+        mail = etree.XML(MAIL)
+        self.assertEquals(etree.tostring(mail[0]), message_bytes(mail[0]))
+
+    def test_plain_file(self) :
+        basedir = tempfile.mkdtemp()
+        try:
+            ReceiveMessageToPlainFile({'basedir': basedir})\
+                .store(['user1'], self.messages[1])
+            fname, = [f for f in os.listdir(os.path.join(basedir, 'user1'))\
+                      if not f.startswith('.')]
+            data = open(os.path.join(basedir, 'user1', fname)).read()
+            self.assertEquals(message_bytes(self.messages[1]), data)
+            self.assertSameXML(self.messages[1], data)
+        finally:
+            shutil.rmtree(basedir)
+
+
+class RenamingPlugin(ChaskiPlugin) :
+    mutates = True
+
+    def process(self, mail, src_sock) :
+        self.size = mail_size(mail)
+        for subject in mail.iter(NS + 'Subject') :
+            subject.text = 'eggs'
+        return PROCESS_OK, mail
+
+
+class FakeSock(object) :
+    def sendall(self, data) :
+        pass
+
+    def close(self) :
+        pass
+
+
+class MailContextTest(unittest.TestCase) :
+    def setUp(self) :
+        self.mail = etree.XML(MAIL)
+        self.messages = self.mail.findall(NS + 'Message')
+        self.context = register(self.mail)
+
+    def tearDown(self) :
+        release(self.mail)
+
+    def test_cached(self) :
+        size = mail_size(self.mail)
+        self.assertEquals(len(etree.tostring(self.mail)), size)
+        self.assertEquals(etree.tostring(self.messages[0])\
+                          , message_bytes(self.messages[0]))
+        mail_chunks(self.mail)
+        message_bytes(self.messages[0])
+        self.assertEquals(2, self.context.serializations)
+
+    def test_removed_child(self) :
+        message = self.messages[0]
+        message_bytes(message)
+        secret = message.find(NS + 'SecretTo')
+        message.remove(secret)
+        self.assertFalse('SecretTo' in message_bytes(message))
+        self.assertEquals(2, self.context.serializations)
+
+    def test_mutated(self) :
+        mail_size(self.mail)
+        message_bytes(self.messages[1])
+        sender = self.messages[0].find(NS + 'From')
+        sender.text = 'ham@localhost'
+        mark_mutated(sender)
+        self.assertTrue('ham@localhost' in message_bytes(self.messages[0]))
+        self.assertEquals(len(etree.tostring(self.mail))\
+                          , mail_size(self.mail))
+        message_bytes(self.messages[1])
+        self.assertEquals(4, self.context.serializations)
+
+    def test_run_plugins(self) :
+        plugins = [RenamingPlugin({}), RenamingPlugin({})]
+        logger = chaski_server.logging.getLogger('raw_test')
+        self.assertTrue(chaski_server.run_plugins(plugins, self.mail\
+                                                  , FakeSock(), logger))
+        self.assertEquals(len(etree.tostring(self.mail)), plugins[1].size)
+        self.assertEquals(None, mail_context(self.mail))
+
+
+if __name__ == '__main__' :
+    unittest.main()
@@ -0,0 +1,250 @@
+import unittest
+import socket
+import shutil
+import logging
+import tempfile
+from lxml import etree
+
+from chaski_reader import MessageReader, ConnectionClosed, StructureError\
+     , MessageTooBig, structural_check, schema_validator
+from chaski_spill import Spiller
+from chaski_config import ChaskiConfig, Listener, MessageSizeLimits
+from chaski_server import process_message
+from chaski_plugin import ChaskiPlugin
+
+SCHEMA = etree.XMLSchema(etree.XML('''<?xml version="1.0" encoding="UTF-8"?>
+<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema"
+	   xmlns="urn:chaski:org"
+	   targetNamespace="urn:chaski:org"
+	   elementFormDefault="qualified">
+  <xs:element name="Fetch">
+    <xs:complexType>
+      <xs:sequence>
+	<xs:element name="To" type="xs:string" maxOccurs="unbounded"/>
+      </xs:sequence>
+    </xs:complexType>
+  </xs:element>
+</xs:schema>'''))
+
+TEST_MSG = '''<?xml version='1.0' encoding='UTF-8'?>
+<chaski:Fetch xmlns:chaski="urn:chaski:org">
+  <chaski:To>user1</chaski:To>
+  <chaski:To>user2</chaski:To>
+</chaski:Fetch>'''
+
+BAD_MSG = '''<chaski:Fetch xmlns:chaski="urn:chaski:org">
+  <chaski:From>user1</chaski:From>
+</chaski:Fetch>'''
+
+STRUCT_MSG = '''<chaski:Mail xmlns:chaski="urn:chaski:org">
+  <chaski:Message>
+      <chaski:From>spam</chaski:From>
+      <chaski:Subject>eggs</chaski:Subject>
+  </chaski:Message>
+</chaski:Mail>'''
+
+CREDS_MSG = '''<chaski:Mail xmlns:chaski="urn:chaski:org">
+  <chaski:Credentials>
+      <chaski:Username>bulk</chaski:Username>
+      <chaski:Password>eggs</chaski:Password>
+  </chaski:Credentials>
+  <chaski:Message>
+      <chaski:From>bulk</chaski:From>
+      <chaski:Subject>%s</chaski:Subject>
+  </chaski:Message>
+</chaski:Mail>''' % ('spam ' * 1000)
+CREDS_END = CREDS_MSG.index('<chaski:Message>') + len('<chaski:Message>')
+
+
+def verify(username, password) :
+    return (username, password) == ('bulk', 'eggs')
+
+
+class Auth(ChaskiPlugin) :
+    match = ChaskiPlugin.match_any
+
+    def credsok(self, username, password) :
+        return verify(username, password)
+
+
+class MessageReaderTest(unittest.TestCase) :
+
+    def test_feed_by_byte(self) :
+        reader = MessageReader(len(TEST_MSG), schema_validator(SCHEMA))
+        for char in TEST_MSG[:-1] :
+            self.assertEquals(None, reader.feed(char))
+        message = reader.feed(TEST_MSG[-1])
+        self.assertEquals('{urn:chaski:org}Fetch', message.tag)
+        self.assertEquals(2, len(message))
+
+    def test_max_size(self) :
+        reader = MessageReader(len(TEST_MSG) - 1)
+        self.assertRaises(MemoryError, reader.feed, TEST_MSG)
+        reader = MessageReader(len(TEST_MSG) - 1)
+        self.assertRaises(MessageTooBig, reader.feed, TEST_MSG)
+
+    def feed(self, reader, data, chunk_size=100) :
+        """Feed data in chunks, returns (message, bytes fed)"""
+        for i in range(0, len(data), chunk_size) :
+            try:
+                message = reader.feed(data[i:i+chunk_size])
+            except MessageTooBig :
+                return None, i + chunk_size
+        return message, len(data)
+
+    def test_user_limit(self) :
+        limits = {'bulk': len(CREDS_MSG)}
+        verified = []
+        def check(username, password) :
+            verified.append(username)
+            return verify(username, password)
+        reader = MessageReader(CREDS_END + 100, None, None, limits.get\
+                               , check)
+        message, fed = self.feed(reader, CREDS_MSG)
+        self.assertEquals('bulk', message.findtext('.//{urn:chaski:org}From'))
+        self.assertEquals(len(CREDS_MSG), reader.max_size)
+        # credentials are verified by the worker, not while fed
+        self.assertEquals([], verified)
+        reader.verify_user()
+        self.assertEquals(['bulk'], verified)
+
+    def test_unverified_user(self) :
+        # a claimed username doesn't raise the limit
+        limits = {'bulk': len(CREDS_MSG)}
+        reader = MessageReader(CREDS_END + 100, None, None, limits.get)
+        message, fed = self.feed(reader, CREDS_MSG)
+        self.assertEquals(None, message)
+        self.assertEquals(CREDS_END + 100, reader.max_size)
+        reader = MessageReader(CREDS_END + 100, None, None, limits.get\
+                               , lambda username, password : False)
+        message, fed = self.feed(reader, CREDS_MSG)
+        self.assertRaises(MessageTooBig, reader.verify_user)
+
+    def test_small_unverified(self) :
+        # a message within the original limit needs no verification
+        reader = MessageReader(len(CREDS_MSG), None, None\
+                               , {'bulk': len(CREDS_MSG) * 2}.get\
+                               , lambda username, password : 1 / 0)
+        message, fed = self.feed(reader, CREDS_MSG)
+        reader.verify_user()
+        self.assertEquals(len(CREDS_MSG) * 2, reader.max_size)
+
+    def test_lower_user_limit(self) :
+        limits = {'bulk': CREDS_END + 100}
+        reader = MessageReader(len(CREDS_MSG), None, None, limits.get)
+        message, fed = self.feed(reader, CREDS_MSG)
+        self.assertEquals(None, message)
+        # rejected as soon as the limit is crossed
+        self.assertTrue(fed <= CREDS_END + 200)
+
+    def test_unknown_user(self) :
+        reader = MessageReader(CREDS_END + 100, None, None, {}.get)
+        message, fed = self.feed(reader, CREDS_MSG)
+        self.assertEquals(None, message)
+        self.assertEquals(CREDS_END + 100, reader.max_size)
+
+    def test_spilled_user_limit(self) :
+        spill_dir = tempfile.mkdtemp()
+        try:
+            limits = {'bulk': CREDS_END + 100}
+            reader = MessageReader(len(CREDS_MSG), None\
+                , Spiller(1024, spill_dir), limits.get)
+            message, fed = self.feed(reader, CREDS_MSG)
+            self.assertEquals(None, message)
+            self.assertTrue(fed <= CREDS_END + 200)
+        finally:
+            shutil.rmtree(spill_dir)
+
+    def test_size_limits(self) :
+        limits = MessageSizeLimits(100, {'10.0.0.2': 200}, {'bulk': 300})
+        listener = Listener(25)
+        big_listener = Listener(2525, None, 150)
+        self.assertEquals(100, limits.connection_limit(listener, '10.0.0.1'))
+        self.assertEquals(150\
+            , limits.connection_limit(big_listener, '10.0.0.1'))
+        self.assertEquals(200, limits.connection_limit(big_listener\
+                                                       , '10.0.0.2'))
+        self.assertEquals(300, limits.user_limit('bulk'))
+        self.assertEquals(None, limits.user_limit('other'))
+
+    def test_config_verify(self) :
+        auth = Auth({})
+        conf = ChaskiConfig.__new__(ChaskiConfig)
+        conf.from_params(validation='none', my_name='localhost'\
+                         , plugins=[auth], max_message_size=CREDS_END + 100\
+                         , user_message_sizes={'bulk': len(CREDS_MSG)})
+        reader = conf.size_limits.reader(conf.listeners[0], '10.0.0.1')
+        message, fed = self.feed(reader, CREDS_MSG)
+        self.assertEquals(len(CREDS_MSG), reader.max_size)
+        reader.verify_user()
+        reader = conf.size_limits.reader(conf.listeners[0], '10.0.0.1')
+        message, fed = self.feed(reader, CREDS_MSG.replace('eggs', 'ham'))
+        self.assertRaises(MessageTooBig, reader.verify_user)
+
+    def test_unverified_result(self) :
+        auth = Auth({})
+        conf = ChaskiConfig.__new__(ChaskiConfig)
+        conf.from_params(validation='none', my_name='localhost'\
+                         , plugins=[auth], max_message_size=CREDS_END + 100\
+                         , user_message_sizes={'bulk': len(CREDS_MSG)})
+        client, server = socket.socketpair()
+        client.sendall(CREDS_MSG.replace('eggs', 'ham'))
+        process_message((server, ('127.0.0.1', 0)), conf.listeners[0]\
+                        , logging.getLogger('reader_test'), conf)
+        status, description = etree.XML(client.recv(4096))
+        self.assertEquals('Rejected', status.text)
+        self.assertEquals('Message exceeds size limit of %d bytes'\
+                          % (CREDS_END + 100), description.text)
+        client.close()
+
+    def test_rejected_result(self) :
+        conf = ChaskiConfig.__new__(ChaskiConfig)
+        conf.from_params(validation='none', my_name='localhost'\
+                         , max_message_size=len(STRUCT_MSG) - 1)
+        client, server = socket.socketpair()
+        client.sendall(STRUCT_MSG)
+        process_message((server, ('127.0.0.1', 0)), conf.listeners[0]\
+                        , logging.getLogger('reader_test'), conf)
+        status, description = etree.XML(client.recv(4096))
+        self.assertEquals('Rejected', status.text)
+        self.assertEquals('Message exceeds size limit of %d bytes'\
+                          % (len(STRUCT_MSG) - 1), description.text)
+        client.close()
+
+    def test_schema(self) :
+        reader = MessageReader(len(BAD_MSG), schema_validator(SCHEMA))
+        self.assertRaises(etree.DocumentInvalid, reader.feed, BAD_MSG)
+
+    def test_deferred_validation(self) :
+        reader = MessageReader(len(BAD_MSG), schema_validator(SCHEMA))
+        reader.defer_validation()
+        message = reader.feed(BAD_MSG)
+        self.assertRaises(etree.DocumentInvalid, reader.check, message)
+
+    def test_structural(self) :
+        reader = MessageReader(len(BAD_MSG), structural_check)
+        self.assertRaises(StructureError, reader.feed, BAD_MSG)
+
+    def test_structural_mail(self) :
+        structural_check(etree.XML(STRUCT_MSG))
+        self.assertRaises(StructureError, structural_check\
+                          , etree.XML(STRUCT_MSG.replace('Subject', 'Topic')))
+        self.assertRaises(StructureError, structural_check\
+                          , etree.XML('<note/>'))
+
+    def test_closed(self) :
+        reader = MessageReader(len(TEST_MSG))
+        reader.feed(TEST_MSG[:10])
+        self.assertRaises(ConnectionClosed, reader.feed, '')
+
+    def test_read_message(self) :
+        client, server = socket.socketpair()
+        client.sendall(TEST_MSG)
+        message = MessageReader(len(TEST_MSG)).read_message(server, 16)
+        self.assertEquals(2, len(message))
+        client.close()
+        server.close()
+
+
+if __name__ == '__main__' :
+    unittest.main()
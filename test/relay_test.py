@@ -0,0 +1,217 @@
+import unittest
+import time
+import socket
+import thread
+import logging
+
+import chaski_server
+from chaski_config import ChaskiConfig
+from chaski_plugin import ChaskiPlugin
+from chaski_relay import RelayPool, Delivery, WRITE_SIZE
+from chaski_raw import ChainedChunks
+from chaski_const import PROCESS_OK, PROCESS_FAIL, SERVE_THREAD, SERVE_POLL\
+     , RESULT_MESSAGE
+
+MAIL = '''<chaski:Mail xmlns:chaski="urn:chaski:org">
+  <chaski:Message>
+      <chaski:From>spam@peer</chaski:From>
+      <chaski:To>user1@localhost</chaski:To>
+      <chaski:Subject>%s</chaski:Subject>
+  </chaski:Message>
+</chaski:Mail>'''
+
+
+class Collector(ChaskiPlugin) :
+    match = ChaskiPlugin.match_any
+
+    def __init__(self, params) :
+        ChaskiPlugin.__init__(self, params)
+        self.subjects = []
+
+    def process(self, mail, src_sock) :
+        subject = mail.findtext('{urn:chaski:org}Message/'\
+                                '{urn:chaski:org}Subject')
+        if subject == 'reject' :
+            return PROCESS_FAIL, 'rejected'
+        self.subjects.append(subject)
+        return PROCESS_OK, mail
+
+
+def read_mails(server, count) :
+    """Peer reading count mails from one connection, only the first
+    ones get Result"""
+    sock, address = server.accept()
+    for i in range(count) :
+        data = ''
+        while not data.endswith('</chaski:Mail>') :
+            data += sock.recv(4096)
+        if i < count - 1 :
+            sock.sendall(RESULT_MESSAGE % ('Success', 'stored'))
+    sock.close()
+
+
+class Store(Collector) :
+    stores = True
+
+
+def start_server(mode, keep_alive, keep_alive_timeout=0.5\
+                 , collector_class=Collector) :
+    collector = collector_class({})
+    conf = ChaskiConfig.__new__(ChaskiConfig)
+    conf.from_params(port=0, plugins=[collector], serve_mode=mode\
+                     , workers=2, validation='none', my_name='localhost'\
+                     , keep_alive=keep_alive\
+                     , keep_alive_timeout=keep_alive_timeout)
+    sock = chaski_server.init_serv_sock(0, 10)
+    thread.start_new_thread(chaski_server.SERVE_FUNCTIONS[mode]\
+        , ([(sock, conf.listeners[0])], logging.getLogger('relay_test')\
+           , conf))
+    return collector, sock.getsockname()[1]
+
+
+class RelayPoolTest(unittest.TestCase) :
+    mode = SERVE_THREAD
+
+    def relay(self, pool, port, subjects) :
+        deliveries = [Delivery('127.0.0.1', port, [MAIL % subject])\
+                      for subject in subjects]
+        return pool.relay(deliveries)
+
+    def test_keep_alive(self) :
+        collector, port = start_server(self.mode, True)
+        pool = RelayPool(max_per_host=1)
+        for i in range(3) :
+            delivery, = self.relay(pool, port, ['eggs%d' % i])
+            self.assertTrue(delivery.ok)
+        self.assertEquals(['eggs0', 'eggs1', 'eggs2'], collector.subjects)
+        self.assertEquals(1, pool.connected)
+        self.assertEquals(2, pool.reused)
+
+    def test_idle_connections(self) :
+        # kept alive connections don't hold the two workers
+        collector, port = start_server(self.mode, True, 10)
+        started = time.time()
+        pools = [RelayPool() for i in range(4)]
+        for pool in pools :
+            delivery, = self.relay(pool, port, ['eggs'])
+            self.assertTrue(delivery.ok)
+        self.assertTrue(time.time() - started < 5)
+
+    def test_streamed(self) :
+        collector, port = start_server(self.mode, True)
+        subject = 'eggs' * WRITE_SIZE
+        head, tail = MAIL.split('%s')
+        chunks = ChainedChunks([[head]\
+            , [subject[i:i+1000] for i in range(0, len(subject), 1000)]\
+            , [tail]])
+        delivery, = RelayPool().relay([Delivery('127.0.0.1', port, chunks)])
+        self.assertTrue(delivery.ok)
+        self.assertEquals([subject], collector.subjects)
+
+    def test_result(self) :
+        collector, port = start_server(self.mode, True)
+        pool = RelayPool(max_per_host=2)
+        deliveries = self.relay(pool, port, ['reject', 'spam', 'ham'])
+        self.assertEquals([False, True, True]\
+                          , [delivery.ok for delivery in deliveries])
+        self.assertEquals('rejected', deliveries[0].description)
+        self.assertTrue(deliveries[0].rejected)
+        self.assertEquals(2, pool.connected)
+        self.assertEquals(1, pool.reused)
+
+    def test_failed_after_store(self) :
+        collector, port = start_server(self.mode, True\
+                                       , collector_class=Store)
+        delivery, = self.relay(RelayPool(), port, ['reject'])
+        self.assertFalse(delivery.ok)
+        self.assertFalse(delivery.rejected)
+        self.assertEquals('rejected', delivery.description)
+
+    def test_closed_by_peer(self) :
+        collector, port = start_server(self.mode, False)
+        pool = RelayPool()
+        for i in range(2) :
+            delivery, = self.relay(pool, port, ['eggs'])
+            self.assertTrue(delivery.ok)
+            time.sleep(0.1)
+        self.assertEquals(2, pool.connected)
+        self.assertEquals(0, pool.reused)
+
+    def test_stale_connection(self) :
+        collector, port = start_server(self.mode, False)
+        pool = RelayPool()
+        self.relay(pool, port, ['eggs'])
+        time.sleep(0.1)
+        # pooled connection fails before the mail is sent
+        conn, = pool.idle[('127.0.0.1', port)]
+        conn.idle = lambda : True
+        conn.sock.shutdown(socket.SHUT_WR)
+        delivery, = self.relay(pool, port, ['spam'])
+        self.assertTrue(delivery.ok)
+        self.assertTrue(delivery.retried)
+        self.assertEquals(['eggs', 'spam'], collector.subjects)
+
+    def test_reset_before_read(self) :
+        collector, port = start_server(self.mode, False)
+        pool = RelayPool()
+        self.relay(pool, port, ['eggs'])
+        time.sleep(0.1)
+        # closing by peer is noticed after the mail is written,
+        # the reset shows the peer hasn't read it
+        conn, = pool.idle[('127.0.0.1', port)]
+        conn.idle = lambda : True
+        delivery, = self.relay(pool, port, ['spam'])
+        self.assertTrue(delivery.ok)
+        self.assertTrue(delivery.retried)
+        self.assertEquals(['eggs', 'spam'], collector.subjects)
+
+    def test_lost_result(self) :
+        # the peer reads the second mail and closes without Result,
+        # it might have stored the mail so it is not relayed again
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        thread.start_new_thread(read_mails, (server, 2))
+        pool = RelayPool()
+        port = server.getsockname()[1]
+        self.assertTrue(self.relay(pool, port, ['eggs'])[0].ok)
+        delivery, = self.relay(pool, port, ['spam'])
+        self.assertFalse(delivery.ok)
+        self.assertFalse(delivery.retried)
+        self.assertEquals(1, pool.connected)
+        server.close()
+
+    def test_closed_between_mails(self) :
+        # the peer closes connections after Result
+        collector, port = start_server(self.mode, False)
+        pool = RelayPool(max_per_host=1)
+        deliveries = self.relay(pool, port, ['a', 'b', 'c'])
+        self.assertEquals([True] * 3, [delivery.ok for delivery in deliveries])
+        self.assertEquals(['a', 'b', 'c'], collector.subjects)
+
+    def test_idle_timeout(self) :
+        collector, port = start_server(self.mode, True)
+        pool = RelayPool()
+        self.relay(pool, port, ['eggs'])
+        time.sleep(1)
+        # the server has closed idle connection, a new one is made
+        delivery, = self.relay(pool, port, ['spam'])
+        self.assertTrue(delivery.ok)
+        self.assertEquals(2, pool.connected)
+
+    def test_connect_failure(self) :
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        delivery, = self.relay(RelayPool(), port, ['eggs'])
+        self.assertFalse(delivery.ok)
+        self.assertTrue(delivery.description.startswith('Failed to connect'))
+
+
+class PollRelayPoolTest(RelayPoolTest) :
+    mode = SERVE_POLL
+
+
+if __name__ == '__main__' :
+    unittest.main()
@@ -0,0 +1,68 @@
+import unittest
+import threading
+
+from chaski_resolver import CachingResolver, HostTable, ResolveError
+
+HOSTS = HostTable({'10.0.0.1': ['mail.spam.org', 'spam.org']\
+                   , '10.0.0.2': ['eggs.org']})
+
+
+class CountingTable(object) :
+    def __init__(self) :
+        self.calls = 0
+    def __call__(self, ip) :
+        self.calls += 1
+        return HOSTS(ip)
+
+
+class CachingResolverTest(unittest.TestCase) :
+
+    def test_names(self) :
+        resolver = CachingResolver(lookup=HOSTS)
+        self.assertEquals(['spam.org', 'mail.spam.org']\
+                          , resolver.names('10.0.0.1'))
+        self.assertEquals([], resolver.names('10.0.0.3'))
+
+    def test_cache(self) :
+        table = CountingTable()
+        resolver = CachingResolver(lookup=table)
+        for i in range(3) :
+            resolver.names('10.0.0.1')
+            resolver.names('10.0.0.3')
+        self.assertEquals(2, table.calls)
+        stats = resolver.stats()
+        self.assertEquals(2, stats['hits'])
+        self.assertEquals(2, stats['negative_hits'])
+        self.assertEquals(2, stats['misses'])
+
+    def test_ttl(self) :
+        table = CountingTable()
+        resolver = CachingResolver(ttl=0, negative_ttl=0, lookup=table)
+        resolver.names('10.0.0.1')
+        resolver.names('10.0.0.1')
+        self.assertEquals(2, table.calls)
+
+    def test_lru(self) :
+        table = CountingTable()
+        resolver = CachingResolver(max_entries=1, lookup=table)
+        resolver.names('10.0.0.1')
+        resolver.names('10.0.0.2')
+        resolver.names('10.0.0.1')
+        self.assertEquals(3, table.calls)
+        self.assertEquals(1, resolver.stats()['entries'])
+
+    def test_timeout(self) :
+        gate = threading.Event()
+        def slow_lookup(ip) :
+            gate.wait()
+            return HOSTS(ip)
+        resolver = CachingResolver(timeout=0.1, lookup=slow_lookup)
+        try:
+            self.assertRaises(ResolveError, resolver.names, '10.0.0.1')
+            self.assertEquals(1, resolver.stats()['timeouts'])
+        finally:
+            gate.set()
+
+
+if __name__ == '__main__' :
+    unittest.main()
@@ -0,0 +1,122 @@
+import unittest
+import os
+import shutil
+import tempfile
+from lxml import etree
+
+from chaski_segment import ReceiveMessageToSegments\
+     , FetchMessagesFromSegments, SegmentStore
+from fetch_test import fetch_pages
+from chaski_plugin import FetchConditions, FetchAborted
+
+MESSAGE = etree.XML('''<chaski:Mail xmlns:chaski="urn:chaski:org">
+  <chaski:Message>
+      <chaski:From>spam@localhost</chaski:From>
+      <chaski:To>user1@localhost</chaski:To>
+      <chaski:Subject>Shalom Haolam!</chaski:Subject>
+      <chaski:Chapter>
+	<chaski:ChapterName>Text</chaski:ChapterName>
+	<chaski:MIMEType>text/html</chaski:MIMEType>
+	<chaski:ChapterContent>tru &lt;br>la</chaski:ChapterContent>
+      </chaski:Chapter>
+  </chaski:Message>
+</chaski:Mail>''')[0]
+
+HEADER = '''<chaski:Message xmlns:chaski="urn:chaski:org">
+      <chaski:From>spam@localhost</chaski:From>
+      <chaski:To>user1@localhost</chaski:To>
+      <chaski:Subject>Shalom Haolam!</chaski:Subject>
+      <chaski:Chapter size="10">
+	<chaski:ChapterName>Text</chaski:ChapterName>
+	<chaski:MIMEType>text/html</chaski:MIMEType>
+	</chaski:Chapter>
+  </chaski:Message>
+'''
+
+
+class SegmentStoreTest(unittest.TestCase) :
+    def setUp(self) :
+        self.dir = tempfile.mkdtemp()
+        params = {'basedir': self.dir, 'segment_size': '2000'\
+                  , 'compact_interval': '0'}
+        self.receive = ReceiveMessageToSegments(params)
+        self.fetcher = FetchMessagesFromSegments(params)
+        self.segments = self.fetcher.segments
+
+    def tearDown(self) :
+        shutil.rmtree(self.dir)
+
+    def fetch(self, accounts, **conds) :
+        mail = etree.XML(''.join(self.fetcher.fetch(accounts\
+            , FetchConditions(**conds))))
+        return [etree.tostring(m) for m in mail]
+
+    def test_stored_once(self) :
+        self.receive.store(['user1', 'user2'], MESSAGE)
+        self.assertEquals(len(etree.tostring(MESSAGE)) + len(HEADER)\
+            , os.path.getsize(self.segments.segment_path(1)))
+        self.assertEquals([etree.tostring(MESSAGE)], self.fetch(['user1']))
+        self.assertEquals([HEADER], self.fetch(['user2'], onlyheaders='1'))
+
+    def test_pages(self) :
+        for i in range(5) :
+            self.receive.store(['user1', 'user2'], MESSAGE)
+        self.assertEquals([4, 4, 2], fetch_pages(self.fetcher\
+            , ['user1', 'user2'], maxmessages='4'))
+        self.assertEquals([5], fetch_pages(self.fetcher, ['user2']\
+                                           , maxmessages='5'))
+
+    def test_order(self) :
+        for i in range(5) :
+            self.receive.store(['user1'], MESSAGE)
+        self.assertTrue(self.segments.active > 1)
+        records = self.segments.entries('user1')
+        fetched = self.segments.read(reversed(records))
+        self.assertEquals([r.msgid for r in records]\
+                          , [r.msgid for r, data in fetched])
+
+    def test_tombstones(self) :
+        self.receive.store(['user1', 'user2'], MESSAGE)
+        self.assertEquals(1, len(self.fetch(['user1'], removeafter='true')))
+        self.assertEquals([], self.fetch(['user1']))
+        self.assertEquals(1, len(self.fetch(['user2'])))
+
+    def test_compact(self) :
+        for i in range(6) :
+            self.receive.store(['user1'], MESSAGE)
+        records = self.segments.entries('user1')
+        self.segments.remove('user1', [r.msgid for r in records[:4]])
+        self.assertTrue(self.segments.compact() > 0)
+        self.assertEquals(['%08d.seg' % self.segments.active]\
+                          , os.listdir(self.segments.segments_dir))
+        self.assertEquals(2, len(self.fetch(['user1'])))
+        # the state is rebuilt from the rewritten catalog
+        other = SegmentStore(self.dir, compact_interval=0)
+        self.assertEquals([r.msgid for r in records[4:]]\
+                          , [r.msgid for r in other.entries('user1')])
+
+    def test_truncated_segment(self) :
+        self.receive.store(['user1'], MESSAGE)
+        path = self.segments.segment_path(1)
+        data = open(path, 'rb').read()
+        open(path, 'wb').write(data[:-10])
+        self.assertRaises(FetchAborted, self.fetch, ['user1'])
+
+    def test_read_while_compacted(self) :
+        for i in range(6) :
+            self.receive.store(['user1'], MESSAGE)
+        records = self.segments.entries('user1')
+        places = [(r.segno, r.offset) for r in records]
+        self.segments.remove('user1', [r.msgid for r in records[:4]])
+        # a fetch has opened the old segment before compaction
+        fetched = self.segments.read(records[4:])
+        record, data = fetched.next()
+        self.segments.compact()
+        # records held by readers keep their old places
+        self.assertEquals(places, [(r.segno, r.offset) for r in records])
+        self.assertEquals([etree.tostring(MESSAGE)] * 2\
+            , [data] + [data for record, data in fetched])
+
+
+if __name__ == '__main__' :
+    unittest.main()
@@ -8,10 +8,9 @@ import logging
 import sys
 
 import chaski_plugin
-from chaski_const import PROCESS_OK, PROCESS_FAIL
+from chaski_const import PROCESS_OK, PROCESS_FAIL, RESULT_MESSAGE
 
 res = None
-TEST_PORT = 1456
 
 TEST_MSG = '''<?xml version='1.0' encoding='UTF-8'?>
 <chaski:Mail xmlns:chaski="urn:chaski:org">
@@ -45,20 +44,23 @@ RES_MSG = '''<chaski:Mail xmlns:chaski="urn:chaski:org">
 </chaski:Mail>'''
 
 
-def listen_and_compare(l, port) :
+def listen_and_compare(l, s) :
     l.acquire()
     global res
-    s = socket.socket()
     try:
-        s.bind(('', port))
-        s.listen(10)
-
         sock, addr = s.accept()
     except socket.error, err :
         print 'Error occured %s' % err
     else :
-        data = sock.recv(1024)
+        data = ''
+        while not data.rstrip().endswith('</chaski:Mail>') :
+            chunk = sock.recv(1024)
+            if not chunk :
+                break
+            data += chunk
         res = data
+        sock.sendall(RESULT_MESSAGE % ('Success', 'Message stored'))
+        sock.close()
     finally:
         l.release()
         print 'Releasing the lock'
@@ -69,15 +71,22 @@ class DummyConf(object) :
     
 class SendPluginTest(unittest.TestCase) :
     def setUp(self) :
-        self.plugin = chaski_plugin.SendMessage({'port': TEST_PORT})
+        self.sock = socket.socket()
+        self.sock.bind(('', 0))
+        self.sock.listen(10)
+        self.plugin = chaski_plugin.SendMessage(\
+            {'port': self.sock.getsockname()[1]})
         conf = DummyConf()
         conf.my_name = 'localhost'
         self.plugin.conf = conf
         logging.basicConfig(level=logging.DEBUG, stream=sys.stdout)
 
+    def tearDown(self) :
+        self.sock.close()
+
     def test_mail_send(self) :
         l = thread.allocate_lock()
-        thread.start_new_thread(listen_and_compare, (l, TEST_PORT))
+        thread.start_new_thread(listen_and_compare, (l, self.sock))
         time.sleep(1)
         print 'Awake'
         status, out = self.plugin.process(etree.XML(TEST_MSG), None)
@@ -0,0 +1,164 @@
+import unittest
+import os
+import base64
+import shutil
+import tempfile
+from lxml import etree
+
+from chaski_reader import MessageReader
+from chaski_spill import Spiller
+from chaski_raw import register, release, message_bytes, mail_size\
+     , mail_chunks, spilled, ChainedChunks, StreamedChunks
+from chaski_plugin import make_header, SendMessage
+from chaski_store import ReceiveMessageToIndexedStore\
+     , FetchMessagesFromIndexedStore
+from chaski_plugin import FetchConditions
+
+NS = '{urn:chaski:org}'
+DATA = ''.join([chr(i % 256) for i in range(3000)])
+ENCODED = base64.encodestring(DATA) # lines of 76 characters
+
+MAIL = '''<chaski:Mail xmlns:chaski="urn:chaski:org">
+  <chaski:Message>
+      <chaski:From>spam@localhost</chaski:From>
+      <chaski:To>user1@localhost</chaski:To>
+      <chaski:Subject>Shalom Haolam!</chaski:Subject>
+      <chaski:Chapter>
+	<chaski:ChapterName>Text</chaski:ChapterName>
+	<chaski:MIMEType>text/plain</chaski:MIMEType>
+	<chaski:ChapterContent>%s</chaski:ChapterContent>
+      </chaski:Chapter>
+      <chaski:Chapter>
+	<chaski:ChapterName>Small</chaski:ChapterName>
+	<chaski:MIMEType>text/plain</chaski:MIMEType>
+	<chaski:ChapterContent>eggs &amp; ham</chaski:ChapterContent>
+      </chaski:Chapter>
+      <chaski:Chapter>
+	<chaski:ChapterName>Photo</chaski:ChapterName>
+	<chaski:MIMEType>image/png</chaski:MIMEType>
+	<chaski:ChapterContent encoding="base64">%s</chaski:ChapterContent>
+      </chaski:Chapter>
+  </chaski:Message>
+</chaski:Mail>''' % ('&lt;&amp;&gt; \xd7\x90 ' * 200, ENCODED)
+
+
+class FakeRelays(object) :
+    def __init__(self) :
+        self.deliveries = []
+
+    def relay(self, deliveries) :
+        for delivery in deliveries :
+            delivery.ok = True
+        self.deliveries.extend(deliveries)
+        return deliveries
+
+
+class RelayConf(object) :
+    my_name = 'peer'
+
+
+class SpillTest(unittest.TestCase) :
+    decode = False
+
+    def setUp(self) :
+        self.dir = tempfile.mkdtemp()
+        self.mail = self.read(MAIL)
+        self.contents = self.mail.findall('.//' + NS + 'ChapterContent')
+
+    def tearDown(self) :
+        release(self.mail)
+        shutil.rmtree(self.dir)
+
+    def read(self, data, chunk_size=100) :
+        reader = MessageReader(len(data), None\
+                               , Spiller(1024, self.dir, self.decode))
+        for i in range(0, len(data), chunk_size) :
+            mail = reader.feed(data[i:i+chunk_size])
+        register(mail, reader.raw, reader.spills)
+        return mail
+
+    def files(self) :
+        return os.listdir(self.dir)
+
+    def test_spilled(self) :
+        self.assertEquals(2, len(self.files()))
+        self.assertEquals([None, 'eggs & ham', None]\
+                          , [c.text for c in self.contents])
+        self.assertEquals(None, spilled(self.contents[1]))
+        self.assertEquals(len(DATA), spilled(self.contents[2]).content_size())
+
+    def test_message_bytes(self) :
+        expected = etree.XML(MAIL)[0]
+        data = message_bytes(self.mail[0])
+        message = etree.XML(data)
+        contents = message.findall('.//' + NS + 'ChapterContent')
+        self.assertEquals(expected.findall('.//' + NS + 'ChapterContent')[0]\
+                          .text, contents[0].text)
+        self.assertEquals(DATA, base64.decodestring(contents[2].text))
+        self.assertEquals(len(''.join(mail_chunks(self.mail)))\
+                          , mail_size(self.mail))
+
+    def test_header(self) :
+        self.assertEquals(make_header(etree.XML(MAIL)[0])\
+                          , make_header(self.mail[0]))
+
+    def test_released(self) :
+        release(self.mail)
+        self.assertEquals([], self.files())
+
+    def test_failed(self) :
+        reader = MessageReader(len(MAIL), None, Spiller(1024, self.dir))
+        reader.feed(MAIL[:-500])
+        self.assertEquals(4, len(self.files()))
+        self.assertRaises(etree.XMLSyntaxError, reader.feed, '</bad>')
+        self.assertEquals(2, len(self.files()))
+
+    def test_markup_in_content(self) :
+        data = MAIL.replace('</chaski:ChapterContent>'\
+                            , '<!-- c --></chaski:ChapterContent>', 1)
+        self.assertRaises(ValueError, self.read, data)
+        self.assertEquals(2, len(self.files()))
+
+    def test_indexed_store(self) :
+        params = {'basedir': os.path.join(self.dir, 'mail')}
+        ReceiveMessageToIndexedStore(params).store(['user1'], self.mail[0])
+        mail = etree.XML(''.join(FetchMessagesFromIndexedStore(params)\
+                                 .fetch(['user1'], FetchConditions())))
+        expected = etree.XML(MAIL).findall('.//' + NS + 'ChapterContent')
+        contents = mail.findall('.//' + NS + 'ChapterContent')
+        self.assertEquals([c.text for c in expected[:2]]\
+                          , [c.text for c in contents[:2]])
+        # base64 line breaks are not kept by decoding
+        self.assertEquals(DATA, base64.decodestring(contents[2].text))
+
+    def test_relayed(self) :
+        plugin = SendMessage({})
+        plugin.conf = RelayConf()
+        plugin.relays = FakeRelays()
+        plugin.process(self.mail, None)
+        delivery, = plugin.relays.deliveries
+        # spill files are read only when the mail is written
+        self.assertTrue(isinstance(delivery.chunks, ChainedChunks))
+        self.assertTrue(StreamedChunks in [part.__class__ for part\
+                                           in delivery.chunks.parts])
+        data = ''.join(delivery.chunks)
+        self.assertEquals(data, ''.join(delivery.chunks))
+        contents = etree.XML(data).findall('.//' + NS + 'ChapterContent')
+        self.assertEquals(DATA, base64.decodestring(contents[2].text))
+
+
+class DecodingSpillTest(SpillTest) :
+    decode = True
+
+    def test_decoded(self) :
+        spill = spilled(self.contents[2])
+        self.assertEquals(DATA, open(spill.path, 'rb').read())
+
+    def test_bad_base64(self) :
+        data = MAIL.replace(ENCODED, ENCODED[:-2])
+        self.assertRaises(ValueError, self.read, data)
+        self.assertEquals(2, len(self.files()))
+
+
+if __name__ == '__main__' :
+    unittest.main()
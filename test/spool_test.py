@@ -0,0 +1,258 @@
+import unittest
+import os
+import time
+import shutil
+import signal
+import tempfile
+
+from chaski_spool import Spool
+from chaski_relay import RelayPool
+from relay_test import start_server, MAIL
+from chaski_const import SERVE_THREAD, MAIL_HEAD, MAIL_TAIL
+
+
+class FakeRelays(object) :
+    """Answers deliveries by host: 'down' fails to connect,
+    'strict' fails mails, 'picky' rejects mails with <bad/>
+    before storing them, 'flaky' drops mails with <lost/>
+    unanswered, others accept"""
+
+    def __init__(self) :
+        self.relayed = []
+
+    def relay(self, deliveries) :
+        for delivery in deliveries :
+            data = ''.join(delivery.chunks)
+            self.relayed.append((delivery.host, data))
+            delivery.answered = delivery.host != 'down' \
+                                and not (delivery.host == 'flaky' \
+                                         and '<lost/>' in data)
+            delivery.ok = delivery.answered \
+                          and delivery.host != 'strict' \
+                          and not (delivery.host == 'picky' \
+                                   and '<bad/>' in data)
+            delivery.rejected = delivery.host == 'picky' and not delivery.ok
+        return deliveries
+
+
+class SpoolTest(unittest.TestCase) :
+    def setUp(self) :
+        self.spooldir = tempfile.mkdtemp()
+        self.relays = FakeRelays()
+        self.spool = self.make_spool()
+
+    def tearDown(self) :
+        shutil.rmtree(self.spooldir)
+
+    def make_spool(self, **params) :
+        return Spool(self.spooldir, self.relays, retry_delay=10\
+                     , max_retry_delay=25, **params)
+
+    def queued(self, host, port=25) :
+        return self.spool.queue(host, port).mail_names()
+
+    def test_deliver(self) :
+        for i in range(3) :
+            self.spool.enqueue('peer', 25, ['<mail>', buffer('%d' % i)\
+                                            , '</mail>'])
+        self.assertEquals(3, len(self.queued('peer')))
+        self.assertFalse(self.spool.deliver())
+        self.assertEquals([('peer', '<mail>%d</mail>' % i) for i in range(3)]\
+                          , self.relays.relayed)
+        self.assertEquals([], self.queued('peer'))
+
+    def test_durable(self) :
+        self.spool.enqueue('peer/../x', 25, ['<mail/>'])
+        # queued mails are found by a new spool (after restart)
+        self.spool = self.make_spool()
+        self.spool.deliver()
+        self.assertEquals([('peer/../x', '<mail/>')], self.relays.relayed)
+
+    def test_rejected(self) :
+        self.spool.enqueue('strict', 25, ['<mail/>'])
+        self.spool.deliver()
+        self.assertEquals([], self.queued('strict'))
+
+    def test_backoff(self) :
+        self.spool.enqueue('down', 25, ['<mail/>'])
+        self.spool.enqueue('peer', 25, ['<mail/>'])
+        now = time.time()
+        queue = self.spool.queue('down', 25)
+        for delay in [10, 20, 25] :
+            self.spool.deliver(now)
+            self.assertEquals(now + delay, queue.next_attempt)
+            self.assertEquals(delay, self.spool.wait_time(now))
+            # not retried before the next attempt
+            relayed = len(self.relays.relayed)
+            self.spool.deliver(now + delay - 1)
+            self.assertEquals(relayed, len(self.relays.relayed))
+            now += delay
+        self.assertEquals(1, len(self.queued('down')))
+        self.assertEquals([], self.queued('peer'))
+        queue.host = 'peer'
+        self.spool.deliver(now)
+        self.assertEquals(0, queue.failures)
+        self.assertEquals([], self.queued('down'))
+
+    def test_partly_failed(self) :
+        self.spool = self.make_spool(batch_mails=1)
+        self.enqueue_messages('flaky', ['<a/>', '<lost/>', '<b/>'])
+        # the peer answered, the lost mail is retried at once
+        self.assertTrue(self.spool.deliver())
+        queue = self.spool.queue('flaky', 25)
+        self.assertEquals(0, queue.failures)
+        self.assertEquals(1, len(self.queued('flaky')))
+        self.assertFalse(self.spool.deliver())
+        self.assertEquals(1, queue.failures)
+        self.assertEquals(1, len(self.queued('flaky')))
+
+    def test_expire(self) :
+        self.spool = self.make_spool(max_age=60)
+        self.spool.enqueue('down', 25, ['<mail/>'])
+        self.spool.deliver(time.time() + 61)
+        self.assertEquals([], self.queued('down'))
+        self.assertEquals([], self.relays.relayed)
+
+    def enqueue_messages(self, host, messages) :
+        for message in messages :
+            self.spool.enqueue(host, 25, [MAIL_HEAD, message, MAIL_TAIL])
+
+    def test_batch(self) :
+        self.spool = self.make_spool(batch_mails=2, batches_per_round=1)
+        self.enqueue_messages('peer', ['<a/>', '<b/>', '<c/>'])
+        self.spool.enqueue('peer', 25, ['<other/>'])
+        self.assertTrue(self.spool.deliver())
+        self.assertEquals(2, len(self.queued('peer')))
+        # a mail not written by SendMessage is relayed alone
+        self.assertTrue(self.spool.deliver())
+        self.assertFalse(self.spool.deliver())
+        self.assertEquals([MAIL_HEAD + '<a/><b/>' + MAIL_TAIL\
+                           , MAIL_HEAD + '<c/>' + MAIL_TAIL, '<other/>']\
+                          , [data for host, data in self.relays.relayed])
+
+    def test_batch_streamed(self) :
+        self.enqueue_messages('peer', ['<a/>', '<b/>'])
+        queue = self.spool.queue('peer', 25)
+        batch, = self.spool.batches(queue, queue.mail_names())[0]
+        # the mails are read when the batch is relayed
+        self.assertEquals(MAIL_HEAD + '<a/><b/>' + MAIL_TAIL\
+                          , ''.join(batch.chunks()))
+        os.remove(batch.paths[1])
+        self.assertRaises(IOError, ''.join, batch.chunks())
+
+    def test_batch_bytes(self) :
+        self.spool = self.make_spool(batch_bytes=8)
+        self.enqueue_messages('peer', ['<a/>', '<b/>', '<long/>'])
+        self.spool.deliver()
+        self.assertEquals([MAIL_HEAD + '<a/><b/>' + MAIL_TAIL\
+                           , MAIL_HEAD + '<long/>' + MAIL_TAIL]\
+                          , [data for host, data in self.relays.relayed])
+
+    def test_batch_age(self) :
+        self.spool = self.make_spool(batch_mails=3, batch_age=5)
+        self.enqueue_messages('peer', ['<a/>', '<b/>'])
+        now = time.time()
+        self.assertFalse(self.spool.deliver(now))
+        self.assertEquals([], self.relays.relayed)
+        self.assertTrue(4 < self.spool.wait_time(now) <= 5)
+        # flushed by age
+        self.spool.deliver(now + 5)
+        self.assertEquals(1, len(self.relays.relayed))
+        # flushed by count
+        self.enqueue_messages('peer', ['<a/>', '<b/>', '<c/>'])
+        self.spool.deliver(time.time())
+        self.assertEquals(2, len(self.relays.relayed))
+
+    def test_rejected_batch(self) :
+        self.enqueue_messages('picky', ['<a/>', '<bad/>', '<c/>'])
+        self.assertTrue(self.spool.deliver())
+        self.assertEquals(3, len(self.queued('picky')))
+        self.assertFalse(self.spool.deliver())
+        self.assertEquals([], self.queued('picky'))
+        self.assertEquals(['<a/><bad/><c/>', '<a/>', '<bad/>', '<c/>']\
+            , [data[len(MAIL_HEAD):-len(MAIL_TAIL)]\
+               for host, data in self.relays.relayed])
+        # next mails are batched again
+        self.enqueue_messages('picky', ['<d/>', '<e/>'])
+        self.spool.deliver()
+        self.assertEquals(5, len(self.relays.relayed))
+
+    def test_failed_batch(self) :
+        # the peer might have stored a part of the batch
+        self.enqueue_messages('strict', ['<a/>', '<b/>'])
+        self.assertFalse(self.spool.deliver())
+        self.assertEquals([], self.queued('strict'))
+        self.assertEquals(1, len(self.relays.relayed))
+
+    def test_shared_state(self) :
+        self.spool.enqueue('down', 25, ['<mail/>'])
+        self.enqueue_messages('picky', ['<a/>', '<bad/>'])
+        now = time.time()
+        self.spool.deliver(now)
+        # other process (or restart) follows the schedule
+        self.spool = self.make_spool()
+        self.spool.deliver(now + 1)
+        self.assertEquals(['<a/>', '<bad/>']\
+            , [data[len(MAIL_HEAD):-len(MAIL_TAIL)]\
+               for host, data in self.relays.relayed[2:]])
+        queue = self.spool.queue('down', 25)
+        self.assertEquals((1, now + 10), (queue.failures, queue.next_attempt))
+
+    def test_locked(self) :
+        self.spool.enqueue('peer', 25, ['<mail/>'])
+        fd = self.spool.queue('peer', 25).lock()
+        try:
+            self.spool.deliver()
+        finally:
+            os.close(fd)
+        self.assertEquals([], self.relays.relayed)
+
+    def test_worker(self) :
+        collector, port = start_server(SERVE_THREAD, True)
+        self.spool = Spool(self.spooldir, RelayPool())
+        self.spool.start()
+        self.spool.enqueue('127.0.0.1', port, [MAIL % 'eggs'])
+        for i in range(100) :
+            if collector.subjects :
+                break
+            time.sleep(0.05)
+        self.assertEquals(['eggs'], collector.subjects)
+
+    def test_closed_between_batches(self) :
+        collector, port = start_server(SERVE_THREAD, False)
+        self.spool = Spool(self.spooldir, RelayPool(max_per_host=1)\
+                           , batch_mails=1)
+        for subject in ['a', 'b', 'c'] :
+            self.spool.enqueue('127.0.0.1', port, [MAIL % subject])
+        self.assertFalse(self.spool.deliver())
+        self.assertEquals(['a', 'b', 'c'], collector.subjects)
+        self.assertEquals([], self.queued('127.0.0.1', port))
+        self.assertEquals(0, self.spool.queue('127.0.0.1', port).failures)
+
+    def test_forked_worker(self) :
+        collector, port = start_server(SERVE_THREAD, True)
+        self.spool = Spool(self.spooldir, RelayPool(), scan_interval=3600)
+        self.spool.start()
+        self.spool.lock.acquire()
+        try:
+            pid = os.fork()
+        finally:
+            self.spool.lock.release()
+        if pid == 0 :
+            # neither the thread nor the lock of the parent are used
+            status = 1
+            try:
+                signal.alarm(10)
+                self.spool.start()
+                self.spool.enqueue('127.0.0.1', port, [MAIL % 'eggs'])
+                while self.queued('127.0.0.1', port) :
+                    time.sleep(0.05)
+                status = 0
+            finally:
+                os._exit(status)
+        self.assertEquals(0, os.waitpid(pid, 0)[1])
+        self.assertEquals(['eggs'], collector.subjects)
+
+
+if __name__ == '__main__' :
+    unittest.main()
@@ -0,0 +1,152 @@
+import unittest
+import os
+import shutil
+import tempfile
+import signal
+import threading
+from datetime import date
+from lxml import etree
+
+from chaski_sqlite import ReceiveMessageToSQLite, FetchMessagesFromSQLite
+from fetch_test import fetch_pages
+from chaski_plugin import FetchConditions, encode_cursor
+from chaski_pool import PendingResult, CallTimeout
+from chaski_const import PROCESS_FAIL
+
+MESSAGE = etree.XML('''<chaski:Mail xmlns:chaski="urn:chaski:org">
+  <chaski:Message>
+      <chaski:From>spam@localhost</chaski:From>
+      <chaski:To>user1@localhost</chaski:To>
+      <chaski:Subject>Shalom Haolam!</chaski:Subject>
+      <chaski:Chapter>
+	<chaski:ChapterName>Text</chaski:ChapterName>
+	<chaski:MIMEType>text/html</chaski:MIMEType>
+	<chaski:ChapterContent>tru &lt;br>la</chaski:ChapterContent>
+      </chaski:Chapter>
+  </chaski:Message>
+</chaski:Mail>''')[0]
+
+HEADER = '''<chaski:Message xmlns:chaski="urn:chaski:org">
+      <chaski:From>spam@localhost</chaski:From>
+      <chaski:To>user1@localhost</chaski:To>
+      <chaski:Subject>Shalom Haolam!</chaski:Subject>
+      <chaski:Chapter size="10">
+	<chaski:ChapterName>Text</chaski:ChapterName>
+	<chaski:MIMEType>text/html</chaski:MIMEType>
+	</chaski:Chapter>
+  </chaski:Message>
+'''
+
+FETCH = '''<chaski:Fetch xmlns:chaski="urn:chaski:org">
+  <chaski:Credentials>
+    <chaski:Username>event</chaski:Username>
+    <chaski:Password>Chaski</chaski:Password>
+  </chaski:Credentials>
+  <chaski:To>user1</chaski:To>
+  <chaski:Conditions>
+    <chaski:OnlyHeader>false</chaski:OnlyHeader>
+    <chaski:RemoveAfterFetch>false</chaski:RemoveAfterFetch>
+    <chaski:Cursor>%s</chaski:Cursor>
+  </chaski:Conditions>
+</chaski:Fetch>'''
+
+
+class SQLiteStoreTest(unittest.TestCase) :
+    def setUp(self) :
+        self.dir = tempfile.mkdtemp()
+        params = {'database': os.path.join(self.dir, 'mail.db')}
+        self.receive = ReceiveMessageToSQLite(params)
+        self.fetcher = FetchMessagesFromSQLite(params)
+
+    def tearDown(self) :
+        shutil.rmtree(self.dir)
+
+    def fetch(self, accounts, **conds) :
+        mail = etree.XML(''.join(self.fetcher.fetch(accounts\
+            , FetchConditions(**conds))))
+        return [etree.tostring(m) for m in mail]
+
+    def test_store_and_fetch(self) :
+        self.receive.store(['user1', 'user2'], MESSAGE)
+        self.assertEquals([etree.tostring(MESSAGE)], self.fetch(['user1']))
+        self.assertEquals([HEADER], self.fetch(['user2'], onlyheaders='1'))
+        self.assertEquals([(1,)], self.fetcher.db.query(\
+            'SELECT count(*) FROM messages', ()))
+
+    def test_pages(self) :
+        for i in range(5) :
+            self.receive.store(['user1', 'user2'], MESSAGE)
+        self.assertEquals([3, 3, 3, 1], fetch_pages(self.fetcher\
+            , ['user1', 'user2'], maxmessages='3'))
+        self.assertEquals([2, 2, 1], fetch_pages(self.fetcher, ['user2']\
+            , onlyheaders='1', maxbytes=str(len(HEADER) * 2)))
+        self.assertEquals([2, 2, 1], fetch_pages(self.fetcher, ['user1']\
+            , maxmessages='2', removeafter='true'))
+        # malformed cursor is rejected, not restarted from the beginning
+        fetch = etree.XML(FETCH % encode_cursor('user1', 'spam'))
+        status, description = self.fetcher.process(fetch, None)
+        self.assertEquals(PROCESS_FAIL, status)
+        self.assertTrue(description.startswith('Bad fetch conditions'))
+        self.assertEquals([], self.fetch(['user1']))
+
+    def test_date_range(self) :
+        self.receive.store(['user1'], MESSAGE)
+        today = date.today().strftime('%Y-%m-%d')
+        self.assertEquals(1, len(self.fetch(['user1'], mindate=today\
+                                            , maxdate=today)))
+        self.assertEquals([], self.fetch(['user1'], maxdate='2006-08-28'))
+
+    def test_remove_after(self) :
+        self.receive.store(['user1', 'user2'], MESSAGE)
+        self.assertEquals(1, len(self.fetch(['user1'], removeafter='true')))
+        self.assertEquals([], self.fetch(['user1']))
+        self.assertEquals(1, len(self.fetch(['user2'], removeafter='true')))
+        self.assertEquals([(0,)], self.fetcher.db.query(\
+            'SELECT count(*) FROM messages', ()))
+
+    def test_concurrent_writes(self) :
+        def store() :
+            for i in range(10) :
+                self.receive.store(['user1'], MESSAGE)
+        threads = [threading.Thread(target=store) for i in range(5)]
+        for t in threads :
+            t.start()
+        for t in threads :
+            t.join()
+        self.assertEquals(50, len(self.fetch(['user1'])))
+
+    def test_forked_writer(self) :
+        self.receive.store(['user1'], MESSAGE)
+        pid = os.fork()
+        if pid == 0 :
+            # the writer thread of the parent doesn't exist in the child
+            status = 1
+            try:
+                signal.alarm(10)
+                self.receive.store(['user1'], MESSAGE)
+                status = 0
+            finally:
+                os._exit(status)
+        self.assertEquals(0, os.waitpid(pid, 0)[1])
+        self.assertEquals(2, len(self.fetch(['user1'])))
+
+    def test_write_timeout(self) :
+        db = self.receive.db
+        db.start()
+        db.write_timeout = 0.1
+        release = threading.Event()
+        db.jobs.put((PendingResult(), lambda db : release.wait(), ()))
+        try:
+            self.assertRaises(CallTimeout, db.write, lambda db : None)
+        finally:
+            release.set()
+
+    def test_indexed_query(self) :
+        plan = self.fetcher.db.query('EXPLAIN QUERY PLAN SELECT message_id'\
+            ' FROM recipients WHERE username = ? AND received >= ?'\
+            , ('user1', 0))
+        self.assertTrue('USING' in ' '.join([str(row[-1]) for row in plan]))
+
+
+if __name__ == '__main__' :
+    unittest.main()
@@ -0,0 +1,224 @@
+import unittest
+import os
+import time
+import socket
+import shutil
+import tempfile
+from datetime import date
+from lxml import etree
+
+import chaski_store
+from chaski_store import ReceiveMessageToIndexedStore\
+     , FetchMessagesFromIndexedStore, Mailbox
+from fetch_test import fetch_pages
+from chaski_plugin import FetchConditions, FetchAborted, make_header
+from chaski_const import PROCESS_FAIL
+
+MESSAGE = etree.XML('''<chaski:Mail xmlns:chaski="urn:chaski:org">
+  <chaski:Message>
+      <chaski:From>spam@localhost</chaski:From>
+      <chaski:To>user1@localhost</chaski:To>
+      <chaski:Subject>Shalom Haolam!</chaski:Subject>
+      <chaski:Chapter>
+	<chaski:ChapterName>Text</chaski:ChapterName>
+	<chaski:MIMEType>text/html</chaski:MIMEType>
+	<chaski:ChapterContent>tru &lt;br>la</chaski:ChapterContent>
+      </chaski:Chapter>
+      <chaski:Chapter>
+	<chaski:ChapterName>Photo</chaski:ChapterName>
+	<chaski:MIMEType>image/png</chaski:MIMEType>
+	<chaski:ChapterContent encoding='base64'>asdf5awe68r4</chaski:ChapterContent>
+      </chaski:Chapter>
+  </chaski:Message>
+</chaski:Mail>''')[0]
+
+FETCH = '''<chaski:Fetch xmlns:chaski="urn:chaski:org">
+  <chaski:Credentials>
+    <chaski:Username>event</chaski:Username>
+    <chaski:Password>Chaski</chaski:Password>
+  </chaski:Credentials>
+  <chaski:To>user1</chaski:To>
+  <chaski:Conditions>
+    <chaski:OnlyHeader>false</chaski:OnlyHeader>
+    <chaski:RemoveAfterFetch>false</chaski:RemoveAfterFetch>
+  </chaski:Conditions>
+</chaski:Fetch>'''
+
+
+class IndexedStoreTest(unittest.TestCase) :
+    def setUp(self) :
+        self.dir = tempfile.mkdtemp()
+        params = {'basedir': self.dir}
+        self.receive = ReceiveMessageToIndexedStore(params)
+        self.fetcher = FetchMessagesFromIndexedStore(params)
+
+    def tearDown(self) :
+        shutil.rmtree(self.dir)
+
+    def fetch(self, accounts, **conds) :
+        mail = etree.XML(''.join(self.fetcher.fetch(accounts\
+            , FetchConditions(**conds))))
+        return [etree.tostring(m) for m in mail]
+
+    def test_store_and_fetch(self) :
+        self.receive.store(['user1', 'user2'], MESSAGE)
+        self.assertEquals([etree.tostring(MESSAGE)], self.fetch(['user1']))
+        self.assertEquals([make_header(MESSAGE)]\
+                          , self.fetch(['user2'], onlyheaders='true'))
+
+    def test_pages(self) :
+        for i in range(5) :
+            self.receive.store(['user1', 'user2'], MESSAGE)
+        self.assertEquals([2, 2, 2, 2, 2], fetch_pages(self.fetcher\
+            , ['user1', 'user2'], maxmessages='2'))
+        size = len(etree.tostring(MESSAGE))
+        self.assertEquals([3, 2], fetch_pages(self.fetcher, ['user1']\
+                                              , maxbytes=str(size * 3 + 1)))
+        # the first message of a page is sent even if it's too big
+        self.assertEquals([1] * 5, fetch_pages(self.fetcher, ['user1']\
+                                               , maxbytes='1'))
+
+    def test_sharded(self) :
+        self.receive.store(['user1'], MESSAGE)
+        entry = self.fetcher.mailstore.mailbox('user1').entries()[0]
+        self.assertEquals(os.path.join(self.dir, 'user1', entry.msgid[:2]\
+            , entry.msgid[2:4], entry.msgid + '.xml')\
+            , self.fetcher.mailstore.mailbox('user1').message_path(\
+            entry.msgid))
+
+    def test_date_range(self) :
+        self.receive.store(['user1'], MESSAGE)
+        today = date.today()
+        self.assertEquals(1, len(self.fetch(['user1']\
+            , mindate=today.strftime('%Y-%m-%d'))))
+        self.assertEquals([], self.fetch(['user1'], maxdate='2006-08-28'))
+
+    def test_remove_after(self) :
+        self.receive.store(['user1', 'user2'], MESSAGE)
+        self.assertEquals(1, len(self.fetch(['user1'], removeafter='true')))
+        self.assertEquals([], self.fetch(['user1']))
+        self.assertEquals(1, len(self.fetch(['user2'])))
+
+    def test_shared_index(self) :
+        # another process appends to the index
+        self.receive.store(['user1'], MESSAGE)
+        self.assertEquals(1, len(self.fetch(['user1'])))
+        other = Mailbox(os.path.join(self.dir, 'user1'))
+        entry = other.entries()[0]
+        entry.msgid = 'f' * 32
+        other.append([str(entry)])
+        self.assertEquals(2, len(self.fetcher.mailstore.mailbox('user1')\
+                                 .entries()))
+
+    def test_compact(self) :
+        saved = chaski_store.COMPACT_MIN
+        chaski_store.COMPACT_MIN = 2
+        try:
+            for i in range(3) :
+                self.receive.store(['user1'], MESSAGE)
+            mailbox = self.fetcher.mailstore.mailbox('user1')
+            msgids = [e.msgid for e in mailbox.entries()]
+            mailbox.remove(msgids[:2])
+            index = open(mailbox.index_path).read()
+            self.assertEquals(1, len(index.splitlines()))
+            self.assertEquals(msgids[2:]\
+                              , [e.msgid for e in mailbox.entries()])
+        finally:
+            chaski_store.COMPACT_MIN = saved
+
+    def message_file(self, account) :
+        mailbox = self.fetcher.mailstore.mailbox(account)
+        entry = mailbox.entries()[0]
+        if entry.blob is not None :
+            return self.fetcher.mailstore.blobs.blob_path(entry.blob)
+        return mailbox.message_path(entry.msgid)
+
+    def truncate(self, path) :
+        data = open(path, 'rb').read()
+        open(path, 'wb').write(data[:-10])
+
+    def test_missing_file(self) :
+        self.receive.store(['user1'], MESSAGE)
+        os.remove(self.message_file('user1'))
+        self.assertEquals([], self.fetch(['user1']))
+
+    def test_truncated_file(self) :
+        self.receive.store(['user1'], MESSAGE)
+        self.truncate(self.message_file('user1'))
+        self.assertRaises(FetchAborted, self.fetch, ['user1'])
+
+    def test_aborted_connection(self) :
+        self.receive.store(['user1'], MESSAGE)
+        self.truncate(self.message_file('user1'))
+        client, server = socket.socketpair()
+        status, description = self.fetcher.process(etree.XML(FETCH), server)
+        self.assertEquals(PROCESS_FAIL, status)
+        received = []
+        while not received or received[-1] :
+            received.append(client.recv(4096))
+        # closed before the end of the mail, no Result follows
+        self.assertFalse(''.join(received).endswith('</chaski:Mail>'))
+        client.close()
+
+
+class BlobStoreTest(IndexedStoreTest) :
+    def setUp(self) :
+        self.dir = tempfile.mkdtemp()
+        # blobs needn't be on the filesystem of mailboxes
+        self.blobdir = tempfile.mkdtemp()
+        params = {'basedir': self.dir, 'blobdir': self.blobdir}
+        self.receive = ReceiveMessageToIndexedStore(params)
+        self.fetcher = FetchMessagesFromIndexedStore(params)
+        self.blobs = self.fetcher.mailstore.blobs
+
+    def tearDown(self) :
+        IndexedStoreTest.tearDown(self)
+        shutil.rmtree(self.blobdir)
+
+    def blob_files(self) :
+        files = []
+        for path, dirs, names in os.walk(self.blobdir) :
+            files.extend(names)
+        files.sort()
+        return files
+
+    def test_dedup(self) :
+        for i in range(3) :
+            self.receive.store(['user1', 'user2'], MESSAGE)
+        entry = self.fetcher.mailstore.mailbox('user1').entries()[0]
+        self.assertEquals([entry.blob + '.refs', entry.blob + '.xml']\
+                          , self.blob_files())
+        self.assertEquals(6, self.blobs.references(entry.blob))
+        self.assertEquals([etree.tostring(MESSAGE)] * 3\
+                          , self.fetch(['user2']))
+
+    def test_journal_compacted(self) :
+        self.blobs.journal_lines = 4
+        for i in range(5) :
+            self.receive.store(['user1', 'user2'], MESSAGE)
+        mailbox = self.fetcher.mailstore.mailbox('user1')
+        digest = mailbox.entries()[0].blob
+        self.assertEquals((10, 2), self.blobs.read_journal(digest))
+        self.fetcher.mailstore.remove(mailbox\
+            , [entry.msgid for entry in mailbox.entries()])
+        self.assertEquals(5, self.blobs.references(digest))
+        self.assertTrue(self.blobs.read_journal(digest)[1] < 4)
+        self.assertEquals(2, len(self.blob_files()))
+
+    def test_blob_removed(self) :
+        self.receive.store(['user1', 'user2'], MESSAGE)
+        self.receive.store(['user1'], MESSAGE)
+        self.assertEquals(2, len(self.fetch(['user1'], removeafter='true')))
+        self.assertEquals(2, len(self.blob_files()))
+        mailbox = self.fetcher.mailstore.mailbox('user2')
+        msgids = [entry.msgid for entry in mailbox.entries()]
+        self.fetcher.mailstore.remove(mailbox, msgids)
+        # removed already, references are not dropped twice
+        self.fetcher.mailstore.remove(mailbox, msgids)
+        self.assertEquals([], self.blob_files())
+        self.receive.store(['user1'], MESSAGE)
+        self.assertEquals([etree.tostring(MESSAGE)], self.fetch(['user1']))
+
+
+if __name__ == '__main__' :
+    unittest.main()
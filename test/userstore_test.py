@@ -0,0 +1,88 @@
+import unittest
+import os
+import time
+import shutil
+import tempfile
+import sqlite3
+
+from chaski_userstore import UserStore, UserTable, SnapshotTable\
+     , parse_users
+
+USERCONF = '''event, f4d5d8f67597b3166b042c81a581bfea, user1,user2,user3
+sgge, d41d8cd98f00b204e9800998ecf8427e, sgge
+'''
+
+
+class UserStoreTest(unittest.TestCase) :
+    def setUp(self) :
+        self.dir = tempfile.mkdtemp()
+        self.userconf = os.path.join(self.dir, 'user.conf')
+        self.write(USERCONF)
+
+    def tearDown(self) :
+        shutil.rmtree(self.dir)
+
+    def write(self, data) :
+        out = open(self.userconf, 'wb')
+        out.write(data)
+        out.close()
+
+    def check_table(self, table) :
+        self.assertEquals('f4d5d8f67597b3166b042c81a581bfea'\
+                          , table.password_hash('event'))
+        self.assertEquals(None, table.password_hash('user1'))
+        self.assertTrue(table.owns('event', 'user2'))
+        self.assertFalse(table.owns('sgge', 'user2'))
+        self.assertEquals('event', table.owner('user3'))
+        self.assertEquals(None, table.owner('nobody'))
+
+    def test_memory_table(self) :
+        self.check_table(UserTable(parse_users(USERCONF.split('\n'))))
+
+    def test_snapshot_table(self) :
+        snapshot = os.path.join(self.dir, 'users.db')
+        SnapshotTable.compile(parse_users(USERCONF.split('\n')), snapshot)
+        self.check_table(SnapshotTable(snapshot))
+
+    def test_reload(self) :
+        store = UserStore(self.userconf, check_interval=0)
+        old = store.table()
+        self.check_table(old)
+        self.write(USERCONF + 'spam, 0, eggs\n')
+        new = store.table()
+        self.assert_(old is not new)
+        self.assertEquals('spam', new.owner('eggs'))
+        self.assertEquals(None, old.owner('eggs'))
+
+    def test_reload_snapshot(self) :
+        snapshot = os.path.join(self.dir, 'users.db')
+        store = UserStore(self.userconf, snapshot, 0)
+        self.check_table(store.table())
+        time.sleep(0.01)
+        self.write(USERCONF + 'spam, 0, eggs\n')
+        os.utime(self.userconf, (time.time() + 1, time.time() + 1))
+        self.assertEquals('spam', store.table().owner('eggs'))
+        store = UserStore(self.userconf, snapshot)
+        self.assertEquals('spam', store.table().owner('eggs'))
+
+    def test_close_replaced_snapshot(self) :
+        snapshot = os.path.join(self.dir, 'users.db')
+        store = UserStore(self.userconf, snapshot, 0)
+        old = store.table()
+        db = old.db
+        self.write(USERCONF + 'spam, 0, eggs\n')
+        os.utime(self.userconf, (time.time() + 1, time.time() + 1))
+        self.assertEquals('spam', store.table().owner('eggs'))
+        # still open for the reader holding it
+        self.assertEquals(None, old.owner('eggs'))
+        del old
+        self.assertRaises(sqlite3.ProgrammingError, db.execute, 'SELECT 1')
+
+    def test_reload_failure(self) :
+        store = UserStore(self.userconf, check_interval=0)
+        os.remove(self.userconf)
+        self.check_table(store.table())
+
+
+if __name__ == '__main__' :
+    unittest.main()
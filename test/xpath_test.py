@@ -0,0 +1,47 @@
+import unittest
+from lxml import etree
+
+import chaski_plugin
+
+TEST_MSG = etree.XML('''<?xml version='1.0' encoding='UTF-8'?>
+<chaski:Mail xmlns:chaski="urn:chaski:org">
+  <chaski:Credentials>
+    <chaski:Username>event</chaski:Username>
+    <chaski:Password></chaski:Password>
+  </chaski:Credentials>
+  <chaski:Message>
+      <chaski:From>spam</chaski:From>
+      <chaski:To>maps@sgge.org</chaski:To>
+      <chaski:To>sgge@localhost</chaski:To>
+  </chaski:Message>
+</chaski:Mail>''')
+
+
+class CompiledXPathTest(unittest.TestCase) :
+
+    def test_cache(self) :
+        path = chaski_plugin.compile_xpath('chaski:Message')
+        self.assert_(path is chaski_plugin.compile_xpath('chaski:Message'))
+        other = chaski_plugin.compile_xpath('c:Message', {'c': 'urn:other'})
+        self.assert_(path is not other)
+        self.assertEquals([], other(TEST_MSG))
+
+    def test_node_text(self) :
+        self.assertEquals('event', chaski_plugin.node_text(\
+            chaski_plugin.USERNAME_PATH, TEST_MSG))
+        self.assertEquals('', chaski_plugin.node_text(\
+            chaski_plugin.PASSWORD_PATH, TEST_MSG))
+        self.assertEquals(None, chaski_plugin.node_text(\
+            chaski_plugin.TO_PATH, TEST_MSG))
+        self.assertEquals(2, len(chaski_plugin.MESSAGE_TO_PATH(TEST_MSG)))
+
+    def test_xpath_exists(self) :
+        plugin = chaski_plugin.ChaskiPlugin({'match_xpath': '/chaski:Mail'})
+        self.assertTrue(plugin.xpath_exists(TEST_MSG))
+        plugin = chaski_plugin.ChaskiPlugin({'match_xpath': '/chaski:Fetch'})
+        plugin.compile_matchers()
+        self.assertFalse(plugin.xpath_exists(TEST_MSG))
+
+
+if __name__ == '__main__' :
+    unittest.main()